@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# aio - asyncio variant of the ASCOM Alpaca Device superclass
+#
+# Part of the Alpyca application interface package
+#
+# Python Compatibility: Requires Python 3.7 or later
+# GitHub: https://github.com/ASCOMInitiative/alpyca
+#
+# -----------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2022 Ethan Chappel and Bob Denny
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# -----------------------------------------------------------------------------
+# Edit History:
+# 18-Oct-26 (lightapt) Initial Edit, pooled keep-alive connections per host,
+#                      per request timeouts and gather_properties()
+# -----------------------------------------------------------------------------
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from typing import Dict, List
+import requests
+from requests.adapters import HTTPAdapter
+from libs.alpyca.device import Device, API_VERSION, check_response
+
+# Enough for a whole camera configuration in one round trip
+POOL_SIZE = 32
+DEFAULT_TIMEOUT = 5.0
+
+class HostPool:
+    """Keep-alive connections to one Alpaca server, shared by all of its devices.
+
+    Notes:
+        * The HTTP requests are made by a pooled ``requests.Session`` on the
+          worker threads of the pool, so at most ``size`` requests are on the
+          wire at the same time and each of them re-uses an open connection.
+          The coroutines of :py:class:`AsyncDevice` only wait for them.
+
+    """
+
+    def __init__(self, base: str, size: int = POOL_SIZE):
+        """Initialize HostPool object.
+
+        Attributes:
+            base: Protocol and address of the Alpaca server e.g. http://127.0.0.1:11111
+            size: Number of connections and worker threads.
+
+        """
+        self.base = base
+        self.size = size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="alpaca")
+
+    def close(self) -> None:
+        """Close the connections and stop the worker threads."""
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+_pools: Dict[str, HostPool] = {}
+_pools_lock = Lock()
+
+def get_pool(protocol: str, address: str) -> HostPool:
+    """Get the shared connection pool of an Alpaca server, created on first use.
+
+    Args:
+        protocol: http or https
+        address: Domain name or IP address of Alpaca server, with the port.
+
+    """
+    base = f"{protocol}://{address}"
+    with _pools_lock:
+        pool = _pools.get(base)
+        if pool is None:
+            pool = _pools[base] = HostPool(base)
+        return pool
+
+def close_pools() -> None:
+    """Close the connection pools of all Alpaca servers."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+class AsyncDevice:
+    """asyncio interface to any ASCOM Alpaca device.
+
+    Notes:
+        * Properties are read with :py:meth:`get` using their Alpaca name, e.g.
+          ``await dev.get("RightAscension")``, and written or commanded with
+          :py:meth:`put`. Values are returned as sent by the server, no enum or
+          type conversion is made.
+        * All the devices of a server share one :py:class:`HostPool`.
+
+    """
+
+    def __init__(
+        self,
+        address: str,
+        device_type: str,
+        device_number: int,
+        protocol: str = "http",
+        timeout: float = DEFAULT_TIMEOUT
+    ):
+        """Initialize AsyncDevice object.
+
+        Attributes:
+            address: Domain name or IP address of Alpaca server.
+                Can also specify port number if needed.
+            device_type: One of the recognised ASCOM device types
+                e.g. telescope (must be lower case).
+            device_number: Zero based device number as set on the server.
+            protocol: Protocol (http vs https) used to communicate with Alpaca server.
+            timeout: Default timeout of one request in seconds.
+
+        """
+        self.address = address
+        self.device_type = device_type.lower()
+        self.device_number = device_number
+        self.api_version = API_VERSION
+        self.timeout = timeout
+        self.base_url = "%s://%s/api/v%d/%s/%d" % (
+            protocol,
+            self.address,
+            self.api_version,
+            self.device_type,
+            self.device_number
+        )
+        self.pool = get_pool(protocol, address)
+
+    @classmethod
+    def from_device(cls, device: Device, timeout: float = DEFAULT_TIMEOUT) -> "AsyncDevice":
+        """Create the asyncio twin of a blocking :py:class:`~alpaca.device.Device`.
+
+        Args:
+            device: Any Alpyca device, e.g. Telescope.
+            timeout: Default timeout of one request in seconds.
+
+        """
+        protocol = device.base_url.split("://", 1)[0]
+        return cls(device.address, device.device_type, device.device_number, protocol, timeout)
+
+    async def get(self, attribute: str, tmo: float = None, **data):
+        """Read a property or call a GET method of the device.
+
+        Args:
+            attribute: Alpaca name of the property, case insensitive.
+            tmo (optional) Timeout in seconds, the default of the device if None.
+            **data: Data to send with request.
+
+        Returns:
+            The Value member of the response.
+
+        Raises:
+            asyncio.TimeoutError: If the server did not answer in time.
+            Any of the ASCOM exceptions raised by the blocking interface.
+
+        """
+        response = await self._request("get", attribute, tmo, data)
+        return response["Value"]
+
+    async def put(self, attribute: str, tmo: float = None, **data) -> dict:
+        """Write a property or call a PUT method of the device.
+
+        Args:
+            attribute: Alpaca name of the property or method, case insensitive.
+            tmo (optional) Timeout in seconds, the default of the device if None.
+            **data: Data to send with request.
+
+        Returns:
+            The whole JSON response.
+
+        """
+        return await self._request("put", attribute, tmo, data)
+
+    async def gather_properties(self, names: List[str], tmo: float = None) -> dict:
+        """Read several properties concurrently.
+
+        Args:
+            names: Alpaca names of the properties.
+            tmo (optional) Timeout of each request in seconds.
+
+        Returns:
+            Dictionary {name: value}. A property which failed has the exception
+            as value, so that one unimplemented property does not hide the others.
+
+        Notes:
+            * All the requests are sent at once, reading a whole configuration
+              costs about one round trip instead of one per property.
+
+        """
+        values = await asyncio.gather(*(self.get(name, tmo) for name in names), return_exceptions=True)
+        return dict(zip(names, values))
+
+    async def _request(self, method: str, attribute: str, tmo: float, data: dict) -> dict:
+        """Run one HTTP request on the pool of the server and check the response."""
+        tmo = self.timeout if tmo is None else tmo
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.pool.executor, self._send, method, attribute.lower(), tmo, data)
+        # The socket timeout of requests is per read, the whole request is bounded here
+        return await asyncio.wait_for(future, tmo + 1.0)
+
+    def _send(self, method: str, attribute: str, tmo: float, data: dict) -> dict:
+        """Blocking part of a request, runs on a worker thread of the pool."""
+        # Make Host: header safe for IPv6
+        if(self.address.startswith('[') and not self.address.startswith('[::1]')):
+            hdrs = {'Host': f'{self.address.split("%")[0]}]'}
+        else:
+            hdrs = {}
+        with Device._ctid_lock:
+            pdata = {
+                    "ClientTransactionID": f"{Device._client_trans_id}",
+                    "ClientID": f"{Device._client_id}"
+                    }
+            Device._client_trans_id += 1
+        pdata.update(data)
+        url = "%s/%s" % (self.base_url, attribute)
+        if method == "get":
+            response = self.pool.session.get(url, params=pdata, timeout=tmo, headers=hdrs)
+        else:
+            response = self.pool.session.put(url, data=pdata, timeout=tmo, headers=hdrs)
+        check_response(response)
+        return response.json()
+
+class AsyncCamera(AsyncDevice):
+    """asyncio interface to an ASCOM Alpaca camera."""
+
+    def __init__(self, address: str, device_number: int, protocol: str = "http", timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(address, "camera", device_number, protocol, timeout)
+
+class AsyncFilterWheel(AsyncDevice):
+    """asyncio interface to an ASCOM Alpaca filter wheel."""
+
+    def __init__(self, address: str, device_number: int, protocol: str = "http", timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(address, "filterwheel", device_number, protocol, timeout)
+
+class AsyncFocuser(AsyncDevice):
+    """asyncio interface to an ASCOM Alpaca focuser."""
+
+    def __init__(self, address: str, device_number: int, protocol: str = "http", timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(address, "focuser", device_number, protocol, timeout)
+
+class AsyncTelescope(AsyncDevice):
+    """asyncio interface to an ASCOM Alpaca telescope."""
+
+    def __init__(self, address: str, device_number: int, protocol: str = "http", timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(address, "telescope", device_number, protocol, timeout)
+
+# ========================
+# Blocking callers
+# ========================
+
+_loop = None
+_loop_lock = Lock()
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Event loop of the blocking callers, running on its own thread."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, name="AlpacaLoop", daemon=True).start()
+        return _loop
+
+def run_sync(coro):
+    """Run a coroutine of this module from blocking code and wait for its result.
+
+    Notes:
+        * Works on any thread, including the one of a running event loop,
+          the coroutine is run on a private loop.
+
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+def prefetch_properties(device: Device, names: List[str], tmo: float = DEFAULT_TIMEOUT) -> dict:
+    """Read several properties of a blocking device concurrently.
+
+    Args:
+        device: Any Alpyca device, e.g. Camera.
+        names: Alpaca names of the properties.
+        tmo (optional) Timeout of each request in seconds.
+
+    Returns:
+        Dictionary {name: value or exception}, see :py:meth:`AsyncDevice.gather_properties`
+
+    """
+    return run_sync(AsyncDevice.from_device(device, tmo).gather_properties(names))
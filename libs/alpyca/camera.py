@@ -38,6 +38,7 @@
 # 02-May-22 (rbd) Initial Edit
 # 13-May-22 (rbd) 2.0.0-dev1 Project now called "Alpyca" - no logic changes
 # 21-Jul-22 (rbd) 2.0.1 Resolve TODO reviews
+# 18-Oct-26 (lightapt) Add ImageArrayNumpy, ImageBytes streamed into numpy buffer
 # -----------------------------------------------------------------------------
 
 from libs.alpyca.device import Device
@@ -47,6 +48,7 @@ from libs.alpyca.docenum import DocIntEnum
 from typing import List
 import requests
 import array
+import numpy as np
 
 class CameraStates(DocIntEnum):
     """Current condition of the Camera"""
@@ -826,6 +828,29 @@ class Camera(Device):
         """
         return self._get_imagedata("imagearray")
 
+    @property
+    def ImageArrayNumpy(self) -> np.ndarray:
+        """Return the exposure pixel values as a *numpy* array, ready for FITS.
+
+        Raises:
+            InvalidOperationException: If no image data is available
+            NotConnectedException: If the device is not connected
+            DriverException: An error occurred that is not described by
+                one of the more specific ASCOM exceptions.
+                The device did not *successfully* complete the request.
+
+        Notes:
+            * Unlike :py:attr:`ImageArray` the returned array is already transposed,
+              shape is (Y, X) for Rank 2 and (Z, Y, X) for Rank 3 images, so it can be 
+              given to *astropy* directly. It is a view on the received buffer, no copy.
+            * With ImageBytes the HTTP body is streamed straight into a preallocated 
+              buffer of the transmission element type (e.g. uint16), no Python objects
+              are created per pixel. JSON image data is converted with ``np.array``.
+            * See :py:attr:`ImageArrayInfo` for metadata covering the returned image data.
+
+        """
+        return self._get_imagedata_numpy("imagearray")
+
     @property
     def ImageArrayInfo(self) -> ImageMetadata:
         """Get image metadata sucn as dimensions, data type, rank.
@@ -1684,6 +1709,128 @@ class Camera(Device):
             )
             return l
 
+    def _get_imagedata_numpy(self, attribute: str, tmo=60.0, **data) -> np.ndarray:
+        """Get image data as a numpy array, streaming ImageBytes into a preallocated buffer
+
+        Args:
+            attribute (str): Attribute to get from server.
+            tmo (optional) Timeout for HTTP (default = 60 sec)
+            **data: Data to send with request.
+
+        """
+        hdrs = {'accept' : 'application/imagebytes'}
+        # Make Host: header safe for IPv6
+        if(self.address.startswith('[') and not self.address.startswith('[::1]')):
+            hdrs['Host'] = f'{self.address.split("%")[0]}]'
+        # Only the transaction id needs the lock, do not hold it during the download
+        with Device._ctid_lock:
+            pdata = {
+                    "ClientTransactionID": f"{Device._client_trans_id}",
+                    "ClientID": f"{Device._client_id}" 
+                    }
+            Device._client_trans_id += 1
+        pdata.update(data)
+        response = self.rqs.get("%s/%s" % (self.base_url, attribute), params=pdata,
+                        headers=hdrs, timeout=tmo, stream=True)
+        try:
+            if response.status_code not in range(200, 204):             # HTTP level errors 
+                raise AlpacaRequestException(response.status_code, 
+                        f"{response.reason}: {response.text} (URL {response.url})")
+
+            ct = response.headers.get('content-type')   # case insensitive
+            m = 'little'
+            #
+            # IMAGEBYTES -> read the header, then the pixels straight into the array
+            #
+            if ct == 'application/imagebytes':
+                raw = response.raw
+                raw.decode_content = True                   # In case of gzip
+                b = _read_exact(raw, 44)
+                n = int.from_bytes(b[4:8], m)
+                if n != 0:
+                    raise_alpaca_if(n, raw.read().decode(encoding='UTF-8'))
+                self.img_desc = ImageMetadata(
+                    int.from_bytes(b[0:4], m),          # Meta version
+                    int.from_bytes(b[20:24], m),        # Image element type
+                    int.from_bytes(b[24:28], m),        # Xmsn element type
+                    int.from_bytes(b[28:32], m),        # Rank
+                    int.from_bytes(b[32:36], m),        # Dimension 1
+                    int.from_bytes(b[36:40], m),        # Dimension 2
+                    int.from_bytes(b[40:44], m)         # Dimension 3
+                    )
+                dtype = IMAGEBYTES_DTYPES.get(self.img_desc.TransmissionElementType)
+                if dtype is None:
+                    raise InvalidValueException("Unknown or as-yet unsupported ImageBytes Transmission Array Element Type")
+                data_start = int.from_bytes(b[16:20], m)
+                if data_start > 44:
+                    _read_exact(raw, data_start - 44)
+                shape = (self.img_desc.Dimension1, self.img_desc.Dimension2)
+                if self.img_desc.Rank == 3:
+                    shape += (self.img_desc.Dimension3,)
+                nda = np.empty(shape, dtype=dtype)
+                _readinto_exact(raw, memoryview(nda).cast('B'))
+            #
+            # JSON IMAGE DATA -> List of Lists (row major)
+            #
+            else:
+                j = response.json()
+                raise_alpaca_if_error(j["ErrorNumber"], j["ErrorMessage"])
+                nda = np.array(j["Value"])
+                if nda.dtype.kind == 'f':
+                    xmtype = ImageArrayElementTypes.Double
+                else:
+                    nda = nda.astype(np.int32, copy=False)
+                    xmtype = ImageArrayElementTypes.Int32
+                self.img_desc = ImageMetadata(
+                    1,                                  # Meta version
+                    xmtype,                             # Image element type
+                    xmtype,                             # Xmsn element type
+                    nda.ndim,                           # Rank
+                    nda.shape[0],                       # Dimension 1
+                    nda.shape[1],                       # Dimension 2
+                    nda.shape[2] if nda.ndim == 3 else 0    # Dimension 3
+                )
+        finally:
+            response.close()
+        # Alpaca sends [X][Y]([Z]), give back the FITS (Z,)Y,X order as a view
+        return nda.transpose()
+
+# ImageBytes transmission element types , always little endian on the wire
+IMAGEBYTES_DTYPES = {
+    ImageArrayElementTypes.Int16.value : np.dtype('<i2'),
+    ImageArrayElementTypes.Int32.value : np.dtype('<i4'),
+    ImageArrayElementTypes.Double.value : np.dtype('<f8'),
+    ImageArrayElementTypes.Single.value : np.dtype('<f4'),
+    ImageArrayElementTypes.UInt64.value : np.dtype('<u8'),
+    ImageArrayElementTypes.Byte.value : np.dtype('u1'),
+    ImageArrayElementTypes.Int64.value : np.dtype('<i8'),
+    ImageArrayElementTypes.UInt16.value : np.dtype('<u2'),
+}
+
+def _read_exact(raw, n: int) -> bytes:
+    """Read exactly n bytes from a streamed response or raise"""
+    b = raw.read(n)
+    while len(b) < n:
+        more = raw.read(n - len(b))
+        if not more:
+            raise AlpacaRequestException(0, "ImageBytes response ended too early")
+        b += more
+    return b
+
+def _readinto_exact(raw, buf: memoryview) -> None:
+    """Fill the whole buffer from a streamed response or raise"""
+    pos = 0
+    while pos < len(buf):
+        n = raw.readinto(buf[pos:])
+        if not n:
+            raise AlpacaRequestException(0, "ImageBytes response ended too early")
+        pos += n
+
+def raise_alpaca_if_error(n, m):
+    """Same as :py:func:`raise_alpaca_if` but does nothing when there is no error"""
+    if n != 0:
+        raise_alpaca_if(n, m)
+
 def raise_alpaca_if(n, m):
     """If non-zero Alpaca error, raise the appropriate Alpaca exception
 
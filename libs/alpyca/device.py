@@ -41,6 +41,7 @@
 # 17-Jul-22 (rbd) 2.0.1rc1 Speed up by re-using ports via requests.Session().
 # 21-Jul-22 (rbd) 2.0.1 Resolve TODO reviews
 # 21-Aug-22 (rbd) 2.0.2 Fix DriverVersion to return the string GitHub issue #4
+# 18-Oct-26 (lightapt) Move the Alpaca error check to check_response() for aio
 # -----------------------------------------------------------------------------
 
 from threading import Lock
@@ -420,48 +421,52 @@ class Device:
         return response.json()
 
     def __check_error(self, response) -> None:
-        """Alpaca exception handler (ASCOM exception types)
-
-        Args:
-            response (Response): Response from Alpaca server to check.
-
-        Notes:
-            * Depending on the error number, the appropriate ASCOM exception type
-              will be raised. See the ASCOM Alpaca API Reference for the reserved
-              error codes and their corresponding exceptions. NOTE that DriverException
-              and AlpacaRequestException take error code and message.
-            * If an unassigned error code in the range 0x400 <= code <= 0x4FF
-              is received, a DriverException will also be raised.
-
-
-        """
-        if response.status_code in range(200, 204):
-            j = response.json()
-            n = j["ErrorNumber"]
-            m = j["ErrorMessage"]
-            if n != 0:
-                if n == 0x0400:
-                    raise NotImplementedException(m)
-                elif n == 0x0401:
-                    raise InvalidValueException(m)
-                elif n == 0x0402:
-                    raise ValueNotSetException(m)
-                elif n == 0x0407:
-                    raise NotConnectedException(m)
-                elif n == 0x0408:
-                    raise ParkedException(m)
-                elif n == 0x0409:
-                    raise SlavedException(m)
-                elif n == 0x040B:
-                    raise InvalidOperationException(m)
-                elif n == 0x040c:
-                    raise ActionNotImplementedException(m)
-                elif n >= 0x500 and n <= 0xFFF:
-                    raise DriverException(n, m)
-                else: # unknown 0x400-0x4FF
-                    raise DriverException(n, m) # Outside 0x500-0x5FF but agreed on this
-        else:
-            raise AlpacaRequestException(response.status_code, f"{response.text} (URL {response.url})")
+        """Alpaca exception handler (ASCOM exception types), see :py:func:`check_response`"""
+        check_response(response)
+
+def check_response(response) -> None:
+    """Alpaca exception handler (ASCOM exception types)
+
+    Args:
+        response (Response): Response from Alpaca server to check.
+
+    Notes:
+        * Depending on the error number, the appropriate ASCOM exception type
+          will be raised. See the ASCOM Alpaca API Reference for the reserved
+          error codes and their corresponding exceptions. NOTE that DriverException
+          and AlpacaRequestException take error code and message.
+        * If an unassigned error code in the range 0x400 <= code <= 0x4FF
+          is received, a DriverException will also be raised.
+
+
+    """
+    if response.status_code in range(200, 204):
+        j = response.json()
+        n = j["ErrorNumber"]
+        m = j["ErrorMessage"]
+        if n != 0:
+            if n == 0x0400:
+                raise NotImplementedException(m)
+            elif n == 0x0401:
+                raise InvalidValueException(m)
+            elif n == 0x0402:
+                raise ValueNotSetException(m)
+            elif n == 0x0407:
+                raise NotConnectedException(m)
+            elif n == 0x0408:
+                raise ParkedException(m)
+            elif n == 0x0409:
+                raise SlavedException(m)
+            elif n == 0x040B:
+                raise InvalidOperationException(m)
+            elif n == 0x040c:
+                raise ActionNotImplementedException(m)
+            elif n >= 0x500 and n <= 0xFFF:
+                raise DriverException(n, m)
+            else: # unknown 0x400-0x4FF
+                raise DriverException(n, m) # Outside 0x500-0x5FF but agreed on this
+    else:
+        raise AlpacaRequestException(response.status_code, f"{response.text} (URL {response.url})")
 
 
 
@@ -0,0 +1,264 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# State cache between the Alpaca devices and the API callers
+#
+# Every property read through the cache is kept for a time to live
+# depending on the property. A fresh value is returned from memory,
+# a stale one is read again from the device. When several threads
+# ask for the same stale property at the same time , only one HTTP
+# request is made and all of them get its result.
+#
+# Writes and commands (goto , park , move ...) are still sent to the
+# device directly , the API then invalidates the properties they
+# change so the next read gets the new state.
+#
+# At connection the configuration properties are prefetched all at
+# once with the asyncio client (libs/alpyca/aio.py) , so reading the
+# whole configuration costs about one round trip.
+#
+# The time to live can be changed in the "cache" section of the
+# configuration :
+#   "cache" : {"default_ttl" : 1.0 , "ttl" : {"RightAscension" : 0.5}}
+#
+# #################################################################
+
+import threading
+import time
+from concurrent.futures import Future
+
+import server.config as c
+from libs.alpyca.aio import prefetch_properties
+
+DEFAULT_TTL = 1.0
+
+# Time to live of the properties in seconds , fast changing ones are short
+TELESCOPE_TTL = {
+    "RightAscension" : 0.5,
+    "Declination" : 0.5,
+    "Azimuth" : 0.5,
+    "Altitude" : 0.5,
+    "Slewing" : 0.25,
+    "Tracking" : 2.0,
+    "AtPark" : 2.0,
+    "AtHome" : 2.0,
+    "SiteLatitude" : 3600.,
+    "SiteLongitude" : 3600.,
+}
+
+FOCUSER_TTL = {
+    "Position" : 0.25,
+    "IsMoving" : 0.25,
+    "Temperature" : 10.0,
+    "TempComp" : 5.0,
+}
+
+FILTERWHEEL_TTL = {
+    "Position" : 0.25,
+}
+
+CAMERA_TTL = {
+    "CameraState" : 0.1,
+    "CCDTemperature" : 2.0,
+    "CoolerPower" : 2.0,
+    "CoolerOn" : 5.0,
+}
+
+# Plain properties read by get_configration() , prefetched concurrently at connection
+# NOTE : Enum properties (CameraState , TrackingRate ...) are converted by the blocking
+#        interface , they are not prefetched
+TELESCOPE_CONFIG = (
+    "Name","Description","CanPark","CanSetPark","CanSetTracking","CanSync","CanFindHome",
+    "SiteLongitude","SiteLatitude","AtPark","Tracking","Slewing",
+    "RightAscension","Declination","Azimuth","Altitude",
+    "CanSetRightAscensionRate","RightAscensionRate","CanSetDeclinationRate","DeclinationRate",
+)
+
+FOCUSER_CONFIG = (
+    "Name","Description","TempCompAvailable","Temperature","Position","MaxStep","MaxIncrement","StepSize",
+)
+
+FILTERWHEEL_CONFIG = (
+    "Name","Description","FocusOffsets","Names","Position",
+)
+
+CAMERA_CONFIG = (
+    "Name","Description","CanAsymmetricBin","BinX","BinY","CanSetCCDTemperature","CanGetCoolerPower",
+    "CCDTemperature","CoolerPower","CoolerOn","Gain","GainMax","GainMin","Offset","OffsetMax","OffsetMin",
+    "CanPulseGuide","HasShutter","IsPulseGuiding","ImageReady","ExposureMax","ExposureMin","ExposureResolution",
+    "MaxBinX","MaxBinY","CameraXSize","CameraYSize","BayerOffsetX","BayerOffsetY","PixelSizeX","PixelSizeY",
+    "MaxADU","StartX","StartY","NumX","NumY","SensorName",
+)
+
+class DeviceStateCache(object):
+    """
+        Coalescing cache of the properties of one Alpaca device
+    """
+
+    def __init__(self, device, ttl : dict = None, default_ttl : float = None) -> None:
+        """
+            Args :
+                device : alpyca device like Telescope
+                ttl : dict # {property : seconds} , merged with the "cache" configuration
+                default_ttl : float # time to live of the other properties
+        """
+        options = c.config.get("cache") or {}
+        self.device = device
+        self.ttl = dict(ttl or {})
+        self.ttl.update(options.get("ttl") or {})
+        self.default_ttl = default_ttl if default_ttl is not None else options.get("default_ttl", DEFAULT_TTL)
+        # property -> (value , time of the read)
+        self._values = {}
+        # property -> Future of the running read
+        self._reading = {}
+        # Bumped by invalidate() , a read started before is returned but not kept
+        self._generation = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits" : 0,
+            "reads" : 0,
+            "coalesced" : 0,
+            "errors" : 0,
+            "prefetched" : 0,
+        }
+
+    def get(self, name : str, max_age : float = None):
+        """
+            Get a property , from memory if it is fresh enough | 获取属性
+            Args :
+                name : str # Alpaca property like "RightAscension"
+                max_age : float # override the time to live , 0 forces a read
+            Returns : value of the property
+            NOTE : Alpaca exceptions are raised to every caller waiting for the read
+        """
+        ttl = self.ttl.get(name, self.default_ttl) if max_age is None else max_age
+        with self._lock:
+            entry = self._values.get(name)
+            if entry is not None and time.monotonic() - entry[1] < ttl:
+                self._stats["hits"] += 1
+                return entry[0]
+            future = self._reading.get(name)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                owner = False
+            else:
+                future = self._reading[name] = Future()
+                generation = self._generation.get(name, 0)
+                self._stats["reads"] += 1
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            value = getattr(self.device, name)
+        except BaseException as e:
+            with self._lock:
+                self._stats["errors"] += 1
+                self._reading.pop(name, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if self._generation.get(name, 0) == generation:
+                self._values[name] = (value, time.monotonic())
+            self._reading.pop(name, None)
+        future.set_result(value)
+        return value
+
+    def get_many(self, names : list, max_age : float = None) -> dict:
+        """
+            Get several properties
+            Args :
+                names : list
+                max_age : float
+            Returns : dict # {property : value}
+        """
+        return {name : self.get(name, max_age) for name in names}
+
+    def prefetch(self, names : list) -> int:
+        """
+            Read several properties concurrently and keep them | 并发预取属性
+            Args :
+                names : list # Alpaca properties , see CAMERA_CONFIG
+            Returns : int # number of properties read
+            NOTE : A property which failed is not kept , the next get() reads it again
+                    and raises its exception to the caller
+        """
+        with self._lock:
+            generations = {name : self._generation.get(name, 0) for name in names}
+        values = prefetch_properties(self.device, list(names))
+        now = time.monotonic()
+        count = 0
+        with self._lock:
+            for name, value in values.items():
+                if isinstance(value, BaseException) or self._generation.get(name, 0) != generations[name]:
+                    continue
+                self._values[name] = (value, now)
+                count += 1
+            self._stats["prefetched"] += count
+        return count
+
+    def peek(self, name : str, default = None):
+        """
+            Get the last known value without any request
+            Args :
+                name : str
+                default : returned if the property was never read
+            Returns : value
+        """
+        with self._lock:
+            entry = self._values.get(name)
+        return entry[0] if entry is not None else default
+
+    def set(self, name : str, value) -> None:
+        """
+            Store a value known by the caller , like the one just written
+            Args :
+                name : str
+                value : any
+            Returns : None
+        """
+        with self._lock:
+            self._generation[name] = self._generation.get(name, 0) + 1
+            self._values[name] = (value, time.monotonic())
+
+    def invalidate(self, *names) -> None:
+        """
+            Forget some properties , all of them if no name is given | 清除缓存
+            Args :
+                *names : str
+            Returns : None
+            NOTE : Call it after every command changing the state of the device
+        """
+        with self._lock:
+            for name in (names or list(self._values.keys())):
+                self._values.pop(name, None)
+                self._generation[name] = self._generation.get(name, 0) + 1
+
+    def get_stats(self) -> dict:
+        """
+            Get the counters of the cache
+            Args : None
+            Returns : dict # hits , reads , coalesced , errors , prefetched , size
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._values)
+        return stats
@@ -39,12 +39,26 @@ from datetime import datetime
 from os import path,mkdir,getcwd
 from json import dumps,JSONDecodeError
 import numpy as np
-import astropy.io.fits as fits
 from io import BytesIO
 from base64 import b64encode
 from requests.exceptions import ConnectionError
 from sys import _getframe
 
+from utils.frame import pack_frame
+from utils.histogram import analyse_frame
+from utils.preview import preview_store
+from utils.fitswriter import get_fits_writer
+from utils.image import calc_star_metrics
+from server.basic.sequence import SequenceEngine,SequenceAbort,SEQUENCE_MODES
+from server.basic.video import VideoCapture
+from server.api.ascom.cache import DeviceStateCache,CAMERA_TTL,CAMERA_CONFIG
+from queue import Full
+import server.config as c
+
+# Seconds between two ImageReady requests of a video frame
+VIDEO_POLL_MIN = 0.015
+VIDEO_POLL_MAX = 0.1
+
 CameraState = {
     CameraStates.cameraIdle : 0 , 
     CameraStates.cameraExposing : 1 , 
@@ -77,8 +91,12 @@ class AscomCameraAPI(BasicCameraAPI):
     def __init__(self) -> None:
         self.info = BasicCameraInfo()
         self.device = None
+        self.cache = None
         self.info._is_connected = False
         self.info._percent_complete = 0
+        self.sequence = SequenceEngine(self)
+        self.video = VideoCapture()
+        self._video_frame = None
 
     def __del__(self) -> None:
         if self.info._is_connected:
@@ -127,6 +145,7 @@ class AscomCameraAPI(BasicCameraAPI):
         try:
             self.device = Camera(host + ":" + str(port), device_number)
             self.device.Connected = True
+            self.cache = DeviceStateCache(self.device, CAMERA_TTL)
         except DriverException as e:
             logger.error(_(f"Faild to connect to device on {host}:{port}"))
             return return_error(_(f"Failed to connect to device on {host}:{port}"))
@@ -226,10 +245,25 @@ class AscomCameraAPI(BasicCameraAPI):
                     "info" : BasicCameraInfo object
                 }
             }
+            NOTE : Temperature and cooler power are read through the state cache
         """
         if self.device is None or not self.info._is_connected:
             logger.warning(_(f"{error.NotConnected.value} , please do not execute polling command"))
             return return_warning(_(error.NotConnected.value),{})
+        try:
+            if self.info._can_cooling:
+                self.info._temperature = self.cache.get("CCDTemperature")
+            if self.info._can_get_coolpower:
+                self.info._cool_power = self.cache.get("CoolerPower")
+        except NotConnectedException as e:
+            logger.error(_(f"Remote device is not connected,error: {e}"))
+            return return_error(_(error.NotConnected.value),{"error":e})
+        except DriverException as e:
+            logger.error(_(f"Remote driver error, {e}"))
+            return return_error(error.DriverError.value,{"error":e})
+        except ConnectionError as e:
+            logger.error(_(f"Network error while get camera configuration, error : {e}"))
+            return return_error(error.NetworkError.value,{"error":e})
         res = self.info.get_dict()
         logger.debug(_(f"New camera info : {res}"))
         logger.info(success.PollingSuccess.value)
@@ -251,42 +285,44 @@ class AscomCameraAPI(BasicCameraAPI):
             logger.warning(_(f"{error.NotConnected.value}, please do not execute {_getframe().f_code.co_name} command"))
             return return_warning(_(error.NotConnected.value),{})
         try:
-            self.info._name = self.device.Name
+            # Read all of the plain properties at once , the reads below are answered from memory
+            self.cache.prefetch(CAMERA_CONFIG)
+            self.info._name = self.cache.get("Name")
             logger.debug(_(f"Camera name : {self.info._name}"))
             self.info._id = self.device._client_id
             logger.debug(_(f"Camera ID : {self.info._id}"))
-            self.info._description = self.device.Description
+            self.info._description = self.cache.get("Description")
             logger.debug(_(f"Camera description : {self.info._description}"))
             self.info._ipaddress = self.device.address
             logger.debug(_(f"Camera IP address : {self.info._ipaddress}"))
             self.info._api_version = self.device.api_version
             logger.debug(_(f"Camera API version : {self.info._api_version}"))
 
-            self.info._can_binning = self.device.CanAsymmetricBin
+            self.info._can_binning = self.cache.get("CanAsymmetricBin")
             logger.debug(_(f"Can camera set binning mode : {self.info._can_binning}"))
-            self.info._binning = [self.device.BinX, self.device.BinY]
+            self.info._binning = [self.cache.get("BinX"), self.cache.get("BinY")]
             logger.debug(_(f"Camera current binning mode : {self.info._binning}"))
 
-            self.info._can_cooling = self.device.CanSetCCDTemperature
+            self.info._can_cooling = self.cache.get("CanSetCCDTemperature")
             logger.debug(_(f"Can camera set cooling : {self.info._can_cooling}"))
-            self.info._can_get_coolpower = self.device.CanGetCoolerPower
+            self.info._can_get_coolpower = self.cache.get("CanGetCoolerPower")
             logger.debug(_(f"Can camera get cooling power : {self.info._can_get_coolpower}"))
             if self.info._can_cooling:
                 try:
-                    self.info._temperature = self.device.CCDTemperature
+                    self.info._temperature = self.cache.get("CCDTemperature")
                 except InvalidValueException as e:
                     logger.debug(error.CanNotGetTemperature)
             if self.info._can_get_coolpower:
                 try:
-                    self.info._cool_power = self.device.CoolerPower
+                    self.info._cool_power = self.cache.get("CoolerPower")
                 except InvalidValueException as e:
                     logger.debug(error.CanNotGetPower)
             try:
-                self.info._gain = self.device.Gain
+                self.info._gain = self.cache.get("Gain")
                 logger.debug(_(f"Camera current gain : {self.info._gain}"))
-                self.info._max_gain = self.device.GainMax
+                self.info._max_gain = self.cache.get("GainMax")
                 logger.debug(_(f"Camera max gain : {self.info._max_gain}"))
-                self.info._min_gain = self.device.GainMin
+                self.info._min_gain = self.cache.get("GainMin")
                 logger.debug(_(f"Camera min gain : {self.info._min_gain}"))
                 self.info._can_gain = True
                 logger.debug(_(f"Can camera set gain : {self.info._can_gain}"))
@@ -296,18 +332,18 @@ class AscomCameraAPI(BasicCameraAPI):
                 self.info._can_gain = False
                 logger.debug(_(f"Can camera set gain : {self.info._can_gain}"))
             
-            self.info._can_guiding = self.device.CanPulseGuide
+            self.info._can_guiding = self.cache.get("CanPulseGuide")
             logger.debug(_(f"Can camera guiding : {self.info._can_guiding}"))
-            self.info._can_has_shutter = self.device.HasShutter
+            self.info._can_has_shutter = self.cache.get("HasShutter")
             logger.debug(_(f"Can camera has shutter : {self.info._can_has_shutter}"))
             self.info._can_iso = False
             logger.debug(_(f"Can camera set iso : {self.info._can_iso}"))
             try:
-                self.info._offset = self.device.Offset
+                self.info._offset = self.cache.get("Offset")
                 logger.debug(_(f"Camera current offset : {self.info._offset}"))
-                self.info._max_offset = self.device.OffsetMax
+                self.info._max_offset = self.cache.get("OffsetMax")
                 logger.debug(_(f"Camera max offset : {self.info._max_offset}"))
-                self.info._min_offset = self.device.OffsetMin
+                self.info._min_offset = self.cache.get("OffsetMin")
                 logger.debug(_(f"Camera min offset : {self.info._min_offset}"))
                 self.info._can_offset = True
                 logger.debug(_(f"Can camera set offset : {self.info._can_offset}"))
@@ -317,32 +353,32 @@ class AscomCameraAPI(BasicCameraAPI):
                 self.info._can_offset = False
                 logger.debug(_(f"Can camera set offset : {self.info._can_offset}"))
 
-            self.info._is_cooling = self.device.CoolerOn
+            self.info._is_cooling = self.cache.get("CoolerOn")
             logger.debug(_(f"Is camera cooling : {self.info._is_cooling}"))
             self.info._is_exposure = CameraState.get(self.device.CameraState)
             logger.debug(_(f"Is camera exposure : {self.info._is_exposure}"))
             try:
-                self.info._is_guiding = self.device.IsPulseGuiding
+                self.info._is_guiding = self.cache.get("IsPulseGuiding")
                 logger.debug(_(f"Is camera guiding : {self.info._is_guiding}"))
             except NotImplementedException:
                 self.info._is_guiding = False
-            self.info._is_imageready = self.device.ImageReady
+            self.info._is_imageready = self.cache.get("ImageReady")
             logger.debug(_(f"Is camera image ready : {self.info._is_imageready}"))
             self.info._is_video = False
             logger.debug(_(f"Is camera video : {self.info._is_video}"))
 
-            self.info._max_exposure = self.device.ExposureMax
+            self.info._max_exposure = self.cache.get("ExposureMax")
             logger.debug(_(f"Camera max exposure : {self.info._max_exposure}"))
-            self.info._min_exposure = self.device.ExposureMin
+            self.info._min_exposure = self.cache.get("ExposureMin")
             logger.debug(_(f"Camera min exposure : {self.info._min_exposure}"))
-            self.info._min_exposure_increment = self.device.ExposureResolution
+            self.info._min_exposure_increment = self.cache.get("ExposureResolution")
             logger.debug(_(f"Camera min exposure increment : {self.info._min_exposure_increment}"))
-            self.info._max_binning = [self.device.MaxBinX,self.device.MaxBinY]
+            self.info._max_binning = [self.cache.get("MaxBinX"),self.cache.get("MaxBinY")]
             logger.debug(_(f"Camera max binning : {self.info._max_binning}"))
 
-            self.info._height = self.device.CameraYSize
+            self.info._height = self.cache.get("CameraYSize")
             logger.debug(_(f"Camera frame height : {self.info._height}"))
-            self.info._width = self.device.CameraXSize
+            self.info._width = self.cache.get("CameraXSize")
             logger.debug(_(f"Camera frame width : {self.info._width}"))
             self.info._max_height = self.info._height
             self.info._max_width = self.info._width
@@ -350,9 +386,9 @@ class AscomCameraAPI(BasicCameraAPI):
             self.info._min_width = self.info._width
             self.info._depth = self.device.ImageArrayInfo
             try:
-                self.info._bayer_offset_x = self.device.BayerOffsetX
+                self.info._bayer_offset_x = self.cache.get("BayerOffsetX")
                 logger.debug(_(f"Camera bayer offset x : {self.info._bayer_offset_x}"))
-                self.info._bayer_offset_y = self.device.BayerOffsetY
+                self.info._bayer_offset_y = self.cache.get("BayerOffsetY")
                 logger.debug(_(f"Camera bayer offset y : {self.info._bayer_offset_y}"))
                 self.info._bayer_pattern = 0
                 self.info._is_color = True
@@ -361,21 +397,21 @@ class AscomCameraAPI(BasicCameraAPI):
                 self.info._bayer_offset_y = 0
                 self.info._bayer_pattern = ""
                 self.info._is_color = False
-            self.info._pixel_height = self.device.PixelSizeY
+            self.info._pixel_height = self.cache.get("PixelSizeY")
             logger.debug(_(f"Camera pixel height : {self.info._pixel_height}"))
-            self.info._pixel_width = self.device.PixelSizeX
+            self.info._pixel_width = self.cache.get("PixelSizeX")
             logger.debug(_(f"Camera pixel width : {self.info._pixel_width}"))
-            self.info._max_adu = self.device.MaxADU
+            self.info._max_adu = self.cache.get("MaxADU")
             logger.debug(_(f"Camera max ADU : {self.info._max_adu}"))
-            self.info._start_x = self.device.StartX
+            self.info._start_x = self.cache.get("StartX")
             logger.debug(_(f"Camera start x : {self.info._start_x}"))
-            self.info._start_y = self.device.StartY
+            self.info._start_y = self.cache.get("StartY")
             logger.debug(_(f"Camera start y : {self.info._start_y}"))
-            self.info._subframe_x = self.device.NumX
+            self.info._subframe_x = self.cache.get("NumX")
             logger.debug(_(f"Camera subframe x : {self.info._subframe_x}"))
-            self.info._subframe_y = self.device.NumY
+            self.info._subframe_y = self.cache.get("NumY")
             logger.debug(_(f"Camera subframe y : {self.info._subframe_y}"))
-            self.info._sensor_name = self.device.SensorName
+            self.info._sensor_name = self.cache.get("SensorName")
             logger.debug(_(f"Camera sensor name : {self.info._sensor_name}"))
             self.info._sensor_type = Sensor.get(self.device.SensorType)
             logger.debug(_(f"Camera sensor type : {self.info._sensor_type}"))
@@ -444,6 +480,7 @@ class AscomCameraAPI(BasicCameraAPI):
                         "enable" : boolean # enable or disable
                         "filter" : int # id of filter
                     }
+                    "wait" : bool # wait for the end of the exposure , default True
                 }
             }
             Returns : {
@@ -451,7 +488,8 @@ class AscomCameraAPI(BasicCameraAPI):
                 "message" : str,
                 "params" : None
             }
-            NOTE : This function is a blocking function
+            NOTE : This function is a blocking function unless wait is False ,
+                    then get_image_ready() tells when the image can be downloaded
         """
         if self.device is None or not self.info._is_connected:
             logger.warning(_(f"{error.NotConnected.value} , please do not execute {_getframe().f_code.co_name} command"))
@@ -461,10 +499,12 @@ class AscomCameraAPI(BasicCameraAPI):
         offset = params.get("offset")
         binning = params.get("binning")
 
-        is_save = params.get("image").get("is_save")
-        is_dark = params.get("image").get("is_dark")
-        name = params.get("image").get("name")
-        _type = params.get("image").get("type")
+        wait = params.get("wait", True)
+        image = params.get("image") or {}
+        is_save = image.get("is_save")
+        is_dark = image.get("is_dark")
+        name = image.get("name")
+        _type = image.get("type")
         # TODO : there should be well considered
         if params.get("filterwheel") is not None:
             filterwheel = params.get("filterwheel").get("enable")
@@ -520,13 +560,19 @@ class AscomCameraAPI(BasicCameraAPI):
             logger.debug(_("Prepare to create a dark image"))
 
         logger.info(_("Start exposure ..."))
+        started = False
         try:
-            self.device.StartExposure(exposure,is_dark)
+            self.device.StartExposure(exposure,not is_dark)
             self.info._is_exposure = True
+            self.info._last_exposure = exposure
+            if not wait:
+                # The caller polls get_image_ready() , the camera is still exposing
+                started = True
+                logger.info(_("Start exposure successfully"))
+                return return_success(_("Start exposure successfully"),{"exposure" : exposure})
             sleep(0.1)
             if not self.device.ImageReady and self.device.CameraState == CameraStates.cameraExposing:
                 logger.info(_("Start exposure successfully"))
-                self.info._last_exposure = exposure
             else:
                 logger.info(_("Start exposure failed"))
             used_time = 0
@@ -556,7 +602,8 @@ class AscomCameraAPI(BasicCameraAPI):
             logger.error(_(f"{error.NetworkError.value} , error : {e}"))
             return return_error(error.NetworkError.value,{"error":e})
         finally:
-            self.info._is_exposure = False
+            if not started:
+                self.info._is_exposure = False
         
         if is_save is None:
             is_save = True
@@ -573,6 +620,8 @@ class AscomCameraAPI(BasicCameraAPI):
             else:
                 _type = self.info._image_type
 
+        return return_success(_("Finish exposure successfully"),{"exposure" : exposure})
+
     def abort_exposure(self) -> dict:
         """
             Abort exposure operation | 停止曝光
@@ -637,7 +686,7 @@ class AscomCameraAPI(BasicCameraAPI):
             return return_warning(_("Exposure not started"),{})
 
         try:
-            status = CameraState.get(self.device.CameraState)
+            status = CameraState.get(self.cache.get("CameraState"))
         except NotConnectedException as e:
             logger.error(_(f"Remote device is not connected,error: {e}"))
             return return_error(_(error.NotConnected.value),{"error":e})
@@ -651,20 +700,143 @@ class AscomCameraAPI(BasicCameraAPI):
         logger.debug(_(f"Get camera exposure status : {status}"))
         return return_success(_("Get camera exposure status successfully"),{"status":status})
 
-    def get_exposure_result(self) -> dict:
+    def get_image_ready(self, check_state : bool = False) -> dict:
+        """
+            Check if the image of the running exposure is ready | 检查图像是否就绪
+            Args :
+                check_state : bool # also read the camera state to find errors , one more request
+            Returns:{
+                "status" : int,
+                "message" : str
+                "params" : {
+                    "ready" : bool
+                    "state" : int # only if check_state , see CameraState
+                }
+            }
+            NOTE : One request to the camera , cheap enough to be polled
+        """
+        if not self.info._is_connected:
+            return return_error(error.NotConnected.value,{"error": error.NotConnected.value})
+        try:
+            ready = self.device.ImageReady
+            res = {"ready" : ready}
+            if check_state and not ready:
+                res["state"] = CameraState.get(self.device.CameraState)
+        except NotConnectedException as e:
+            logger.error(_(f"Remote device is not connected,error: {e}"))
+            return return_error(_(error.NotConnected.value),{"error":e})
+        except DriverException as e:
+            logger.error(_(f"Remote driver error, {e}"))
+            return return_error(error.DriverError.value,{"error":e})
+        except ConnectionError as e:
+            logger.error(_(f"Network error while get camera configuration, error : {e}"))
+            return return_error(error.NetworkError.value,{"error":e})
+        if ready:
+            self.info._is_exposure = False
+            self.info._is_imageready = True
+        return return_success(_("Get image ready successfully"),res)
+
+    def _fits_header(self, target : str = None, _filter = None, frame_type : str = None) -> dict:
+        """
+            Build the FITS header of the last image
+            Args :
+                target : str # name of the target
+                _filter : str or int # filter name or id
+                frame_type : str # light , dark , flat or offset
+            Returns : dict
+        """
+        hdr = {
+            "EXPOSURE" : self.info._last_exposure,
+            "TIME" : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "BINX" : self.info._binning[0],
+            "BINY" : self.info._binning[1],
+            "INSTRUME" : self.info._sensor_type,
+            "SOFTWARE" : "LightAPT ASCOM Client",
+        }
+        if self.info._can_gain:
+            hdr['GAIN'] = self.info._gain
+        if self.info._can_offset:
+            hdr['OFFSET'] = self.info._offset
+        if self.info._can_iso:
+            hdr['ISO'] = self.info._iso
+        if target:
+            hdr["OBJECT"] = target
+        if _filter is not None:
+            hdr["FILTER"] = _filter
+        if frame_type:
+            hdr["IMAGETYP"] = frame_type
+        return hdr
+
+    def _on_fits_written(self, future) -> None:
+        """
+            Called by the FITS writer thread when a frame is saved
+            Args :
+                future : concurrent.futures.Future
+            Returns : None
+        """
+        if future.exception() is None:
+            logger.debug(_(f"Save image successfully : {future.result()}"))
+
+    def _download_image(self) -> np.ndarray:
+        """
+            Download the last image from the camera | 下载图像
+            Args : None
+            Returns : np.ndarray # (planes,)height,width in the type matching the depth of the camera
+            NOTE : Alpaca exceptions are raised to the caller
+        """
+        # Already a (planes,)height,width numpy view on the downloaded buffer
+        imgdata = self.device.ImageArrayNumpy
+        if self.info._depth not in (16,32,64):
+            img_format = self.device.ImageArrayInfo
+            if img_format.ImageElementType == ImageArrayElementTypes.Int32:
+                if self.info._max_adu <= 65535:
+                    self.info._depth = 16
+                else:
+                    self.info._depth = 32
+            elif img_format.ImageElementType == ImageArrayElementTypes.Double:
+                self.info._depth = 64
+            if img_format.Rank == 2:
+                self.info._imgarray = True
+            else:
+                self.info._imgarray = False
+            logger.debug(_(f"Camera Image Array : {self.info._imgarray}"))
+        img = None
+        if self.info._depth == 16:
+            img = np.uint16
+        elif self.info._depth == 32:
+            img = np.int32
+        else:
+            img = np.float64
+        # No copy if the camera transmits in the same type
+        return imgdata.astype(img, copy=False)
+
+    def get_exposure_result(self, params = {}) -> dict:
         """
             Get exposure result when exposure successful | 曝光成功后获取图像
-            Args: None
+            Args: {
+                "mode" : str # "base64" (default) or "binary"
+                "bins" : int # number of histogram bins , default 256
+                "preview" : bool # register the frame for the /preview urls , default True
+                "save" : bool # save the frame in a FITS file , default True
+                "target" , "filter" , "frame_type" , "index" : template fields of the file name
+                "template" : str # path template , see utils.fitswriter
+            }
             Returns:{
                 "status" : int,
                 "message" : str
                 "params" : {
-                    "image" : Base64 encoded image
-                    "histogram" : List
+                    "image" : Base64 encoded image # only base64 mode
+                    "frame" : bytes # only binary mode , see utils.frame
+                    "header" : dict # only binary mode , header of the frame
+                    "histogram" : List # counts from 0 to the white level
+                    "stats" : dict # min , max , mean , median , mad , sigma , percentiles , white
+                    "stretch" : dict # auto stretch , shadows , midtones and highlights
+                    "preview" : dict # id , levels and urls of the downsampled previews
                     "info" : Image Info
                 }
             }
-            NOTE : Format!
+            NOTE : In binary mode the raw pixels are sent as a binary websocket message
+                    and the JSON response only carries the header pointing to it
         """
         if not self.info._is_connected:
             logger.warning(_(f"Cannot get exposure result, camera is not connected"))
@@ -672,84 +844,64 @@ class AscomCameraAPI(BasicCameraAPI):
         if self.info._is_exposure:
             logger.error(_("Exposure is still in progress, could not get exposure result"))
             return return_error(_("Exposure is still in progress"),{"error": "Exposure is still in progress"})
+        if params is None:
+            params = {}
+        mode = params.get("mode")
+        if mode is None:
+            mode = "base64"
+        if mode not in ["base64","binary"]:
+            logger.error(_(f"Unknown exposure result mode : {mode}"))
+            return return_error(_("Unknown exposure result mode"),{"error":mode})
         try:
-            hist = None
+            analysis = None
             base64_encode_img = None
             info = None
+            header = None
+            frame = None
 
-            imgdata = self.device.ImageArray
-            if self.info._depth is None:
-                img_format = self.device.ImageArrayInfo
-                if img_format.ImageElementType == ImageArrayElementTypes.Int32:
-                    if self.info._max_adu <= 65535:
-                        self.info._depth = 16
-                    else:
-                        self.info._depth = 32
-                elif img_format.ImageElementType == ImageArrayElementTypes.Double:
-                    self.info._depth = 64
-                if img_format.Rank == 2:
-                    self.info._imgarray = True
-                else:
-                    self.info._imgarray = False
-                logger.debug(_(f"Camera Image Array : {self.info._imgarray}"))
-            img = None
-            if self.info._depth == 16:
-                img = np.uint16
-            elif self.info._depth == 32:
-                img = np.int32
-            else:
-                img = np.float64
-            
-            if self.info._imgarray:
-                nda = np.array(imgdata, dtype=img).transpose()
-            else:
-                nda = np.array(imgdata, dtype=img).transpose(2,1,0)
-            # Create a histogram of the image
-            if self.info._depth == 16:
-                hist , bins= np.histogram(nda,bins=[i for i in range(1,256)])
-            elif self.info._depth == 32:
-                hist, bins= np.histogram(nda,bins=[i for i in range(1,65536)])
-            # Create a base64 encoded image
-            bytesio = BytesIO()
-            np.savetxt(bytesio, nda)
-            base64_encode_img = b64encode(bytesio.getvalue())
+            nda = self._download_image()
+            # Histogram , statistics and auto stretch , so the client can render without the full frame
+            white = self.info._max_adu if self.info._depth != 64 else None
+            analysis = analyse_frame(nda, params.get("bins") or 256, white)
+            if params.get("preview", True):
+                # Only registered here , the previews are rendered when the client asks for them
+                analysis["preview"] = preview_store.add(nda, analysis["stretch"], white)
             # Create a image information dict
             info = {
                 "exposure" : self.info._last_exposure
             }
-            if self.info._can_save:
-                logger.debug(_("Start saving image data in fits"))
-                hdr = fits.Header()
-                hdr['COMMENT'] = """FITS (Flexible Image Transport System) format defined in Astronomy and'
-                                    Astrophysics Supplement Series v44/p363, v44/p371, v73/p359, v73/p365.
-                                    Contact the NASA Science Office of Standards and Technology for the
-                                    FITS Definition document""" #100 and other FITS information.'
-                if self.info._depth == 16:
-                    hdr['BZERO'] = 32768.0
-                    hdr['BSCALE'] = 1.0
-                hdr['EXPOSURE'] = self.info._last_exposure
-                hdr['TIME'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                hdr['BINX'] = self.info._binning[0]
-                hdr['BINY'] = self.info._binning[1]
-                hdr['INSTRUME'] = self.info._sensor_type
-
-                if self.info._can_gain:
-                    hdr['GAIN'] = self.info._gain
-                if self.info._can_offset:
-                    hdr['OFFSET'] = self.info._offset
-                if self.info._can_iso:
-                    hdr['ISO'] = self.info._iso
-
-                hdr["SOFTWARE"] = "LightAPT ASCOM Client"
-
-                hdu = fits.PrimaryHDU(nda, header=hdr)
-
-                _path = "Image_" + "001" + ".fits"
+            if mode == "binary":
+                # Send the raw buffer , the client reads it with the header
+                header , frame = pack_frame(nda,
+                    binning = self.info._binning,
+                    exposure = self.info._last_exposure,
+                    depth = self.info._depth)
+                logger.debug(_(f"Packed binary frame : {header}"))
+            else:
+                # Create a base64 encoded image
+                bytesio = BytesIO()
+                np.savetxt(bytesio, nda)
+                base64_encode_img = b64encode(bytesio.getvalue()).decode()
+            if self.info._can_save and params.get("save", True):
+                # Written by the FITS writer threads , the disk never blocks the exposure loop
+                hdr = self._fits_header(params.get("target"), params.get("filter"), params.get("frame_type"))
                 try:
-                    hdu.writeto(_path, overwrite=True)
-                except OSError as e:
-                    logger.error(_(f"Error writing image , error : {e}"))
-                logger.debug(_("Save image successfully"))
+                    future = get_fits_writer(c.config.get("fits")).submit(nda, hdr,
+                        template = params.get("template"),
+                        target = params.get("target"),
+                        filter = params.get("filter"),
+                        frame_type = params.get("frame_type"),
+                        exposure = self.info._last_exposure,
+                        index = params.get("index"),
+                        binning = self.info._binning[0])
+                    future.add_done_callback(self._on_fits_written)
+                    info["save"] = "queued"
+                except Full:
+                    logger.warning(_("FITS writer queue is full , the frame is not saved"))
+                    info["save"] = "dropped"
+                except ValueError as e:
+                    logger.error(_("Invalid FITS file name , error : {}").format(e))
+                    return return_error(_("Invalid FITS file name"),{"error":str(e)})
         except InvalidOperationException as e:
             logger.error(_(f"No image data available , error : {e}"))
             return return_error(_("No image data available"),{"error":e})
@@ -763,7 +915,13 @@ class AscomCameraAPI(BasicCameraAPI):
             logger.error(_(f"Network error while get camera configuration, error : {e}"))
             return return_error(error.NetworkError.value,{"error":e})
         
-        return return_success(_("Save image successfully"),{"image" : base64_encode_img,"histogram" : hist,"info" : info})
+        res = {"info" : info}
+        res.update(analysis)
+        if mode == "binary":
+            res.update({"frame" : frame,"header" : header})
+        else:
+            res["image"] = base64_encode_img
+        return return_success(_("Save image successfully"),res)
         
     def start_sequence_exposure(self, params: dict) -> dict:
         """
@@ -795,15 +953,34 @@ class AscomCameraAPI(BasicCameraAPI):
                             },
                             "guiding" : {
                                 "dither" : bool
-                            }
+                                "every" : int # dither every n light frames , default 1
+                            },
+                            "autofocus" : {
+                                "every" : int # refocus every n light frames
+                                "on_filter_change" : bool
+                                "hfd_increase" : float # refocus if the HFD grew by this percentage
+                            },
+                            "target" : str # name of the target , default the name of the item
                         }
                     ]
                 }
+            Returns : {
+                "status" : int,
+                "message" : str,
+                "params" : {
+                    "status" : dict # see get_sequence_exposure_status()
+                }
+            }
+            NOTE : Return at once , the sequence runs in its own thread.
+                    The next exposure starts as soon as the last image is read from the camera,
+                    saving and analysing it run on worker threads meanwhile.
+                    Filter changes , dithers and autofocus use the actions in self.sequence.hooks
+                    and an item asking for a missing action is refused
         """
         if not self.info._is_connected:
             logger.warning(_(f"Cannot start sequence exposure, camera is not connected"))
             return return_error(error.NotConnected.value,{"error": error.NotConnected.value})
-        if self.info._is_exposure:
+        if self.info._is_exposure or self.sequence.is_running():
             logger.warning(_(f"Sequence exposure is already in progress"))
             return return_error(_("Sequence exposure is already in progress"),{"error": "Sequence exposure is already in progress"})
         
@@ -815,79 +992,37 @@ class AscomCameraAPI(BasicCameraAPI):
         if sequence is None or len(sequence) == 0:
             logger.warning(_(f"sequence must not be empty"))
             return return_error(_("Please provide a reasonable sequence"),{"error":"sequence must not be empty"})
-        
-        try:
-            # execute each sequence
-            for _sequence in sequence:
-                # check parameters provided
-                name = _sequence.get("name")
-                if name is None:
-                    name = "Sequence"
-                mode = _sequence.get("mode")
-                if mode is None:
-                    mode = "light"
-                exposure = _sequence.get("exposure")
-                if exposure is None:
-                    logger.error(error.NoExposureValue)
-                    return return_error(error.NoExposureValue,{"error":error.NoExposureValue})
-                gain = _sequence.get("gain")
-                if gain is None and self.info._can_gain:
-                    logger.error(error.NoGainValue.value)
-                    return return_error(error.NoGainValue.value,{"error":error.NoGainValue.value})
-                offset = _sequence.get("offset")
-                if offset is None and self.info._can_offset:
-                    logger.error(error.NoOffsetValue.value)
-                    return return_error(error.NoOffsetValue.value,{"error":error.NoOffsetValue.value})
-                iso = _sequence.get("iso")
-                if iso is None and self.info._can_iso:
-                    logger.error(error.NoISOValue.value)
-                    return return_error(error.NoISOValue.value,{"error":error.NoISOValue.value})
-                duration = _sequence.get("duration")
-                binning = _sequence.get("binning")
-                if duration is None:
-                    duration = 1
-                repeat = _sequence.get("repeat")
-                if repeat is None:
-                    repeat = 1
-                cooling = _sequence.get("cooling")
-                filterwheel = _sequence.get("filterwheel")
-                if filterwheel:
-                    logger.debug(_("Filter"))
-                if cooling:
-                    logger.debug(_("Cooling"))
-                logger.info(_(f"Start sequence '{name}' exposure"))
-                count = 1
-                for _id in range(repeat):
-                    logger.info(_(f"Start capture no.{count} image"))
-                    r = {
-                        "exposure" : exposure,
-                        "gain" : gain,
-                        "offset" : offset,
-                        "iso" : iso,
-                        "binning" : binning,
-                        "image" : {
-                            "is_save" : True,
-                            "is_dark" : False if mode != "dark" else True,
-                            "name" : name + "_" + str(count) + "_",
-                            "type" : "fits"
-                        }
-                    }
-                    logger.info(_(f"Start No.{_id} image capture"))
-                    res = self.start_exposure(r)
-                    if res.get("status") == 1:
-                        logger.error(_(f"Some error occurred when camera was exposuring , error : {res.get('message')}"))
-                    elif res.get("status") == 2:
-                        logger.warning(_(f"Some warning occurred when camera was exposuring , warning : {res.get('message')}"))
-                    res = self.get_exposure_result()
-                    if res.get("status") == 1:
-                        logger.error(_(f"Some error occurred when getting exposure result, error : {res.get('message')}"))
-                    elif res.get("status") == 2:
-                        logger.warning(_(f"Some warning occurred when getting exposure result, warning : {res.get('message')}"))
-
-                    count += 1
-        except DriverException as e:
-            logger.error(_("Some error occurred while sequence exposure , error : {e}"))
-            return return_error(_("Some error occurred while sequence exposure"),{"error" :e})
+        # Check all of the items before starting , a night should not stop on the third target
+        for _sequence in sequence:
+            if _sequence.get("exposure") is None:
+                logger.error(error.NoExposureValue.value)
+                return return_error(error.NoExposureValue.value,{"error":error.NoExposureValue.value})
+            if _sequence.get("gain") is None and self.info._can_gain:
+                logger.error(error.NoGainValue.value)
+                return return_error(error.NoGainValue.value,{"error":error.NoGainValue.value})
+            if _sequence.get("offset") is None and self.info._can_offset:
+                logger.error(error.NoOffsetValue.value)
+                return return_error(error.NoOffsetValue.value,{"error":error.NoOffsetValue.value})
+            if _sequence.get("iso") is None and self.info._can_iso:
+                logger.error(error.NoISOValue.value)
+                return return_error(error.NoISOValue.value,{"error":error.NoISOValue.value})
+            if (_sequence.get("mode") or "light") not in SEQUENCE_MODES:
+                logger.error(_(f"Unknown sequence mode : {_sequence.get('mode')}"))
+                return return_error(_("Unknown sequence mode"),{"error":_sequence.get("mode")})
+            # A dither or autofocus without its action would be skipped silently
+            autofocus = _sequence.get("autofocus") or {}
+            actions = {
+                "dither" : bool((_sequence.get("guiding") or {}).get("dither")),
+                "autofocus" : any(autofocus.get(k) for k in ("every", "on_filter_change", "hfd_increase")),
+            }
+            for action, needed in actions.items():
+                if needed and action not in self.sequence.hooks:
+                    logger.error(_(f"Sequence item requires {action} , which is not available"))
+                    return return_error(_("Sequence {} is not available").format(action),{"error":action})
+
+        self.sequence.start(sequence, sequence_count)
+        logger.info(_(f"Start sequence exposure , {self.sequence.info.total} frames"))
+        return return_success(_("Start sequence exposure successfully"),{"status" : self.sequence.get_status()})
 
     def abort_sequence_exposure(self) -> dict:
         """
@@ -898,22 +1033,17 @@ class AscomCameraAPI(BasicCameraAPI):
                 "message" : str,
                 "params" : None
             }
-            NOTE : After executing this function , the whole sequence will be reset
+            NOTE : After executing this function , the whole sequence will be reset.
+                    The frames already read from the camera are still saved
         """
         if not self.info._is_connected:
             logger.error(_("Camera is not connected , please do not execute abort sequence exposure command"))
             return return_error(error.NotConnected.value,{"error": error.NotConnected.value})
-        try:
-            res = self.abort_exposure()
-            if res.get("status") == 1:
-                logger.error(_(f"Some error occurred when aborting exposure, error : {res.get('message')}"))
-                return return_error(_("Some error occurred when aborting exposure"),{"error" :res.get('message')})
-            elif res.get("status") == 2:
-                logger.warning(_(f"Some warning occurred when aborting exposure, warning : {res.get('message')}"))
-                return return_error(_("Some warning occurred when aborting exposure"),{"warning" :res.get('message')})
-        except DriverException as e:
-            logger.error(_("Some error occurred while aborting exposure, error : {e}"))
-            return return_error(_("Some error occurred while aborting exposure"),{"error" :e})
+        if not self.sequence.is_running():
+            logger.warning(_("Sequence exposure is not started"))
+            return return_warning(_("Sequence exposure is not started"),{})
+        self.sequence.abort()
+        return return_success(_("Abort sequence exposure successfully"),{"status" : self.sequence.get_status()})
 
     def pause_sequence_exposure(self) -> dict:
         """
@@ -924,7 +1054,13 @@ class AscomCameraAPI(BasicCameraAPI):
                 "message" : str,
                 "params" : None
             }
+            NOTE : The running exposure is finished and saved , the next one is not started
         """
+        if not self.sequence.is_running():
+            logger.warning(_("Sequence exposure is not started"))
+            return return_warning(_("Sequence exposure is not started"),{})
+        self.sequence.pause()
+        return return_success(_("Pause sequence exposure successfully"),{"status" : self.sequence.get_status()})
 
     def continue_sequence_exposure(self) -> dict:
         """
@@ -936,6 +1072,11 @@ class AscomCameraAPI(BasicCameraAPI):
                 "params" : None
             }
         """
+        if not self.sequence.is_running():
+            logger.warning(_("Sequence exposure is not started"))
+            return return_warning(_("Sequence exposure is not started"),{})
+        self.sequence.resume()
+        return return_success(_("Continue sequence exposure successfully"),{"status" : self.sequence.get_status()})
 
     def get_sequence_exposure_status(self) -> dict:
         """
@@ -945,20 +1086,287 @@ class AscomCameraAPI(BasicCameraAPI):
                 "status" : int,
                 "message" : str,
                 "params" : {
-                    "status" : int,
+                    "status" : dict # state , current , total , completed , processed , actions , timing ...
                 }
             }
         """
+        return return_success(_("Get sequence exposure status successfully"),{"status" : self.sequence.get_status()})
 
-    def get_sequence_exposure_result(self) -> dict:
+    def get_sequence_exposure_result(self, params = {}) -> dict:
         """
             Get sequence exposure result | 获取计划拍摄结果
+            Args : {
+                "since" : int # only the frames after this index , default 0
+            }
+            Returns : {
+                "status" : int,
+                "message" : str,
+                "params" : {
+                    "result" : list # index , path , hfd , fwhm , stars , stats , preview ... of each frame
+                }
+            }
+        """
+        since = (params or {}).get("since") or 0
+        return return_success(_("Get sequence exposure result successfully"),{"result" : self.sequence.get_results(since)})
+
+    # #################################################################
+    # Live video , looped short exposures
+    # #################################################################
+
+    def start_video_capture(self, params : dict) -> dict:
+        """
+            Start video capture function | 开始录制视频
+            Args : {
+                "params" : {
+                    "exposure" : float # exposure of each frame , default 0.01
+                    "gain" : int
+                    "offset" : int
+                    "binning" : int
+                    "path" : str # record into a SER file , no recording if None
+                    "ring" : int # frames kept in memory , default 32
+                    "preview_fps" : float # rate of the preview images , default 5
+                    "preview_format" : str # "jpg" or "png"
+                }
+            }
+            Returns : {
+                "status" : int,
+                "message" : str,
+                "params" : {
+                    "status" : dict # see VideoCapture.get_status()
+                }
+            }
+            NOTE : Each frame is a normal exposure downloaded with ImageBytes , the next one is
+                    started as soon as the image is downloaded. Previews are given to
+                    self.video.on_preview
+        """
+        if self.device is None or not self.info._is_connected:
+            logger.warning(_(f"{error.NotConnected.value} , please do not execute {_getframe().f_code.co_name} command"))
+            return return_warning(_(error.NotConnected.value),{})
+        if self.info._is_exposure or self.sequence.is_running() or self.video.is_running():
+            logger.warning(_("Camera is busy , please do not execute start_video_capture command"))
+            return return_warning(_("Camera is busy"),{})
+        exposure = params.get("exposure") or 0.01
+        if not self.info._min_exposure <= exposure <= 10:
+            return return_error(_("A reasonable exposure value is required"),{})
+        self._video_frame = {
+            "exposure" : exposure,
+            "gain" : params.get("gain"),
+            "offset" : params.get("offset"),
+            "binning" : params.get("binning"),
+            "mode" : "light",
+        }
+        settings = dict(params)
+        settings["white"] = self.info._max_adu if self.info._depth != 64 else None
+        settings["instrument"] = self.info._name or ""
+        # Set before the grab thread starts , it clears the flag if the first frame fails
+        self.info._is_video = True
+        try:
+            self.video.start(settings, self)
+        except FileExistsError as e:
+            self.info._is_video = False
+            logger.error(_(f"Video file already exists : {e}"))
+            return return_error(_("Video file already exists"),{"error" : e})
+        except OSError as e:
+            self.info._is_video = False
+            logger.error(_(f"Failed to create video file : {e}"))
+            return return_error(_("Failed to create video file"),{"error" : e})
+        logger.info(_(f"Start video capture , exposure {exposure} seconds"))
+        return return_success(_("Start video capture successfully"),{"status" : self.video.get_status()})
+
+    def abort_video_capture(self) -> dict:
+        """
+            Abort video capture function | 停止录制视频
             Args : None
             Returns : {
                 "status" : int,
                 "message" : str,
                 "params" : {
-                    "result" : dict
+                    "status" : dict
+                }
+            }
+            NOTE : Wait for the running frame and for the recording of the queued frames
+                    A capture stopped by an error is cleaned up too
+        """
+        if not self.video.is_running():
+            self._sync_video_state()
+            logger.warning(_("Video capture is not running"))
+            return return_warning(_("Video capture is not running"),{"status" : self.video.get_status()})
+        self.video.stop()
+        self.info._is_video = False
+        return return_success(_("Abort video capture successfully"),{"status" : self.video.get_status()})
+
+    def get_video_capture_status(self) -> dict:
+        """
+            Get video capture status function | 获取录制视频状态
+            Args : None
+            Returns : {
+                "status" : int,
+                "message" : str,
+                "params" : {
+                    "status" : dict # frames , dropped , recorded , previews , fps , path , state , error
+                }
+            }
+        """
+        self._sync_video_state()
+        return return_success(_("Get video capture status successfully"),{"status" : self.video.get_status()})
+
+    def _sync_video_state(self) -> None:
+        """
+            Clear the video flag if the capture stopped by itself , like after a driver error
+        """
+        if self.info._is_video and not self.video.is_running():
+            self.video.stop()
+            self.info._is_video = False
+
+    def get_video_capture_result(self, params = {}) -> dict:
+        """
+            Get video capture result | 获取视频录制结果
+            Args : {
+                "preview" : bool # register the last frame for the /preview urls , default True
+            }
+            Returns : {
+                "status" : int,
+                "message" : str,
+                "params" : {
+                    "video" : dict # status , path of the SER file and preview of the last frame
                 }
             }
-        """
\ No newline at end of file
+        """
+        self._sync_video_state()
+        return return_success(_("Get video capture result successfully"),
+            {"video" : self.video.get_result((params or {}).get("preview", True))})
+
+    def video_grab(self, abort) -> np.ndarray:
+        """
+            Take one frame of the video , called on the grab thread
+            Args :
+                abort : threading.Event # set when the capture is stopped
+            Returns : np.ndarray or None if aborted
+        """
+        frame = self._video_frame
+        if frame["gain"] is not None or frame["offset"] is not None or frame["binning"]:
+            self.sequence_start(frame)
+            # Only needed once
+            frame.update({"gain" : None, "offset" : None, "binning" : None})
+        else:
+            self.device.StartExposure(frame["exposure"], True)
+            self.info._is_exposure = True
+        if abort.wait(frame["exposure"]):
+            return None
+        # A tenth of the exposure , the readout of a short frame is not worth 500 requests a second
+        poll = min(VIDEO_POLL_MAX, max(VIDEO_POLL_MIN, frame["exposure"] / 10))
+        while not self.device.ImageReady:
+            if abort.wait(poll):
+                return None
+        self.info._is_exposure = False
+        return self._download_image()
+
+    def video_stop(self) -> None:
+        """
+            Stop the running frame of the video
+            Args : None
+            Returns : None
+        """
+        self.info._is_video = False
+        if self.info._is_exposure:
+            self.info._is_exposure = False
+            self.device.AbortExposure()
+
+    # #################################################################
+    # Steps of the sequence engine , see server.basic.sequence
+    # #################################################################
+
+    def sequence_start(self, frame : dict) -> None:
+        """
+            Apply the settings of a frame and start the exposure , do not wait
+            Args :
+                frame : dict # see server.basic.sequence.expand_sequence()
+            Returns : None
+        """
+        if self.info._can_gain and frame["gain"] is not None and frame["gain"] != self.info._gain:
+            self.device.Gain = frame["gain"]
+            self.info._gain = frame["gain"]
+        if self.info._can_offset and frame["offset"] is not None and frame["offset"] != self.info._offset:
+            self.device.Offset = frame["offset"]
+            self.info._offset = frame["offset"]
+        if frame["binning"] and frame["binning"] != self.info._binning[0]:
+            self.device.BinX = frame["binning"]
+            self.device.BinY = frame["binning"]
+            self.info._binning = [frame["binning"], frame["binning"]]
+        self.device.StartExposure(frame["exposure"], frame["mode"] in ("light","flat"))
+        self.info._is_exposure = True
+        self.info._last_exposure = frame["exposure"]
+
+    def sequence_wait(self, frame : dict, abort) -> None:
+        """
+            Wait for the image to be ready
+            Args :
+                frame : dict
+                abort : threading.Event # set when the sequence is aborted
+            Returns : None
+            NOTE : Sleep until the end of the exposure , then poll ImageReady quickly
+        """
+        if abort.wait(max(0, frame["exposure"] - 0.2)):
+            raise SequenceAbort()
+        try:
+            while not self.device.ImageReady:
+                if self.device.CameraState == CameraStates.cameraError:
+                    raise DriverException(0x500, "Some error occurred when camera was exposuring")
+                if abort.wait(0.05):
+                    raise SequenceAbort()
+        except SequenceAbort:
+            # Still exposing , stopped by sequence_abort()
+            raise
+        except Exception:
+            self.info._is_exposure = False
+            raise
+        self.info._is_exposure = False
+
+    def sequence_read(self, frame : dict) -> np.ndarray:
+        """
+            Read the image from the camera
+            Args :
+                frame : dict
+            Returns : np.ndarray
+        """
+        return self._download_image()
+
+    def sequence_process(self, frame : dict, nda : np.ndarray) -> dict:
+        """
+            Save and analyse a frame , called on the worker threads
+            Args :
+                frame : dict
+                nda : np.ndarray
+            Returns : dict # path , hfd , fwhm , stars , stats , stretch , preview
+        """
+        white = self.info._max_adu if self.info._depth != 64 else None
+        res = analyse_frame(nda, white=white)
+        del res["histogram"]
+        res["preview"] = preview_store.add(nda, res["stretch"], white)
+        if frame["mode"] in ("light","flat"):
+            metrics = calc_star_metrics(nda)
+            res.update({"hfd" : metrics["hfd"], "fwhm" : metrics["fwhm"], "stars" : metrics["count"]})
+        if frame["save"] and self.info._can_save:
+            # Blocking is fine here , this is a worker thread and not the exposure loop
+            future = get_fits_writer(c.config.get("fits")).submit(nda,
+                self._fits_header(frame["target"], frame["filter"], frame["mode"]),
+                block = True,
+                target = frame["target"],
+                filter = frame["filter"],
+                frame_type = frame["mode"],
+                exposure = frame["exposure"],
+                index = frame["count"],
+                binning = self.info._binning[0])
+            res["path"] = future.result()
+        return res
+
+    def sequence_abort(self) -> None:
+        """
+            Stop the running exposure of an aborted sequence
+            Args : None
+            Returns : None
+        """
+        if self.info._is_exposure:
+            self.device.AbortExposure()
+            self.info._is_exposure = False
+
@@ -27,6 +27,7 @@ from libs.alpyca.exceptions import (DriverException,
                                         InvalidValueException)
 
 from ...logging import logger,return_error,return_success,return_warning
+from .cache import DeviceStateCache,FILTERWHEEL_TTL,FILTERWHEEL_CONFIG
 
 import gettext
 _ = gettext.gettext
@@ -47,6 +48,7 @@ class AscomFilterwheelAPI(BasicFilterwheelAPI):
         """
         self.info = BasicFilterwheelInfo()
         self.device = None
+        self.cache = None
 
     def __del__(self) -> None:
         """
@@ -86,6 +88,7 @@ class AscomFilterwheelAPI(BasicFilterwheelAPI):
         try:
             self.device = FilterWheel(host + ":" + str(port), device_number)
             self.device.Connected = True
+            self.cache = DeviceStateCache(self.device, FILTERWHEEL_TTL)
         except DriverException as e:
             logger.error(_("Faild to connect to device on {}:{} : {}").format(host,port,e))
             return return_error(_("Failed to connect to device"),{"error" : e})
@@ -173,10 +176,22 @@ class AscomFilterwheelAPI(BasicFilterwheelAPI):
                 message : str,
                 params : 
                     info : BasicFilterwheelInfo object
+            NOTE : The position is read through the state cache , it is -1 while moving
         """
         if self.device is None or not self.info._is_connected:
             logger.warning(_("Filterwheel is not connected, please do not execute polling command"))
             return return_warning(_("Filterwheel is not connected"),{})
+        try:
+            self.info._current_position = self.cache.get("Position")
+        except NotConnectedException as e:
+            logger.error(_("Filterwheel is not connected : {}").format(e))
+            return return_error(_("Remote device is not connected"),{"error":e})
+        except DriverException as e:
+            logger.error(_("Drvier error : {}").format(e))
+            return return_error(_("Drvier error"),{"error":e})
+        except exceptions.ConnectionError as e:
+            logger.error(_("Network error : {}").format(e))
+            return return_error(_("Network error"),{"error":e})
         res = self.info.get_dict()
         logger.debug(_(f"New filterwheel info : {res}"))
         return return_success(_("Filterwheel's information is refreshed"),{"info":res})
@@ -192,22 +207,24 @@ class AscomFilterwheelAPI(BasicFilterwheelAPI):
                     info : BasicFilterwheelInfo object
         """
         try:
-            self.info._name = self.device.Name
+            # Read all of the plain properties at once , the reads below are answered from memory
+            self.cache.prefetch(FILTERWHEEL_CONFIG)
+            self.info._name = self.cache.get("Name")
             logger.debug(_(f"Filterwheel name : {self.info._name}"))
             self.info._id = self.device._client_id
             logger.debug(_(f"Filterwheel ID : {self.info._id}"))
-            self.info._description = self.device.Description
+            self.info._description = self.cache.get("Description")
             logger.debug(_(f"Filterwheel description : {self.info._description}"))
             self.info._ipaddress = self.device.address
             logger.debug(_(f"Filterwheel IP address : {self.info._ipaddress}"))
             self.info._api_version = self.device.api_version
             logger.debug(_(f"Filterwheel API version : {self.info._api_version}"))
 
-            self.info._filter_offset = self.device.FocusOffsets
+            self.info._filter_offset = self.cache.get("FocusOffsets")
             logger.debug(_("Filterwheel Filter Offset : ").format(self.info._filter_offset))
-            self.info._filter_name = self.device.Names
+            self.info._filter_name = self.cache.get("Names")
             logger.debug(_("Filterwheel Filter Name : ").format(self.info._filter))
-            self.info._current_position = self.device.Position
+            self.info._current_position = self.cache.get("Position")
             logger.debug(_("Filterwheel Current Position : ").format(self.info._current_position))
 
         except NotConnectedException as e:
@@ -283,6 +300,7 @@ class AscomFilterwheelAPI(BasicFilterwheelAPI):
 
         try:
             self.device.Position = position
+            self.cache.invalidate("Position")
             self.info._current_position = position
         except InvalidValueException as e:
             logger.error(_("Provided position is not valid : {}").format(e))
@@ -299,7 +317,7 @@ class AscomFilterwheelAPI(BasicFilterwheelAPI):
 
         logger.info(_("Filterwheel slewed to {}").format(self.info._current_position))
 
-        return return_error(_("Filterwheel slewed to target position successfully"),{})
+        return return_success(_("Filterwheel slewed to target position successfully"),{})
 
     def get_filters_list(self) -> dict:
         """
@@ -29,6 +29,7 @@ from libs.alpyca.exceptions import (DriverException,
                                         InvalidOperationException)
 
 from ...logging import logger ,return_error,return_success,return_warning
+from .cache import DeviceStateCache,FOCUSER_TTL,FOCUSER_CONFIG
 
 import gettext
 _ = gettext.gettext
@@ -49,6 +50,7 @@ class AscomFocuserAPI(BasicFocuserAPI):
         """
         self.info = BasicFocuserInfo()
         self.device = None
+        self.cache = None
 
     def __del__(self) -> None:
         """
@@ -88,6 +90,7 @@ class AscomFocuserAPI(BasicFocuserAPI):
         try:
             self.device = Focuser(host + ":" + str(port), device_number)
             self.device.Connected = True
+            self.cache = DeviceStateCache(self.device, FOCUSER_TTL)
         except DriverException as e:
             logger.error(_("Faild to connect to device on {}:{} : {}").format(host,port,e))
             return return_error(_("Failed to connect to device"),{"error" : e})
@@ -175,10 +178,26 @@ class AscomFocuserAPI(BasicFocuserAPI):
                 message : str,
                 params : 
                     info : BasicFocuserInfo object
+            NOTE : Position , movement and temperature are read through the state cache
         """
         if self.device is None or not self.info._is_connected:
             logger.warning(_("Focuser is not connected, please do not execute polling command"))
             return return_warning(_("Focuser is not connected"),{})
+        try:
+            self.info._current_position = self.cache.get("Position")
+            self.info._is_moving = self.cache.get("IsMoving")
+            if self.info._can_temperature:
+                self.info._temperature = self.cache.get("Temperature")
+        except NotConnectedException as e:
+            logger.error(_("Focuser is not connected : {}").format(e))
+            self.info._is_connected = False
+            return return_error(_("Focuser is not connected"),{"error":e})
+        except DriverException as e:
+            logger.error(_("Driver error : {}").format(e))
+            return return_error(_("Driver error"),{"error":e})
+        except exceptions.ConnectionError as e:
+            logger.error(_("Network error: {}").format(e))
+            return return_error(_("Network error"),{"error":e})
         res = self.info.get_dict()
         logger.debug(_(f"New focuser info : {res}"))
         return return_success(_("Focuser's information is refreshed"),{"info":res})
@@ -194,11 +213,13 @@ class AscomFocuserAPI(BasicFocuserAPI):
                     info : BasicFocuserInfo object
         """
         try:
-            self.info._name = self.device.Name
+            # Read all of the plain properties at once , the reads below are answered from memory
+            self.cache.prefetch(FOCUSER_CONFIG)
+            self.info._name = self.cache.get("Name")
             logger.debug(_("Focuser name : {}").format(self.info._name))
             self.info._id = self.device._client_id
             logger.debug(_("Focuser ID : {}").format(self.info._id))
-            self.info._description = self.device.Description
+            self.info._description = self.cache.get("Description")
             logger.debug(_("Focuser description : {}").format(self.info._description))
             self.info._ipaddress = self.device.address
             logger.debug(_("Focuser IP address : {}").format(self.info._ipaddress))
@@ -206,11 +227,11 @@ class AscomFocuserAPI(BasicFocuserAPI):
             logger.debug(_("Focuser API version : {}").format(self.info._api_version))
 
             # Get infomation about the focuser temperature ability
-            self.info._can_temperature = self.device.TempCompAvailable
+            self.info._can_temperature = self.cache.get("TempCompAvailable")
             logger.debug(_(f"Can focuser get temperature: {self.info._can_temperature}"))
             if self.info._can_temperature:
                 try:
-                    self.info._temperature = self.device.Temperature
+                    self.info._temperature = self.cache.get("Temperature")
                     logger.debug(_(f"Focuser current temperature : {self.info._temperature}°C"))
                 except NotImplementedException as e:
                     logger.error(_(f"Failed to get current temperature , error: {e}"))
@@ -220,18 +241,18 @@ class AscomFocuserAPI(BasicFocuserAPI):
 
             # Get the max step the focuser can move to , this is for focuser safety purposes
 
-            self.info._current_position = self.device.Position
+            self.info._current_position = self.cache.get("Position")
             logger.debug(_("Focuser Current Position: {}").format(self.info._current_position))
-            self.info._max_steps = self.device.MaxStep
+            self.info._max_steps = self.cache.get("MaxStep")
             logger.debug(_("Focuser Max Step : {}").format(self.info._max_steps))
-            self.info._max_increment = self.device.MaxIncrement
+            self.info._max_increment = self.cache.get("MaxIncrement")
             logger.debug(_("Focuser Max Increment : {}").format(self.info._max_increment))
 
             # Get the current position of the focuser 
 
-            self.info._current_position = self.device.Position
+            self.info._current_position = self.cache.get("Position")
             logger.debug(_("Current Position : {}").format(self.info._current_position))
-            self.info._step_size = self.device.StepSize
+            self.info._step_size = self.cache.get("StepSize")
             logger.debug(_("Step Size : {}").format(self.info._step_size))
         
         except NotImplementedException as e:
@@ -312,6 +333,7 @@ class AscomFocuserAPI(BasicFocuserAPI):
 
         try:
             self.device.Move(Position=position)
+            self.cache.invalidate("Position","IsMoving")
         except InvalidValueException as e:
             logger.error(_("Invalid position value : {}").format(e))
             return return_error(_("Invalid position value"),{"error":e})
@@ -360,6 +382,7 @@ class AscomFocuserAPI(BasicFocuserAPI):
 
         try:
             self.device.Move(Position=self.info._current_position+step)
+            self.cache.invalidate("Position","IsMoving")
         except InvalidValueException as e:
             logger.error(_("Invalid step value : {}").format(e))
             return return_error(_("Invalid step value"),{"error":e})
@@ -400,8 +423,9 @@ class AscomFocuserAPI(BasicFocuserAPI):
 
         try:
             self.device.Halt()
+            self.cache.invalidate("Position","IsMoving")
             sleep(0.5)
-            if not self.device.IsMoving:
+            if not self.cache.get("IsMoving"):
                 self.info._is_moving = False
         except NotImplementedException as e:
             logger.error(_("Failed to abort focuser : {}").format(e))
@@ -417,7 +441,7 @@ class AscomFocuserAPI(BasicFocuserAPI):
             return return_error(_("Network error"),{"error":e})
             
         logger.info(_("Abort focuser move operation successfully"))
-        return return_success(_("Abort focuser move operation successfully"),{"position" : self.device.Position})
+        return return_success(_("Abort focuser move operation successfully"),{"position" : self.cache.get("Position")})
     
     def get_movement_status(self) -> dict:
         """
@@ -439,8 +463,10 @@ class AscomFocuserAPI(BasicFocuserAPI):
             return return_error(_("Focuser is not moving"),{})
 
         try:
-            status = self.device.IsMoving
-            position = self.device.Position
+            status = self.cache.get("IsMoving")
+            position = self.cache.get("Position")
+            self.info._is_moving = status
+            self.info._current_position = position
         except NotImplementedException as e:
             logger.error(_("Failed to get status of the focuser operation : {}").format(e))
             return return_error(_("Failed to get status of the operation"),{"error":e})
@@ -479,7 +505,7 @@ class AscomFocuserAPI(BasicFocuserAPI):
             return return_error(_("Focuser is not supported to get temperature"))
 
         try:
-            self.info._temperature = self.device.Temperature
+            self.info._temperature = self.cache.get("Temperature")
         except NotImplementedException as e:
             logger.error(_("Focuser is not supported to get temperature : {}").format(e))
             return return_error(_("Focuser is not supported to get temperature"),{"error":e})
@@ -35,10 +35,14 @@ from libs.alpyca.exceptions import (DriverException,
                                         InvalidOperationException)
 
 from server.basic.telescope import BasicTelescopeAPI,BasicTelescopeInfo
+from .cache import DeviceStateCache,TELESCOPE_TTL,TELESCOPE_CONFIG
 
 from utils.i18n import _
 from ...logging import logger,return_error,return_success
 
+# Properties changed by a slew , a park or a home command
+MOTION_PROPERTIES = ("Slewing","Tracking","AtPark","AtHome","RightAscension","Declination","Azimuth","Altitude")
+
 class AscomTelescopeAPI(BasicTelescopeAPI):
     """
         ASCOM Telescope API Interface based on Alpyca.\n
@@ -53,6 +57,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         """
         self.info = BasicTelescopeInfo()
         self.device = None
+        self.cache = None
 
     def __del__(self) -> None:
         """
@@ -98,6 +103,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             self.device = Telescope(_host + ":" + str(_port), _device_number)
             # Make telescope connected
             self.device.Connected = True
+            self.cache = DeviceStateCache(self.device, TELESCOPE_TTL)
         except DriverException as e:
             logger.error(_("Failed to connect to telescope : {}").format(str(e)))
             return return_error(_("Failed to connect telescope"),{"error": str(e)})
@@ -244,16 +250,46 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
                 message : str # message of the disconnection
                 params : dict
                     info : dict # just return self.info.get_dict()
-            NOTE : This function will not refresh the infomation of the telescope , 
-                    because this will cause a huge lag and waste system usage.
+            NOTE : The position and the state are read through the state cache , so polling often
+                    costs at most one request per property and time to live
         """
         if not self.info._is_connected or self.device is None:
             logger.error(_("Telescope is not connected"))
             return return_error(_("Telescope is not connected"),{})
+        try:
+            self.refresh_state()
+        except NotConnectedException as e:
+            logger.error(_("Telescope is not connected : {}").format(str(e)))
+            self.info._is_connected = False
+            return return_error(_("Telescope is not connected"),{"error": str(e)})
+        except DriverException as e:
+            logger.error(_("Telescope driver error : {}").format(str(e)))
+            return return_error(_("Telescope driver error"),{"error": str(e)})
+        except exceptions.ConnectionError as e:
+            logger.error(_("Network error: {}").format(str(e)))
+            return return_error(_("Network error"),{"error": str(e)})
         res = self.info.get_dict()
         logger.debug(_("New telescope information : {}").format(res))
         return return_success(_("Polling teleescope information"),{"info":res})
 
+    def refresh_state(self) -> None:
+        """
+            Refresh the position and the state of the telescope from the state cache
+            Args : None
+            Returns : None
+            NOTE : Alpaca exceptions are raised to the caller
+        """
+        self.info._is_slewing = self.cache.get("Slewing")
+        self.info._is_tracking = self.cache.get("Tracking")
+        if self.info._can_park:
+            self.info._is_parked = self.cache.get("AtPark")
+        self.info.ra = self.cache.get("RightAscension")
+        if self.info._can_dec_axis:
+            self.info.dec = self.cache.get("Declination")
+        if self.info._can_az_alt:
+            self.info.az = self.cache.get("Azimuth")
+            self.info.alt = self.cache.get("Altitude")
+
     def get_configration(self) -> dict:
         """
             Get all of the configurations needed for further processing
@@ -268,13 +304,15 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             return return_error(_("Telescope is not connected"),{})
         logger.info(_("Trying to get telescope configuration"))
         try:
+            # Read all of the plain properties at once , the reads below are answered from memory
+            self.cache.prefetch(TELESCOPE_CONFIG)
             # Basic information , all of the telescopes have these
-            self.info._name = self.device.Name
+            self.info._name = self.cache.get("Name")
             logger.debug(_(f"Telescope name : {self.info._name}"))
             # This client number is just a random number , do not have a specific meaning
             self.info._id = self.device._client_id
             logger.debug(_(f"Telescope ID : {self.info._id}"))
-            self.info._description = self.device.Description
+            self.info._description = self.cache.get("Description")
             logger.debug(_(f"Telescope description : {self.info._description}"))
             self.info._ipaddress = self.device.address
             logger.debug(_(f"Telescope IP address : {self.info._ipaddress}"))
@@ -288,9 +326,9 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             # avoid error command send to the server if it is not available , but a simple
             # check is better solution
             # NOTE : _can_set_track_ra_rate and _can_set_track_dec_rate are moved to below part staying with rates
-            self.info._can_park = self.device.CanPark
+            self.info._can_park = self.cache.get("CanPark")
             logger.debug(_("Telescope Can Park : {}").format(self.info._can_park))
-            self.info._can_set_park_postion = self.device.CanSetPark
+            self.info._can_set_park_postion = self.cache.get("CanSetPark")
             logger.debug(_("Telescope Can Set Parking Position : {}").format(self.info._can_set_park_postion))
 
             # Check if RA axis is available to goto , I don't know whether a single axis telescope can goto
@@ -301,23 +339,23 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             # If not how we to rescue it when error happens
             self.info._can_ahort_goto = True
             logger.debug(_("Telescope Can Abort Slew : {}").format(self.info._can_ahort_goto))
-            self.info._can_track = self.device.CanSetTracking
+            self.info._can_track = self.cache.get("CanSetTracking")
             logger.debug(_("Telescope Can Track : {}").format(self.info._can_track))
-            self.info._can_sync = self.device.CanSync
+            self.info._can_sync = self.cache.get("CanSync")
             logger.debug(_("Telescope Can Sync : {}").format(self.info._can_sync))
             # We are very sure about that our telescopes can slewing fast enough to catch the satelite 
             self.info._can_track_satellite = True
             logger.debug(_("Telescope Can Track Satellite : {}").format(self.info._can_track_satellite))
-            self.info._can_home = self.device.CanFindHome
+            self.info._can_home = self.cache.get("CanFindHome")
             logger.debug(_("Telescope Can Find Home : {}").format(self.info._can_home))
 
             # Check whether we can get the location of the telescope
             # If there is no location available , it will cause NotImplementedException,
             # so we just need to catch the exception and judge whether having location values
             try:
-                self.info.lon = self.device.SiteLongitude
+                self.info.lon = self.cache.get("SiteLongitude")
                 logger.debug(_("Telescope Longitude : {}").format(self.info.lon))
-                self.info.lat = self.device.SiteLatitude
+                self.info.lat = self.cache.get("SiteLatitude")
                 logger.debug(_("Telescope Latitude : {}").format(self.info.lat))
                 self.info._can_get_location = True
             except NotImplementedException as e:
@@ -329,19 +367,20 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             # This time we need to get the current status of the telescope , 
             # For example is the telescope is parked , that means we can not execute other commands,
             # before unparked the telescope . Make sure the telescope is safe
-            self.info._is_parked = self.device.AtPark
+            self.info._is_parked = self.cache.get("AtPark")
             logger.debug(_("Is Telescope At Park Position : {}").format(self.info._is_parked))
-            self.info._is_tracking = self.device.Tracking
+            self.info._is_tracking = self.cache.get("Tracking")
             logger.debug(_("Is Telescope Tracking : {}").format(self.info._is_tracking))
-            self.info._is_slewing = self.device.Slewing
+            self.info._is_slewing = self.cache.get("Slewing")
             logger.debug(_("Is Telescope Slewing : {}").format(self.info._is_slewing))
 
             # Get telescope targeted RA and DEC values
-            self.info.ra = self.device.RightAscension
-            self.info.dec = self.device.Declination
+            self.info.ra = self.cache.get("RightAscension")
+            self.info.dec = self.cache.get("Declination")
             try:
-                self.info.az = self.device.Azimuth
-                self.info.alt = self.device.Altitude
+                self.info.az = self.cache.get("Azimuth")
+                self.info.alt = self.cache.get("Altitude")
+                self.info._can_az_alt = True
             except NotImplementedException as e:
                 logger.warning(_("Telescope do not have az/alt mode enabled"))
                 self.info._can_az_alt = False
@@ -351,22 +390,22 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             # If the telescope can not track , we will not try to get the settings of the tracking
             if self.info._can_track:
                 # Fist we should check if the telescope is enabled to set RA axis tracking rate
-                self.info._can_set_track_ra_rate = self.device.CanSetRightAscensionRate
+                self.info._can_set_track_ra_rate = self.cache.get("CanSetRightAscensionRate")
                 if self.info._can_set_track_ra_rate:
                     try:
                         # Tracking rate of the RightAscenion axis 
-                        self.info.track_ra_rate = self.device.RightAscensionRate
+                        self.info.track_ra_rate = self.cache.get("RightAscensionRate")
                         self.info._can_ra_track = True
                         logger.debug(_("Telescope Right Ascension Rate : {}").format(self.info.track_ra_rate))
                     except NotImplementedException as e:
                         logger.warning(_("Telescope RA axis track mode can not be set"))
                         self.info._can_set_track_ra_rate = False
                 # Just like RA , we need to check first to avoid unexpected errors
-                self.info._can_set_track_dec_rate = self.device.CanSetDeclinationRate
+                self.info._can_set_track_dec_rate = self.cache.get("CanSetDeclinationRate")
                 if self.info._can_set_track_dec_rate:
                     try:
                         # Tracking rate of the Declination axis
-                        self.info.track_dec_rate = self.device.DeclinationRate
+                        self.info.track_dec_rate = self.cache.get("DeclinationRate")
                         self.info._can_dec_track = True
                         logger.debug(_("Telescope Declination Rate : {}").format(self.info.track_dec_rate))
                     except NotImplementedException as e:
@@ -535,7 +574,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         _format_ra = _ra_h  + _ra_m / 60 +  _ra_s / 3600
         _format_dec = _dec_h +  _dec_m /60 + _dec_s / 3600
         # CHeck if the current RA and DEC are the same as target RA and DEC
-        if self.device.RightAscension == _format_ra and self.device.Declination == _format_dec:
+        if self.cache.get("RightAscension") == _format_ra and self.cache.get("Declination") == _format_dec:
             logger.error(_("Telescope is already targeted the right position"))
             return return_error(_("Telescope is already targeted the right position"),{})
 
@@ -543,6 +582,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         try:
             self.device.Tracking = True
             self.device.SlewToCoordinatesAsync(_format_ra,_format_dec)
+            self.cache.invalidate(*MOTION_PROPERTIES)
         except ParkedException as e:
             logger.error(_("Telescope is parked : {}").format(str(e)))
             return return_error(_("Telescope is parked"),{"error": str(e)})
@@ -585,7 +625,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             logger.error(_("Telescope is not connected"))
             return return_error(_("Telescope is not connected"),{})
         # Check if the telescope is truly slewing
-        if not self.device.Slewing:
+        if not self.cache.get("Slewing",0):
             logger.error(_("Telescope is not slewing"))
             return return_error(_("Telescope is not slewing"),{})
         if self.info._is_parked:
@@ -595,6 +635,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         # Trying to abort goto operation
         try:
             self.device.AbortSlew()
+            self.cache.invalidate(*MOTION_PROPERTIES)
         except InvalidOperationException as e:
             logger.error(_("Invalid operation : {}").format(str(e)))
             return return_error(_("Invalid operation"),{"error": str(e)})
@@ -610,7 +651,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             return return_error(_("Network error"),{"error": str(e)})
         
         sleep(0.1)
-        if not self.device.Slewing:
+        if not self.cache.get("Slewing"):
             self.info._is_slewing = False
             logger.info(_("Aborting goto operation successfully"))
         else:
@@ -619,10 +660,10 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         
         # Though I don't think after such a few time the telescope will lose connection , just be careful
         try:
-            current_ra = self.device.RightAscension
+            current_ra = self.cache.get("RightAscension")
             current_dec = None
             if self.info._can_dec_axis:
-                current_dec = self.device.Declination
+                current_dec = self.cache.get("Declination")
         except NotConnectedException as e:
             logger.error(_("Telescope is not connected : {}").format(str(e)))
             self.info._is_connected = False
@@ -653,11 +694,11 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             logger.error(_("Telescope is parked"))
             return return_error(_("Telescope is parked"),{})
         try:
-            status = self.device.Slewing
-            ra = self.device.RightAscension
+            status = self.cache.get("Slewing")
+            ra = self.cache.get("RightAscension")
             dec = None
             if self.info._can_dec_axis:
-                dec = self.device.Declination
+                dec = self.cache.get("Declination")
         except NotImplementedException as e:
             self.info._is_slewing = False
             logger.error(_("Telescope is not support slewing : {}").format(str(e)))
@@ -705,10 +746,10 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             logger.error(_("Telescope is slewing"))
             return return_error(_("Telescope is slewing"),{})
         try:
-            ra = self.device.RightAscension
+            ra = self.cache.get("RightAscension")
             dec = None
             if self.info._can_dec_axis:
-                dec = self.device.Declination
+                dec = self.cache.get("Declination")
         except NotConnectedException as e:
             logger.error(_("Telescope is not connected : {}").format(str(e)))
             self.info._is_connected = False
@@ -748,6 +789,7 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
 
         try:
             self.device.Park()
+            self.cache.invalidate(*MOTION_PROPERTIES)
         except NotImplementedException as e:
             logger.error(_("Telescope does not support park function"))
             return return_error(_("Telescope does not support park function"),{})
@@ -787,12 +829,13 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         if not self.info._is_connected:
             logger.error(_("Telescope is not connected"))
             return return_error(_("Telescope is not connected"),{})
-        if not self.info._is_parked or not self.device.AtPark:
+        if not self.info._is_parked or not self.cache.get("AtPark"):
             logger.error(_("Telescope is not parked"))
             return logger.error(_("Telescope is not parked"))
         
         try:
             self.device.Unpark()
+            self.cache.invalidate(*MOTION_PROPERTIES)
         except NotImplementedException as e:
             logger.error(_("Telescope is not supported to unpark"))
             return return_error(_("Telescope is not supported to unpark"),{"error":str(e)})
@@ -879,9 +922,10 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
             # Here is a Alpyca limitation , we can just let the telescope move to the wanted position
             # Then we can set the position of the park operation
             self.device.SlewToCoordinatesAsync(self.info.park_ra,self.info.park_dec)
+            self.cache.invalidate(*MOTION_PROPERTIES)
             used_time = 0
             while used_time <= self.info.timeout:
-                if not self.device.Slewing:
+                if not self.cache.get("Slewing"):
                     break
                 used_time += 1
                 sleep(1)
@@ -933,16 +977,17 @@ class AscomTelescopeAPI(BasicTelescopeAPI):
         
         try:
             self.device.FindHome()
+            self.cache.invalidate(*MOTION_PROPERTIES)
 
             used_time = 0
             flag = False
             while used_time <= self.info.timeout:
-                if self.device.AtHome:
+                if self.cache.get("AtHome"):
                     flag = True
                     break
-                self.info.ra = self.device.RightAscension
+                self.info.ra = self.cache.get("RightAscension")
                 if self.info._can_dec_axis:
-                    self.info.dec = self.device.Declination
+                    self.info.dec = self.cache.get("Declination")
                 logger.debug(_("In returning home processing , RA : {} , DEC : {}").format(self.info.ra,self.info.dec))
                 sleep(1)
                 used_time += 1
@@ -25,6 +25,8 @@ defines the pyindi client for usage
 import PyIndi
 from .misc import INDI_DEBUG,INDI_LOG_DATA
 from .basic_indi_state_str import strIPState, strISState
+from .indi_property_mirror import IndiPropertyMirror
+from .indi_blob_dispatcher import IndiBlobDispatcher
 from ...logging import logger
 
 class IndiClient(PyIndi.BaseClient):
@@ -32,6 +34,10 @@ class IndiClient(PyIndi.BaseClient):
         super(IndiClient, self).__init__()
         self.logger = logger
         self.logger.info('creating an instance of IndiClient')
+        # blobs are handed to their waiters by (device name, blob property name), see indi_blob_dispatcher.py
+        self.blobs = IndiBlobDispatcher()
+        # snapshot of all properties, updated by the callbacks below. see indi_property_mirror.py
+        self.mirror = IndiPropertyMirror()
 
     def newDevice(self, d):
         self.logger.info("new device " + d.getDeviceName())
@@ -39,18 +45,17 @@ class IndiClient(PyIndi.BaseClient):
     def newProperty(self, p):
         if INDI_DEBUG:
             self.logger.info("new property " + p.getName() + " for device " + p.getDeviceName())
+        self.mirror.update_property(p)
 
     def removeProperty(self, p):
         if INDI_DEBUG:
             self.logger.info("remove property " + p.getName() + " for device " + p.getDeviceName())
+        self.mirror.remove_property(p.getDeviceName(), p.getName())
 
     def newBLOB(self, bp):
-        global blob_event1, blob_event2
-        print("new BLOB ", bp.name)
-        if bp.name == 'CCD1':
-            blob_event1.set()
-        else:
-            blob_event2.set()
+        if not self.blobs.dispatch(bp):
+            if INDI_DEBUG:
+                self.logger.info("new BLOB " + bp.name + " for device " + bp.bvp.device + " , nobody is waiting")
 
     def newSwitch(self, svp):
         if INDI_LOG_DATA:
@@ -58,6 +63,7 @@ class IndiClient(PyIndi.BaseClient):
             for t in svp:
                 this_str += "       " + t.name + "(" + t.label + ")= " + strISState(t.s) + '\n'
             self.logger.info(this_str)
+        self.mirror.update_vector(svp, 'switch')
 
     def newNumber(self, nvp):
         if INDI_LOG_DATA:
@@ -65,14 +71,17 @@ class IndiClient(PyIndi.BaseClient):
             for t in nvp:
                 this_str += "       " + t.name + "(" + t.label + ")= " + str(t.value) + '\n'
             self.logger.info(this_str)
+        self.mirror.update_vector(nvp, 'number')
 
     def newText(self, tvp):
         if INDI_DEBUG:
             self.logger.info("new Text " + tvp.name + " for device " + tvp.device)
+        self.mirror.update_vector(tvp, 'text')
 
     def newLight(self, lvp):
         if INDI_DEBUG:
             self.logger.info("new Light " + lvp.name + " for device " + lvp.device)
+        self.mirror.update_vector(lvp, 'light')
 
     def newMessage(self, d, m):
         if INDI_DEBUG:
@@ -84,4 +93,6 @@ class IndiClient(PyIndi.BaseClient):
     def serverDisconnected(self, code):
         self.logger.info("Server disconnected (exit code = " + str(code) + "," + str(self.getHost()) + ":" + str(
             self.getPort()) + ")")
+        # the properties will be announced again on the next connection
+        self.mirror.clear()
 
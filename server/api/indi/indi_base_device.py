@@ -32,6 +32,17 @@ class IndiBaseDevice:
         else:
             self.this_connection_switch = None
 
+    def get_mirrored_property(self, property_name: str):
+        """
+        read a property of this device from the property mirror of the client, without a PyIndi call.
+        :param property_name: str
+        :return: dict with 'state' and 'elements', see indi_property_mirror.py. None if not mirrored yet
+        """
+        mirror = getattr(self.indi_client, 'mirror', None)
+        if mirror is None or self.this_device is None:
+            return None
+        return mirror.get_property(self.this_device.getDeviceName(), property_name)
+
     def setup_device(self, indi_device: BaseDevice):
         if indi_device is None:
             pass  # show log
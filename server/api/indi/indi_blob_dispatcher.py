@@ -0,0 +1,148 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2023 Gao Le
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+"""
+hands the blobs received on the PyIndi thread to the coroutines waiting for them.
+
+blobs are dispatched by (device name, blob property name), so two cameras (or a main and a guide
+camera) never see each other's frames:
+
+    future = indi_client.blobs.expect('CCD Simulator', 'CCD1')   # before starting the exposure
+    indi_client.sendNewNumber(ccd_exposure)
+    blob = await asyncio.wait_for(future, timeout)               # IndiBlob
+
+the data is copied on the PyIndi thread, the buffer of PyIndi is reused for the next blob.
+a waiter gets the first blob arriving after expect(), a cancelled or timed out waiter is removed.
+a handler (e.g. the video stream) is called on the PyIndi thread for every blob of its property.
+"""
+
+import asyncio
+import threading
+import time
+
+from ...logging import logger
+
+
+class IndiBlob:
+    """
+    one received blob, detached from PyIndi
+    """
+    __slots__ = ('device', 'property', 'name', 'format', 'size', 'data', 'timestamp')
+
+    def __init__(self, device: str, property_name: str, name: str, blob_format: str, data: bytes):
+        self.device = device
+        self.property = property_name
+        self.name = name
+        self.format = blob_format
+        self.size = len(data)
+        self.data = data
+        self.timestamp = time.time()
+
+
+def _resolve(future: asyncio.Future, blob: IndiBlob):
+    if not future.done():
+        future.set_result(blob)
+
+
+class IndiBlobDispatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (device, property) -> list of (loop, future)
+        self._waiters = {}
+        # (device, property) -> callable(bp)
+        self._handlers = {}
+
+    def expect(self, device_name: str, property_name: str, loop=None) -> asyncio.Future:
+        """
+        register a waiter for the next blob of a property, call it before asking the driver for the blob.
+        :param device_name: str
+        :param property_name: str, e.g. 'CCD1'
+        :param loop: loop of the waiting coroutine, the running one if None
+        :return: asyncio.Future, result is an IndiBlob
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        key = (device_name, property_name)
+        with self._lock:
+            self._waiters.setdefault(key, []).append((loop, future))
+        future.add_done_callback(lambda f: self._discard(key, f))
+        return future
+
+    async def wait(self, device_name: str, property_name: str, timeout: float = None) -> IndiBlob:
+        """
+        wait for the next blob of a property, see expect() to register before the blob is requested.
+        :return: IndiBlob
+        :raise: asyncio.TimeoutError
+        """
+        return await asyncio.wait_for(self.expect(device_name, property_name), timeout)
+
+    def _discard(self, key: tuple, future: asyncio.Future):
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if not waiters:
+                return
+            waiters[:] = [w for w in waiters if w[1] is not future]
+            if not waiters:
+                del self._waiters[key]
+
+    def set_handler(self, device_name: str, property_name: str, handler):
+        """
+        :param handler: callable(bp), called on the PyIndi thread for every blob of the property
+        """
+        with self._lock:
+            self._handlers[(device_name, property_name)] = handler
+
+    def remove_handler(self, device_name: str, property_name: str):
+        with self._lock:
+            self._handlers.pop((device_name, property_name), None)
+
+    def dispatch(self, bp) -> bool:
+        """
+        called by IndiClient.newBLOB on the PyIndi thread.
+        :param bp: IBLOB
+        :return: bool, False if nobody was waiting for this blob
+        """
+        key = (bp.bvp.device, bp.bvp.name)
+        with self._lock:
+            handler = self._handlers.get(key)
+            waiters = self._waiters.pop(key, None)
+        if handler is not None:
+            try:
+                handler(bp)
+            except Exception as e:
+                logger.warning(f'indi blob handler of {key} failed: {e}')
+        if not waiters:
+            return handler is not None
+        blob = IndiBlob(key[0], key[1], bp.name, bp.format, bytes(bp.getblobdata()))
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, future, blob)
+            except RuntimeError:
+                # the loop of this waiter is closed
+                pass
+        return True
+
+    def get_waiting(self) -> list:
+        """
+        :return: list of (device, property) with a waiter
+        """
+        with self._lock:
+            return list(self._waiters.keys())
@@ -18,12 +18,14 @@ Boston, MA 02110-1301, USA.
 
 """
 
-import json
 import time
-import datetime
+import queue
 import asyncio
+from io import BytesIO
 from pathlib import Path
 import tornado.ioloop
+import numpy as np
+import astropy.io.fits as pyfits
 
 import PyIndi
 from PyIndi import BaseDevice
@@ -36,13 +38,56 @@ from .indi_switch_operation import turn_on_second_swtich, turn_on_first_swtich,
 from .indi_property_2_json import indi_property_2_json
 from .indi_number_range_validation import check_number_range, indi_number_single_get_value
 
-from .misc import blob_event2, blob_event1
-
 from ...logging import logger
+from utils.image import calc_star_metrics
+from utils.histogram import analyse_frame
+from utils.preview import preview_store
+from utils.fitswriter import get_fits_writer
+from utils.blobfiles import blob_files, stream_file, BLOB_CHUNK_SIZE
+from server.basic.video import VideoCapture
+import server.config as c
 
 GAIN_Keywords = ["CCD_GAIN", "CCD_CONTROLS"]
 
 
+def decode_fits(fits: bytes):
+    """
+    decode the image of a FITS blob once, shared by the measures below.
+    :param fits: FITS file content as received from the CCD1 blob
+    :return: np.ndarray, None if the blob can not be read
+    """
+    try:
+        with pyfits.open(BytesIO(fits)) as hdul:
+            return hdul[0].data
+    except Exception as e:
+        logger.warning(f'device camera, failed to decode fits: {e}')
+        return None
+
+
+def measure_hfr(data) -> float:
+    """
+    :return: median half flux radius in pixels, 0 without stars. used in the file name.
+    """
+    try:
+        return round(calc_star_metrics(data)['hfd'] / 2, 2)
+    except Exception as e:
+        logger.warning(f'device camera, failed to measure stars: {e}')
+        return 0
+
+
+def analyse_preview(data) -> dict:
+    """
+    :return: dict with histogram, stats, stretch and preview (the /preview urls of the frame). empty on error
+    """
+    try:
+        ret = analyse_frame(data)
+        ret['preview'] = preview_store.add(data, ret['stretch'])
+        return ret
+    except Exception as e:
+        logger.warning(f'device camera, failed to analyse frame: {e}')
+        return {}
+
+
 class IndiCameraDevice(IndiBaseDevice):
     def __init__(self, indi_client: IndiClient, indi_device: BaseDevice = None):
         super().__init__(indi_client, indi_device)
@@ -62,6 +107,11 @@ class IndiCameraDevice(IndiBaseDevice):
         self.indi_client.setBLOBMode(PyIndi.B_ALSO, self.this_device.getDeviceName(), "CCD1")
         # important flag
         self.in_exposure = False  # flag for camera is working
+        self.exposure_blob = None  # future of the CCD1 blob of the exposure in progress
+        # live video, fed by the CCD_VIDEO_STREAM blobs
+        self.video = VideoCapture()
+        self.video_frame_shape = None
+        self.video_format_warned = False
 
     def check_camera_params(self):
         """
@@ -178,9 +228,13 @@ class IndiCameraDevice(IndiBaseDevice):
         return ret_json
 
     async def get_real_time_info(self, **kwargs):
-        temperature = self.this_device.getNumber("CCD_TEMPERATURE")
+        temperature = self.get_mirrored_property("CCD_TEMPERATURE")
+        if temperature is not None:
+            value = next(iter(temperature['elements'].values()), None)
+        else:
+            value = self.this_device.getNumber("CCD_TEMPERATURE")[0].value
         return {
-            "temperature": temperature[0].value,
+            "temperature": value,
             "in_exposure": self.in_exposure,
         }
 
@@ -263,12 +317,13 @@ class IndiCameraDevice(IndiBaseDevice):
     count:              int, default by 0, sequence subframe number.
     other automatically generated parameters
     exposure    given directly by parameter
-    HFR         calculated by ??? TBD
+    HFR         median half flux radius of the stars in the frame, see measure_hfr
     guiding_rms phd2 guiding accuracy
     date        the date when this fits file is generated.
     date_time   the date time when this fits file is generated. format %Y-%m-%d-%H-%M
     
-    note: if the file name is already exists, extra _1 will be added.
+    note: the file is written by the shared FITS writer, existing files are never overwritten,
+    _1, _2 ... is added to the name instead.
     
     '{date}/{target_name}_{filter}_{exposure}_{date_time}_{HFR}_{guiding_RMS}_{count}.fits'
     """
@@ -290,19 +345,10 @@ class IndiCameraDevice(IndiBaseDevice):
             guiding_RMS = None
         else:
             guiding_RMS = ''
-        now = datetime.datetime.now()
-        now_str = now.strftime('%Y-%m-%d-%H-%M-%S')
-        date_str = now.strftime('%Y-%m-%d')
-        file_name = self.save_file_name_pattern.format(
+        return dict(
             target_name=target_name, count=count, filter=filter, guiding_RMS=guiding_RMS, HFR=kwargs['HFR'],
-            date=date_str, date_time=now_str, exposure=kwargs['exposure_time']
+            exposure=kwargs['exposure_time']
         )
-        file_path = self.fits_save_path / file_name
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        if file_path.exists():
-            new_file_path = file_path.parent / file_name.replace('.fits', '_1.fits')
-            file_path = new_file_path
-        return file_path
 
     async def start_single_exposure(self, exposure_time: float, *args, **kwargs):
         """
@@ -317,42 +363,100 @@ class IndiCameraDevice(IndiBaseDevice):
 
         ccd_exposure = self.this_device.getNumber("CCD_EXPOSURE")
         ccd_exposure[0].value = exposure_time
-        blob_event1.clear()
+        # waiting for the CCD1 blob of this camera only, registered before the driver can answer
+        self.exposure_blob = self.indi_client.blobs.expect(self.this_device.getDeviceName(), 'CCD1')
         self.indi_client.sendNewNumber(ccd_exposure)
         self.in_exposure = True
         logger.info(f'device camera, start exposure {exposure_time} seconds')
-        ccd_ccd1 = self.this_device.getBLOB('CCD1')
 
         if len(args) >= 1:
             kwargs['count'] = args[0]
         kwargs['exposure_time'] = exposure_time
-        kwargs['ccd1'] = ccd_ccd1
+        kwargs['blob_future'] = self.exposure_blob
         tornado.ioloop.IOLoop.instance().add_callback(self.after_exposure_finish, *args, **kwargs)
 
     async def after_exposure_finish(self, *args, **kwargs):
         try:
-            await asyncio.wait_for(blob_event1.wait(), timeout=kwargs['exposure_time']+2)
+            blob = await asyncio.wait_for(kwargs['blob_future'], timeout=kwargs['exposure_time']+2)
             self.in_exposure = False
             logger.info(f'device camera, ended exposure {kwargs["exposure_time"]} seconds')
-            for blob in kwargs['ccd1']:
-                fits = blob.getblobdata()
-                kwargs['HFR'] = 0  # to detect HFR value
-                to_save_file_path = self.__translate_parameters_formatting(**kwargs)
-                with open(str(to_save_file_path), 'wb') as f:
-                    f.write(fits)
-            kwargs['ws_instance'].write_message(json.dumps({
+            loop = asyncio.get_running_loop()
+            # everything runs on worker threads, the event loop only waits. the image is decoded once,
+            # the stars (needed by the file name) and the preview with the statistics are measured in parallel,
+            # and the blob, already a FITS file, is written as is while the preview is still computed.
+            data = await loop.run_in_executor(None, decode_fits, blob.data)
+            if data is None:
+                hfr, analysis = 0, {}
+            else:
+                preview = loop.run_in_executor(None, analyse_preview, data)
+                hfr = await loop.run_in_executor(None, measure_hfr, data)
+            kwargs['HFR'] = hfr
+            try:
+                written = get_fits_writer(c.config.get('fits')).submit(
+                    blob.data, template=self.save_file_name_pattern, root=str(self.fits_save_path),
+                    **self.__translate_parameters_formatting(**kwargs))
+                written.add_done_callback(
+                    lambda future: loop.call_soon_threadsafe(self.__on_fits_written, future, blob, kwargs['ws_instance']))
+            except queue.Full:
+                logger.error('device camera, fits writer queue is full, frame is not saved')
+            except ValueError as e:
+                logger.error(f'device camera, invalid fits file name, frame is not saved: {e}')
+            if data is not None:
+                analysis = await preview
+            analysis['HFR'] = hfr
+            kwargs['ws_instance'].write_encoded({
                 'type': 'signal',
                 'message': 'Exposure Finished!',
-                'data': None,
-            }))
-        except TimeoutError:
-            blob_event1.clear()
+                'data': analysis,
+            })
+        except asyncio.CancelledError:
+            # aborted, the blob will never come
+            logger.info('device camera, exposure aborted before the blob arrived')
+        except asyncio.TimeoutError:
             self.in_exposure = False
-            kwargs['ws_instance'].write_message(json.dumps({
+            kwargs['ws_instance'].write_encoded({
                 'type': 'signal',
                 'message': 'ERROR! Exposure Time Out Error!',
                 'data': None,
-            }))
+            })
+
+    def __on_fits_written(self, future, blob, ws_instance):
+        """
+        offer the saved frame to the client, with a 'File Saved' signal. called on the event loop.
+        """
+        if future.exception() is not None:
+            logger.error(f'device camera, failed to save fits: {future.exception()}')
+            return
+        logger.info(f'device camera, saved {future.result()}')
+        # downloaded with http at data.url (range requests supported) or with download_fits
+        file_info = blob_files.add(future.result(), blob.format, {'device': blob.device})
+        try:
+            ws_instance.write_encoded({
+                'type': 'signal',
+                'message': 'File Saved',
+                'data': file_info,
+            })
+        except Exception as e:
+            logger.warning(f'device camera, failed to send file info: {e}')
+
+    async def download_fits(self, file_id: str = None, chunk_size: int = BLOB_CHUNK_SIZE, offset: int = 0, **kwargs):
+        """
+        send a saved frame to the websocket as binary chunks, between a 'File Stream' and a 'File Stream End' signal.
+        the same file can be downloaded with http at data.url of 'File Saved', with range requests.
+        :param file_id: data.id of 'File Saved', the last saved frame if not given
+        :param chunk_size: int, bytes of each binary message
+        :param offset: int, resume from this byte
+        :param kwargs: ws_instance
+        :return: None, the signals tell the result
+        """
+        try:
+            blob_file = blob_files.get(file_id) if file_id else blob_files.last()
+        except KeyError:
+            blob_file = None
+        if blob_file is None:
+            raise ValueError('Unknown or expired file!')
+        await stream_file(kwargs['ws_instance'], blob_file, chunk_size, offset)
+        return None
 
     async def abort_exposure(self, **kwargs):
         if not self.in_exposure:
@@ -362,8 +466,152 @@ class IndiCameraDevice(IndiBaseDevice):
             abort_exposure = turn_on_multiple_switch_by_index(abort_exposure, 0)
             self.indi_client.sendNewSwitch(abort_exposure)
             self.in_exposure = False
+            if self.exposure_blob is not None:
+                self.exposure_blob.cancel()
             return 'Exposure aborted!'
 
+    """
+    live video with CCD_VIDEO_STREAM.
+    the driver sends a CCD1 blob for every frame, raw pixels with the '.stream' format
+    (the size is read from CCD_STREAM_FRAME), or a FITS file. the blobs are decoded on the
+    PyIndi thread and fed to the shared video engine, see server.basic.video.
+    """
+    def __read_stream_shape(self):
+        width = height = None
+        stream_frame = self.this_device.getNumber('CCD_STREAM_FRAME')
+        if stream_frame:
+            for one_number in stream_frame:
+                if one_number.name == 'WIDTH':
+                    width = int(one_number.value)
+                elif one_number.name == 'HEIGHT':
+                    height = int(one_number.value)
+        if not width or not height:
+            ccd_frame = self.this_device.getNumber('CCD_FRAME')
+            binning = self.this_device.getNumber('CCD_BINNING') if self.has_binning else None
+            bin_x = int(binning[0].value) if binning else 1
+            bin_y = int(binning[1].value) if binning else 1
+            for one_number in ccd_frame:
+                if one_number.name == 'WIDTH':
+                    width = int(one_number.value) // bin_x
+                elif one_number.name == 'HEIGHT':
+                    height = int(one_number.value) // bin_y
+        return height, width
+
+    def __decode_stream_blob(self, bp):
+        data = bp.getblobdata()
+        if bp.format.endswith('.fits'):
+            with pyfits.open(BytesIO(data)) as hdul:
+                return hdul[0].data
+        if bp.format != '.stream':
+            # compressed streams (.stream_jpg) are not decoded
+            if not self.video_format_warned:
+                logger.warning(f'device camera, video format {bp.format} is not supported, frames are dropped')
+                self.video_format_warned = True
+            return None
+        height, width = self.video_frame_shape
+        # the size of the blob tells 8 / 16 bits and mono / RGB
+        depth = len(data) // (height * width)
+        if depth == 1:
+            return np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+        elif depth == 2:
+            return np.frombuffer(data, dtype='<u2').reshape(height, width)
+        elif depth == 3:
+            return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+        elif depth == 6:
+            return np.frombuffer(data, dtype='<u2').reshape(height, width, 3)
+        raise ValueError(f'video blob of {len(data)} bytes does not match a {width}x{height} frame')
+
+    def __on_stream_blob(self, bp):
+        try:
+            nda = self.__decode_stream_blob(bp)
+        except Exception as e:
+            logger.warning(f'device camera, failed to decode video frame: {e}')
+            nda = None
+        if nda is not None:
+            self.video.feed(nda)
+
+    def __on_video_preview(self, ws_instance, io_loop, data, info):
+        async def push():
+            try:
+                if ws_instance.codec.binary:
+                    # binary encodings carry the image inside the signal
+                    info['frame'] = data
+                # queued with its image, a frame still queued for a slow client is replaced
+                await ws_instance.write_encoded({
+                    'type': 'signal',
+                    'message': 'Video Frame',
+                    'data': info,
+                }, None if ws_instance.codec.binary else [data], key='video_frame', preview=True)
+            except Exception as e:
+                logger.warning(f'device camera, failed to send video frame: {e}')
+            finally:
+                self.video.preview_done()
+        io_loop.add_callback(push)
+
+    async def start_video_capture(self, **kwargs):
+        """
+        start the video stream of the camera.
+        :param kwargs: exposure: float, exposure of each frame, default is the driver setting
+                       path: str, record into a SER file, no recording if not given
+                       ring: int, frames kept in memory
+                       preview_fps: float, rate of the previews pushed to ws_instance
+                       ws_instance: websocket receiving the 'Video Frame' signals, each followed by a binary image
+                                    (inside the signal as data.frame with a binary encoding)
+        :return: str
+        """
+        if self.in_exposure or self.video.is_running():
+            return 'Camera is busy. Cannot start video now!'
+        stream = self.this_device.getSwitch('CCD_VIDEO_STREAM')
+        if not stream:
+            return 'No Video Stream Available'
+        encoder = self.this_device.getSwitch('CCD_STREAM_ENCODER')
+        if encoder:
+            for (index, one_switch) in enumerate(encoder):
+                if one_switch.name == 'RAW':
+                    self.indi_client.sendNewSwitch(turn_on_multiple_switch_by_index(encoder, index))
+                    break
+        if 'exposure' in kwargs.keys():
+            streaming_exposure = self.this_device.getNumber('STREAMING_EXPOSURE')
+            if streaming_exposure:
+                streaming_exposure[0].value = kwargs['exposure']
+                self.indi_client.sendNewNumber(streaming_exposure)
+        self.video_frame_shape = self.__read_stream_shape()
+        self.video_format_warned = False
+        if 'ws_instance' in kwargs.keys():
+            io_loop = tornado.ioloop.IOLoop.current()
+            ws_instance = kwargs['ws_instance']
+            self.video.on_preview = lambda data, info: self.__on_video_preview(ws_instance, io_loop, data, info)
+        else:
+            self.video.on_preview = None
+        try:
+            self.video.start({
+                'path': kwargs.get('path'),
+                'ring': kwargs.get('ring'),
+                'preview_fps': kwargs.get('preview_fps', 5),
+                'instrument': self.this_device.getDeviceName(),
+            })
+        except OSError as e:
+            return f'Failed to create video file: {e}'
+        device_name = self.this_device.getDeviceName()
+        self.indi_client.blobs.set_handler(device_name, 'CCD1', self.__on_stream_blob)
+        self.indi_client.sendNewSwitch(turn_on_first_swtich(stream))
+        logger.info('device camera, start video stream')
+        return 'Video started!'
+
+    async def abort_video_capture(self, **kwargs):
+        if not self.video.is_running():
+            return 'No video in progress!'
+        stream = self.this_device.getSwitch('CCD_VIDEO_STREAM')
+        self.indi_client.sendNewSwitch(turn_on_second_swtich(stream))
+        self.indi_client.blobs.remove_handler(self.this_device.getDeviceName(), 'CCD1')
+        # the queued frames are still recorded, keep the event loop free
+        await asyncio.get_running_loop().run_in_executor(None, self.video.stop)
+        logger.info('device camera, stop video stream')
+        return 'Video stopped!'
+
+    async def get_video_capture_status(self, **kwargs):
+        return self.video.get_status()
+
     async def set_number_parameters(self, param_name: str, param_value, *args, **kwargs):
         if param_name == 'gain':
             gain = self.this_device.getNumber(GAIN_Keywords[self.gain_type])
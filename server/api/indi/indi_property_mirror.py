@@ -0,0 +1,361 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2023 Gao Le
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+"""
+in-memory mirror of all indi properties, kept up to date by the IndiClient callbacks.
+
+the callbacks run on the PyIndi thread, the readers run on the event loop or on device threads,
+so every access holds the lock of the mirror and the readers always get copies.
+
+    mirror.get_value('CCD Simulator', 'CCD_TEMPERATURE', 'CCD_TEMPERATURE_VALUE')
+    mirror.get_property('Telescope Simulator', 'EQUATORIAL_EOD_COORD')
+    {
+        'device': 'Telescope Simulator',
+        'name': 'EQUATORIAL_EOD_COORD',
+        'type': 'number',
+        'state': 'Ok',
+        'version': 1234,         # mirror version of the last change of this property
+        'timestamp': 1697600000.0,
+        'elements': {'RA': 5.5, 'DEC': 22.0},
+    }
+
+every change of a property takes the next mirror version. a callback repeating the same values
+is not a change. subscribers get the changed property (and 'removed': True when a property is
+deleted) on their own event loop through loop.call_soon_threadsafe.
+
+snapshot() reads many properties at once, selected by 'device.property[.element]' patterns, and
+only the ones changed after a version for the incremental refreshes, see its docstring.
+"""
+
+import re
+import asyncio
+import fnmatch
+import threading
+import time
+import itertools
+
+import PyIndi
+from .basic_indi_state_str import json_ISState, json_IPState
+from ...logging import logger
+
+PROPERTY_TYPES = {
+    PyIndi.INDI_NUMBER: 'number',
+    PyIndi.INDI_SWITCH: 'switch',
+    PyIndi.INDI_TEXT: 'text',
+    PyIndi.INDI_LIGHT: 'light',
+}
+
+
+def vector_elements(vector, property_type: str) -> dict:
+    """
+    read the element values of an indi vector property
+    :param vector: INumberVectorProperty, ISwitchVectorProperty, ITextVectorProperty or ILightVectorProperty
+    :param property_type: 'number', 'switch', 'text' or 'light'
+    :return: dict, element name -> value (float, bool, str or light state str)
+    """
+    if property_type == 'number':
+        return {one_.name: one_.value for one_ in vector}
+    if property_type == 'switch':
+        return {one_.name: json_ISState(one_.s) for one_ in vector}
+    if property_type == 'text':
+        return {one_.name: one_.text for one_ in vector}
+    if property_type == 'light':
+        return {one_.name: json_IPState(one_.s) for one_ in vector}
+    return {}
+
+
+class IndiPropertyMirror:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # device name -> property name -> property dict, see the header
+        self._devices = {}
+        # (device, property) -> (version of the removal, element names), for the incremental readers
+        self._removed = {}
+        self._version = 0
+        self._subscribers = {}
+        self._tokens = itertools.count(1)
+
+    @property
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    """
+    updates, called by IndiClient on the PyIndi thread
+    """
+    def update_property(self, indi_property):
+        """
+        add or refresh a property announced by newProperty.
+        :param indi_property: PyIndi.Property
+        :return: None
+        """
+        property_type = PROPERTY_TYPES.get(indi_property.getType())
+        if property_type is None:
+            # blobs are handled by the blob handlers of IndiClient
+            return
+        if property_type == 'number':
+            vector = indi_property.getNumber()
+        elif property_type == 'switch':
+            vector = indi_property.getSwitch()
+        elif property_type == 'text':
+            vector = indi_property.getText()
+        else:
+            vector = indi_property.getLight()
+        if vector is None:
+            return
+        self.update_vector(vector, property_type)
+
+    def update_vector(self, vector, property_type: str):
+        """
+        store the new values of a vector property, from newNumber / newSwitch / newText / newLight.
+        :param vector: vector property, with name, device, s and its elements
+        :param property_type: 'number', 'switch', 'text' or 'light'
+        :return: None
+        """
+        try:
+            device_name = vector.device
+            property_name = vector.name
+            elements = vector_elements(vector, property_type)
+            state = json_IPState(vector.s)
+        except Exception as e:
+            logger.warning(f'indi mirror, failed to read property: {e}')
+            return
+        with self._lock:
+            properties = self._devices.setdefault(device_name, {})
+            old = properties.get(property_name)
+            if old is not None and old['state'] == state and old['elements'] == elements:
+                return
+            self._version += 1
+            new = {
+                'device': device_name,
+                'name': property_name,
+                'type': property_type,
+                'state': state,
+                'version': self._version,
+                'timestamp': time.time(),
+                'elements': elements,
+            }
+            if old is not None:
+                new['changed'] = [name for name, value in elements.items() if old['elements'].get(name) != value]
+            properties[property_name] = new
+            self._removed.pop((device_name, property_name), None)
+            self._notify(new)
+
+    def remove_property(self, device_name: str, property_name: str):
+        """
+        forget a property deleted by the driver, from removeProperty.
+        :param device_name: str
+        :param property_name: str
+        :return: None
+        """
+        with self._lock:
+            properties = self._devices.get(device_name)
+            old = properties.pop(property_name, None) if properties else None
+            if old is None:
+                return
+            if not properties:
+                del self._devices[device_name]
+            self._version += 1
+            self._removed[(device_name, property_name)] = (self._version, tuple(old['elements']))
+            self._notify({
+                'device': device_name,
+                'name': property_name,
+                'version': self._version,
+                'removed': True,
+            })
+
+    def remove_device(self, device_name: str):
+        """
+        forget all properties of a device, e.g. when the indi server is disconnected.
+        :param device_name: str
+        :return: None
+        """
+        with self._lock:
+            names = list(self._devices.get(device_name, {}).keys())
+        for property_name in names:
+            self.remove_property(device_name, property_name)
+
+    def clear(self):
+        with self._lock:
+            device_names = list(self._devices.keys())
+        for device_name in device_names:
+            self.remove_device(device_name)
+
+    """
+    readers, from any thread
+    """
+    def get_property(self, device_name: str, property_name: str):
+        """
+        :return: a copy of the property dict, see the header. None if unknown.
+        """
+        with self._lock:
+            one_property = self._devices.get(device_name, {}).get(property_name)
+            if one_property is None:
+                return None
+            ret = dict(one_property)
+            ret['elements'] = dict(one_property['elements'])
+            return ret
+
+    def get_value(self, device_name: str, property_name: str, element_name: str, default=None):
+        """
+        :return: the value of one element, default if unknown.
+        """
+        with self._lock:
+            one_property = self._devices.get(device_name, {}).get(property_name)
+            if one_property is None:
+                return default
+            return one_property['elements'].get(element_name, default)
+
+    def get_state(self, device_name: str, property_name: str, default=None):
+        """
+        :return: the state str of a property ('Idle', 'Ok', 'Busy', 'Alert'), default if unknown.
+        """
+        with self._lock:
+            one_property = self._devices.get(device_name, {}).get(property_name)
+            return default if one_property is None else one_property['state']
+
+    def get_device(self, device_name: str) -> dict:
+        """
+        :return: dict, property name -> copy of the property dict. empty if the device is unknown.
+        """
+        with self._lock:
+            return {name: dict(p, elements=dict(p['elements']))
+                    for name, p in self._devices.get(device_name, {}).items()}
+
+    def get_device_names(self) -> list:
+        with self._lock:
+            return list(self._devices.keys())
+
+    def property_2_json(self, device_name: str, property_name: str):
+        """
+        same output as indi_property_2_json, read from the mirror.
+        :return: dict, {'name', 'type', element name: value}. None if unknown.
+        """
+        one_property = self.get_property(device_name, property_name)
+        if one_property is None:
+            return None
+        ret_struct = {
+            'name': property_name,
+            'type': one_property['type'],
+        }
+        ret_struct.update(one_property['elements'])
+        return ret_struct
+
+    def snapshot(self, patterns=None, since_version: int = 0) -> dict:
+        """
+        read the selected elements of many properties in one call.
+        :param patterns: list of 'device.property' or 'device.property.element' with shell wildcards,
+                         e.g. ['Telescope Simulator.EQUATORIAL_EOD_COORD', 'CCD*.CCD_TEMPERATURE.*', '*.CONNECTION'].
+                         a '*' also matches the dots, so 'CCD Simulator*' selects the whole device. all if None.
+        :param since_version: only the properties changed after this mirror version, 0 for all.
+                              a version newer than the mirror (e.g. the mirror was created again) gives all.
+        :return: dict
+            {
+                'version': 1250,        # since_version of the next refresh
+                'full': False,          # True if every selected property is returned, not only the changes
+                'devices': {'CCD Simulator': {'CCD_TEMPERATURE': {'state': 'Ok', 'version': 1249,
+                                                                  'elements': {'CCD_TEMPERATURE_VALUE': -10.0}}}},
+                'removed': [['CCD Simulator', 'CCD_COOLER']],   # matching properties deleted after since_version
+            }
+        """
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        # one regex for all the patterns, a property matches as a whole or element by element
+        regex = re.compile('|'.join(fnmatch.translate(one_) for one_ in patterns)) if patterns else None
+        since_version = int(since_version or 0)
+        devices = {}
+        removed = []
+        with self._lock:
+            if since_version > self._version:
+                since_version = 0
+            for device_name, properties in self._devices.items():
+                for property_name, one_property in properties.items():
+                    if one_property['version'] <= since_version:
+                        continue
+                    elements = one_property['elements']
+                    prefix = f'{device_name}.{property_name}'
+                    if regex is not None and not regex.match(prefix):
+                        elements = {name: value for name, value in elements.items()
+                                    if regex.match(f'{prefix}.{name}')}
+                        if not elements:
+                            continue
+                    devices.setdefault(device_name, {})[property_name] = {
+                        'state': one_property['state'],
+                        'version': one_property['version'],
+                        'elements': dict(elements),
+                    }
+            if since_version:
+                for (device_name, property_name), (version, element_names) in self._removed.items():
+                    if version <= since_version:
+                        continue
+                    prefix = f'{device_name}.{property_name}'
+                    # selected as a whole, or by one of the elements it had
+                    if regex is None or regex.match(prefix) or any(
+                            regex.match(f'{prefix}.{name}') for name in element_names):
+                        removed.append([device_name, property_name])
+            return {
+                'version': self._version,
+                'full': since_version == 0,
+                'devices': devices,
+                'removed': removed,
+            }
+
+    """
+    change events
+    """
+    def subscribe(self, callback, loop=None, device_names=None) -> int:
+        """
+        call back on every change of a property.
+        :param callback: callable(event), event is the changed property dict, with 'removed': True if deleted.
+                         called on the loop, never on the PyIndi thread.
+        :param loop: asyncio loop running the callback, the current one if None
+        :param device_names: only the changes of these devices, all if None
+        :return: int, token for unsubscribe
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        token = next(self._tokens)
+        with self._lock:
+            self._subscribers[token] = (callback, loop, set(device_names) if device_names else None)
+        return token
+
+    def unsubscribe(self, token: int):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def _notify(self, event: dict):
+        """
+        hand a change to the subscribers, the lock is held.
+        """
+        for token, (callback, loop, device_names) in list(self._subscribers.items()):
+            if device_names is not None and event['device'] not in device_names:
+                continue
+            if loop.is_closed():
+                del self._subscribers[token]
+                continue
+            # each subscriber gets its own copy, the event may be changed by the callback
+            one_event = dict(event)
+            if 'elements' in event:
+                one_event['elements'] = dict(event['elements'])
+            try:
+                loop.call_soon_threadsafe(callback, one_event)
+            except RuntimeError:
+                # the loop was closed meanwhile
+                del self._subscribers[token]
@@ -129,15 +129,23 @@ class IndiTelescopeDevice(IndiBaseDevice):
 
     async def get_real_time_info(self, *args, **kwargs):
         # return ra, dec, in_moving,
-        equad_eod_coord = self.this_device.getNumber("EQUATORIAL_EOD_COORD")
-        ra = equad_eod_coord[0].value
-        dec = equad_eod_coord[1].value
-        state_d = equad_eod_coord.getState()
-        state = strIPState(state_d)
-        if state_d == PyIndi.IPS_BUSY:
-            is_moving = True
+        equad_eod_coord = self.get_mirrored_property("EQUATORIAL_EOD_COORD")
+        if equad_eod_coord is not None:
+            # a dict lookup, the mirror is kept up to date by the client callbacks
+            ra = equad_eod_coord['elements'].get('RA')
+            dec = equad_eod_coord['elements'].get('DEC')
+            state = equad_eod_coord['state']
+            is_moving = state == 'Busy'
         else:
-            is_moving = False
+            equad_eod_coord = self.this_device.getNumber("EQUATORIAL_EOD_COORD")
+            ra = equad_eod_coord[0].value
+            dec = equad_eod_coord[1].value
+            state_d = equad_eod_coord.getState()
+            state = strIPState(state_d)
+            if state_d == PyIndi.IPS_BUSY:
+                is_moving = True
+            else:
+                is_moving = False
         return {
             'ra': ra,
             'dec': dec,
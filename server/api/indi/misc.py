@@ -18,12 +18,5 @@ Boston, MA 02110-1301, USA.
 
 """
 
-import asyncio
-
 INDI_DEBUG = True
 INDI_LOG_DATA = False
-
-# asyncio events
-
-blob_event1 = asyncio.Event()
-blob_event2 = asyncio.Event()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import traceback
+import asyncio
 from .misc import *
 import sys
 from .indi_telescope import IndiTelescopeDevice
@@ -7,12 +8,77 @@ from .indi_focuser import IndiFocusDevice
 from .indi_filter_wheel import IndiFilterWheelDevice
 from .indi_common_printing import *
 from .indi_device_driver_name2type import get_driver_type_by_driver_name
+from .indi_property_mirror import IndiPropertyMirror
 from ...logging import logger
+import tornado.websocket
 """
 todo, need to check how to call function by string
 """
 
 
+class IndiPropertyInterface:
+    """
+    instructions of the 'indi' device name, answered from the property mirror of the client.
+    the subscribed websockets get a 'Property Changed' signal for every change instead of polling.
+    """
+    def __init__(self, mirror: IndiPropertyMirror):
+        self.mirror = mirror
+
+    async def get_property(self, device_name: str, property_name: str, **kwargs):
+        """
+        :return: same as indi_property_2_json, None if unknown
+        """
+        return self.mirror.property_2_json(device_name, property_name)
+
+    async def get_snapshot(self, patterns=None, since_version: int = 0, **kwargs):
+        """
+        many properties in one message, instead of one get_property per property.
+        :param patterns: list of 'device.property[.element]' with wildcards, all if None
+        :param since_version: version of the previous snapshot, only the changes are returned. 0 for all
+        :return: see IndiPropertyMirror.snapshot
+        """
+        return self.mirror.snapshot(patterns, since_version)
+
+    async def subscribe_properties(self, *device_names, **kwargs):
+        """
+        push the changes of the properties to the websocket.
+        :param device_names: only these devices, all if none is given
+        :param kwargs: ws_instance
+        :return: dict, version of the mirror when subscribed
+        """
+        ws_instance = kwargs['ws_instance']
+        self.drop_subscription(ws_instance)
+        io_loop = asyncio.get_running_loop()
+        ws_instance.indi_subscription = self.mirror.subscribe(
+            lambda event: self.__push(ws_instance, event), io_loop, device_names or None)
+        return {
+            'version': self.mirror.version,
+            'devices': list(device_names) or self.mirror.get_device_names(),
+        }
+
+    async def unsubscribe_properties(self, **kwargs):
+        self.drop_subscription(kwargs['ws_instance'])
+        return None
+
+    def drop_subscription(self, ws_instance):
+        token = getattr(ws_instance, 'indi_subscription', None)
+        if token is not None:
+            self.mirror.unsubscribe(token)
+            ws_instance.indi_subscription = None
+
+    def __push(self, ws_instance, event: dict):
+        try:
+            # a change still queued for a slow client is replaced by the newer one of the same property
+            ws_instance.write_encoded({
+                'type': 'signal',
+                'message': 'Property Changed',
+                'data': event,
+            }, key=('indi', event['device'], event['name']))
+        except tornado.websocket.WebSocketClosedError:
+            self.drop_subscription(ws_instance)
+
+
+
 class PyIndiWebSocketWorker:
     def __init__(self):
         self.logger = logger
@@ -29,6 +95,7 @@ class PyIndiWebSocketWorker:
         self.focuser = None
         self.filter_wheel = None
         self.phd2 = None
+        self.properties = IndiPropertyInterface(self.my_indi_client.mirror)
 
     def do_debug_command(self, commands):
         if commands[0] == 'print':
@@ -64,6 +131,8 @@ class PyIndiWebSocketWorker:
             return self.focuser
         elif device_type == 'filter':
             return self.filter_wheel
+        elif device_type == 'indi':
+            return self.properties
         else:
             return None
 
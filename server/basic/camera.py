@@ -184,6 +184,20 @@ class BasicSequenceInfo(object):
     sequence_count = 0
     sequence = []
 
+    state = "idle" # idle , running , pausing , paused , saving , finished , aborted , error
+    name = "" # name of the current sequence item
+    current = 0 # index of the frame being captured , starts from 1
+    total = 0 # number of frames of the whole sequence
+    completed = 0 # frames read from the camera
+    processed = 0 # frames saved and analysed
+    failed = 0 # frames failed to be saved or analysed
+    filter = None # current filter id
+    error = None
+
+    def __init__(self) -> None:
+        self.actions = {} # number of filter changes , dithers and autofocus runs
+        self.timing = {} # duration of the last step of each kind in seconds
+
     def get_dict(self) -> dict:
         """
             Returns a dictionary containing basic sequence information
@@ -193,6 +207,17 @@ class BasicSequenceInfo(object):
         return {
             "sequence_count" : self.sequence_count,
             "sequence" : self.sequence,
+            "state" : self.state,
+            "name" : self.name,
+            "current" : self.current,
+            "total" : self.total,
+            "completed" : self.completed,
+            "processed" : self.processed,
+            "failed" : self.failed,
+            "filter" : self.filter,
+            "error" : self.error,
+            "actions" : dict(self.actions),
+            "timing" : dict(self.timing),
         }
 
 class BasicCameraAPI(BasicDeviceAPI):
@@ -266,16 +291,19 @@ class BasicCameraAPI(BasicDeviceAPI):
             NOTE : This function should not be called if the camera is not in exposure
         """
 
-    def get_exposure_result(self) -> dict:
+    def get_exposure_result(self, params = {}) -> dict:
         """
             Get exposure result function | 获取曝光结果
-            Args:
-                None
+            Args: {
+                "mode" : str # "base64" or "binary"
+            }
             Returns : {
                 "status" : int,
                 "message" : str,
                 "params" : {
-                    "image" : Base64 Encode Image Data,
+                    "image" : Base64 Encode Image Data, # base64 mode
+                    "frame" : bytes, # binary mode , packed by utils.frame.pack_frame()
+                    "header" : dict, # binary mode
                     "histogram" : List,
                     "info" : dict
                 }
@@ -287,19 +315,18 @@ class BasicCameraAPI(BasicDeviceAPI):
             Start exposure function | 开始计划曝光
             Args : {
                 "params" : {
-                    "exposure" : float # exposure time
-                    "gain" : int # gain
-                    "offset" : int # offset
+                    "sequence_count" : int
+                    "sequence" : list # items with exposure , gain , offset , filterwheel , guiding ...
                 }
             }
             Returns : {
                 "status" : int,
                 "message" : str,
                 "params" : {
-                    "results" : SeqExposureResults
+                    "status" : dict # BasicSequenceInfo.get_dict()
                 }
             }
-            TODO : Args and Returns should be thinked more carefully
+            NOTE : Should return at once and run the sequence with server.basic.sequence.SequenceEngine
         """
 
     def abort_sequence_exposure(self) -> dict:
@@ -344,25 +371,24 @@ class BasicCameraAPI(BasicDeviceAPI):
                 "status" : int,
                 "message" : str,
                 "params" : {
-                    "status" : Exposure Status Object
+                    "status" : dict # BasicSequenceInfo.get_dict()
                 }
             }
         """
 
-    def get_sequence_exposure_result(self) -> dict:
+    def get_sequence_exposure_result(self, params = {}) -> dict:
         """
             Get the sequence exposure result | 获取计划拍摄结果
-            Args : None
+            Args : {
+                "since" : int # only the frames after this index
+            }
             Returns : {
                 "status" : int,
                 "message" : str,
                 "params" : {
-                    "image" : Base64 Encode Image Data List
-                    "histogram" : List,
-                    "info" : dict
+                    "result" : list # path , hfd , stats and preview of each processed frame
                 }
             }
-            NOTE : This function should be thinked carefully
         """
 
     def cooling(self, params : dict) -> dict:
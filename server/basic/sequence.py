@@ -0,0 +1,359 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Pipelined sequence exposure engine
+#
+#   engine thread : [expose N][read N][actions][expose N+1][read N+1] ...
+#   worker threads :                   [save & analyse N]  [save & analyse N+1]
+#
+# Only the steps that need the camera run on the engine thread , the
+# next exposure starts as soon as frame N is read from the camera and
+# the actions between frames (filter change , dither , autofocus) are
+# done. Saving and analysing frame N run meanwhile on the workers.
+#
+# The camera must implement :
+#   sequence_start(frame : dict) -> None # apply the settings and start , do not wait
+#   sequence_wait(frame : dict , abort : threading.Event) -> None # return when the image is ready
+#   sequence_read(frame : dict) -> np.ndarray # read the image from the camera
+#   sequence_process(frame : dict , nda : np.ndarray) -> dict # save and analyse , thread safe
+#   sequence_abort() -> None # stop the running exposure
+#
+# #################################################################
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.i18n import _
+from ..logging import logger
+from .camera import BasicSequenceInfo
+
+# Frame types a sequence item can have
+SEQUENCE_MODES = ("light","dark","flat","offset")
+
+class SequenceAbort(Exception):
+    """
+        Raised inside the engine thread when the sequence is aborted
+    """
+
+def expand_sequence(sequence : list) -> list:
+    """
+        Expand the sequence items into the list of frames to capture | 展开计划拍摄
+        Args :
+            sequence : list # items of start_sequence_exposure()
+        Returns : list # one dict per frame
+    """
+    frames = []
+    for item in sequence:
+        name = item.get("name") or "Sequence"
+        filterwheel = item.get("filterwheel") or {}
+        guiding = item.get("guiding") or {}
+        autofocus = item.get("autofocus") or {}
+        repeat = item.get("repeat") or 1
+        for count in range(1, repeat + 1):
+            frames.append({
+                "index" : len(frames) + 1,
+                "name" : name,
+                "count" : count,
+                "mode" : item.get("mode") or "light",
+                "exposure" : item.get("exposure"),
+                "gain" : item.get("gain"),
+                "offset" : item.get("offset"),
+                "iso" : item.get("iso"),
+                "binning" : item.get("binning"),
+                "duration" : item.get("duration") or 0,
+                "filter" : filterwheel.get("id") if filterwheel.get("enable") else None,
+                "dither" : bool(guiding.get("dither")),
+                "dither_every" : max(1, guiding.get("every") or 1),
+                "autofocus_every" : autofocus.get("every") or 0,
+                "autofocus_on_filter" : bool(autofocus.get("on_filter_change")),
+                "autofocus_hfd" : autofocus.get("hfd_increase") or 0,
+                "save" : (item.get("image") or {}).get("is_save", True),
+                "target" : item.get("target") or name,
+            })
+    return frames
+
+class SequenceEngine(object):
+    """
+        Run a sequence with the camera readout of frame N overlapping the next exposure
+    """
+
+    def __init__(self, camera, workers : int = 2) -> None:
+        """
+            Args :
+                camera : object # see the header of this file
+                workers : int # threads saving and analysing the frames
+        """
+        self.camera = camera
+        self.info = BasicSequenceInfo()
+        self.workers = workers
+        # Actions between frames , each one is a callable returning a status dict like return_success()
+        #   filter(id : int) , dither() , autofocus()
+        self.hooks = {}
+        self._thread = None
+        self._executor = None
+        self._abort = threading.Event()
+        self._resume = threading.Event()
+        self._resume.set()
+        self._lock = threading.Lock()
+        self._results = []
+        self._reference_hfd = None
+
+    # #################################################################
+    # Control
+    # #################################################################
+
+    def is_running(self) -> bool:
+        """
+            Check if the engine thread is alive
+            Args : None
+            Returns : bool
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, sequence : list, sequence_count : int = None) -> None:
+        """
+            Start the sequence in a new thread | 开始计划拍摄
+            Args :
+                sequence : list # items of start_sequence_exposure()
+                sequence_count : int
+            Returns : None
+        """
+        if self.is_running():
+            raise RuntimeError("Sequence is already running")
+        frames = expand_sequence(sequence)
+        self.info = BasicSequenceInfo()
+        self.info.sequence = sequence
+        self.info.sequence_count = sequence_count or len(sequence)
+        self.info.total = len(frames)
+        self.info.state = "running"
+        self._results = []
+        self._reference_hfd = None
+        self._abort.clear()
+        self._resume.set()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Sequence")
+        self._thread = threading.Thread(target=self._run, args=(frames,), name="SequenceEngine", daemon=True)
+        self._thread.start()
+
+    def pause(self) -> None:
+        """
+            Pause after the current frame , the running exposure is not stopped
+            Args : None
+            Returns : None
+        """
+        self._resume.clear()
+        if self.info.state == "running":
+            self.info.state = "pausing"
+
+    def resume(self) -> None:
+        """
+            Continue a paused sequence
+            Args : None
+            Returns : None
+        """
+        if self.info.state in ("pausing","paused"):
+            self.info.state = "running"
+        self._resume.set()
+
+    def abort(self, wait : bool = True) -> None:
+        """
+            Abort the sequence and the running exposure
+            Args :
+                wait : bool # wait for the engine thread to stop
+            Returns : None
+        """
+        self._abort.set()
+        self._resume.set()
+        if wait and self.is_running():
+            self._thread.join()
+
+    def get_status(self) -> dict:
+        """
+            Get the progress of the sequence
+            Args : None
+            Returns : dict # see BasicSequenceInfo.get_dict()
+        """
+        with self._lock:
+            return self.info.get_dict()
+
+    def get_results(self, since : int = 0) -> list:
+        """
+            Get the results of the processed frames
+            Args :
+                since : int # only frames with an index greater than this
+            Returns : list
+        """
+        with self._lock:
+            return [r for r in self._results if r["index"] > since]
+
+    # #################################################################
+    # Engine thread
+    # #################################################################
+
+    def _check(self) -> None:
+        """
+            Wait while paused and stop if aborted
+        """
+        if not self._resume.is_set():
+            self.info.state = "paused"
+            self._resume.wait()
+        if self._abort.is_set():
+            raise SequenceAbort()
+        self.info.state = "running"
+
+    def _hook(self, name : str, *args) -> bool:
+        """
+            Run an action between two frames , failures are logged
+            Returns : bool # False if the action is not available or failed
+        """
+        hook = self.hooks.get(name)
+        if hook is None:
+            logger.warning(_("No {} action available , skipped").format(name))
+            return False
+        logger.info(_("Sequence action : {} {}").format(name, args or ""))
+        start = time.monotonic()
+        try:
+            res = hook(*args)
+        except Exception as e:
+            logger.error(_("Sequence action {} failed : {}").format(name, e))
+            return False
+        if isinstance(res, dict) and res.get("status") == 1:
+            logger.error(_("Sequence action {} failed : {}").format(name, res.get("message")))
+            return False
+        with self._lock:
+            self.info.actions[name] = self.info.actions.get(name, 0) + 1
+            self.info.timing[name] = round(time.monotonic() - start, 3)
+        return True
+
+    def _latest_hfd(self) -> float:
+        """
+            HFD of the last frame already analysed , None if there is none
+        """
+        with self._lock:
+            for res in reversed(self._results):
+                if res.get("hfd"):
+                    return res["hfd"]
+        return None
+
+    def _between_frames(self, frame : dict, previous : dict) -> None:
+        """
+            Filter change , dither and autofocus before a frame
+            NOTE : Raise RuntimeError if the filter can not be changed , the frames would be taken
+                    and named with the wrong filter. A failed dither or autofocus does not stop the sequence
+        """
+        focus = False
+        if frame["filter"] is not None and frame["filter"] != self.info.filter:
+            if not self._hook("filter", frame["filter"]):
+                raise RuntimeError(_("Failed to change the filter to {}").format(frame["filter"]))
+            self.info.filter = frame["filter"]
+            focus = frame["autofocus_on_filter"] and previous is not None
+        if previous is not None and previous["mode"] == "light" and frame["mode"] == "light":
+            if frame["dither"] and self.info.completed % frame["dither_every"] == 0:
+                self._hook("dither")
+            if frame["autofocus_every"] and self.info.completed % frame["autofocus_every"] == 0:
+                focus = True
+            hfd = self._latest_hfd()
+            if frame["autofocus_hfd"] and hfd and self._reference_hfd \
+                    and hfd > self._reference_hfd * (1 + frame["autofocus_hfd"] / 100):
+                logger.info(_("HFD went from {:.2f} to {:.2f} , refocus").format(self._reference_hfd, hfd))
+                focus = True
+        if focus:
+            self._hook("autofocus")
+            # The next analysed frame is the new reference
+            self._reference_hfd = None
+
+    def _run(self, frames : list) -> None:
+        """
+            Engine thread
+        """
+        previous = None
+        last_start = None
+        state = "error"
+        try:
+            for frame in frames:
+                self._check()
+                self._between_frames(frame, previous)
+                # Keep the requested time between the start of two frames
+                if previous is not None and previous["duration"]:
+                    delay = previous["duration"] - (time.monotonic() - last_start)
+                    if delay > 0 and self._abort.wait(delay):
+                        raise SequenceAbort()
+                self._check()
+
+                with self._lock:
+                    self.info.current = frame["index"]
+                    self.info.name = frame["name"]
+                logger.info(_("Sequence '{}' , start frame {}/{}").format(frame["name"], frame["index"], self.info.total))
+                last_start = time.monotonic()
+                self.camera.sequence_start(frame)
+                self.camera.sequence_wait(frame, self._abort)
+                exposed = time.monotonic()
+                nda = self.camera.sequence_read(frame)
+                with self._lock:
+                    self.info.completed += 1
+                    self.info.timing["exposure"] = round(exposed - last_start, 3)
+                    self.info.timing["read"] = round(time.monotonic() - exposed, 3)
+                # Saving and analysing overlap the next exposure
+                self._executor.submit(self._process, frame, nda)
+                previous = frame
+            state = "finished"
+        except SequenceAbort:
+            logger.info(_("Sequence aborted"))
+            try:
+                self.camera.sequence_abort()
+            except Exception as e:
+                logger.warning(_("Failed to abort exposure : {}").format(e))
+            state = "aborted"
+        except Exception as e:
+            logger.error(_("Sequence stopped by an error : {}").format(e))
+            state = "error"
+            self.info.error = str(e)
+        finally:
+            # Frames already read are always saved
+            self.info.state = "saving"
+            self._executor.shutdown(wait=True)
+            self.info.state = state
+            logger.info(_("Sequence {} , {} frames captured , {} processed").format(
+                self.info.state, self.info.completed, self.info.processed))
+
+    def _process(self, frame : dict, nda) -> None:
+        """
+            Worker thread , save and analyse one frame
+        """
+        start = time.monotonic()
+        try:
+            res = self.camera.sequence_process(frame, nda) or {}
+        except Exception as e:
+            logger.error(_("Failed to process frame {} : {}").format(frame["index"], e))
+            res = {"error" : str(e)}
+        res.update({"index" : frame["index"], "name" : frame["name"], "filter" : frame["filter"],
+                    "exposure" : frame["exposure"], "mode" : frame["mode"]})
+        with self._lock:
+            if "error" in res:
+                self.info.failed += 1
+            else:
+                self.info.processed += 1
+            self.info.timing["process"] = round(time.monotonic() - start, 3)
+            if self._reference_hfd is None and res.get("hfd") and frame["mode"] == "light":
+                self._reference_hfd = res["hfd"]
+            self._results.append(res)
+            self._results.sort(key=lambda r : r["index"])
@@ -0,0 +1,403 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Live video / fast loop capture (planetary imaging and focusing)
+#
+#   source : grab thread (ASCOM , looped short exposures)
+#            or feed() from the driver thread (INDI streaming BLOBs)
+#      |
+#      +--> ring buffer of the last N frames , never blocks
+#      |
+#      +--> bounded queue --> worker thread : SER recording
+#                                             throttled preview -> on_preview()
+#
+# A frame is dropped (and counted) when the worker is late and the
+# queue is full , the source is never slowed down. The preview is only
+# rendered when the last one was consumed and at most preview_fps
+# times per second.
+#
+# A pulling camera must implement :
+#   video_grab(abort : threading.Event) -> np.ndarray # one frame
+#   video_stop() -> None # stop the running exposure or the stream
+#
+# #################################################################
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from utils.i18n import _
+from utils.histogram import apply_stretch, calc_stats, calc_stretch, white_level
+from utils.preview import bin_image, encode_image, to_display, preview_store
+from utils.ser import SerWriter
+from ..logging import logger
+
+# Frames kept in the ring buffer
+VIDEO_RING_SIZE = 32
+# Frames waiting for the worker thread
+VIDEO_QUEUE_SIZE = 8
+# Longest side of the preview images
+VIDEO_PREVIEW_SIZE = 640
+VIDEO_PREVIEW_FPS = 5
+# A preview not acknowledged after this many seconds is considered lost
+VIDEO_PREVIEW_TIMEOUT = 2.0
+
+class FrameRing(object):
+    """
+        Ring buffer of the last frames
+        NOTE : Every frame is a new array from the camera , so the ring only keeps references
+    """
+
+    def __init__(self, capacity : int = VIDEO_RING_SIZE) -> None:
+        self._frames = deque(maxlen=max(1, int(capacity)))
+        self._lock = threading.Lock()
+
+    def push(self, index : int, t : float, nda : np.ndarray) -> None:
+        """
+            Add a frame , the oldest one is dropped when full
+            Args :
+                index : int # number of the frame since the start
+                t : float # unix time
+                nda : np.ndarray
+            Returns : None
+        """
+        with self._lock:
+            self._frames.append((index, t, nda))
+
+    def latest(self) -> tuple:
+        """
+            Get the last frame
+            Args : None
+            Returns : tuple # (index , t , nda) or None
+        """
+        with self._lock:
+            return self._frames[-1] if self._frames else None
+
+    def frames(self) -> list:
+        """
+            Get all the frames , oldest first
+            Args : None
+            Returns : list # [(index , t , nda)]
+        """
+        with self._lock:
+            return list(self._frames)
+
+    def fps(self) -> float:
+        """
+            Frame rate measured on the frames of the ring
+            Args : None
+            Returns : float
+        """
+        with self._lock:
+            if len(self._frames) < 2:
+                return 0.
+            elapsed = self._frames[-1][1] - self._frames[0][1]
+            count = len(self._frames) - 1
+        return count / elapsed if elapsed > 0 else 0.
+
+class VideoCapture(object):
+    """
+        Live video engine shared by the ASCOM and INDI cameras
+    """
+
+    def __init__(self, on_preview = None) -> None:
+        """
+            Args :
+                on_preview : callable # on_preview(data : bytes , info : dict) , called on the worker thread,
+                                      # call preview_done() once the preview is sent
+        """
+        self.on_preview = on_preview
+        self.ring = FrameRing()
+        self._queue = None
+        self._abort = threading.Event()
+        self._grabber = None
+        self._worker = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._preview_sent = 0.
+        self._preview_pending = False
+        self._settings = {}
+        self._status = {}
+
+    # #################################################################
+    # Control
+    # #################################################################
+
+    def is_running(self) -> bool:
+        """
+            Check if the capture is running
+            Args : None
+            Returns : bool
+        """
+        return self._worker is not None and self._worker.is_alive()
+
+    def start(self, params : dict, camera = None) -> None:
+        """
+            Start the capture | 开始视频采集
+            Args :
+                params : dict
+                    path : str # record into this SER file , no recording if None
+                    ring : int # frames kept in the ring buffer
+                    preview_fps : float # 0 to disable the preview
+                    preview_format : str # "jpg" or "png"
+                    white : float # white level of the frames
+                camera : object # pulling camera , see the header of this file , None if frames are fed
+            Returns : None
+            NOTE : Raise FileExistsError if the SER file already exists
+        """
+        if self.is_running():
+            raise RuntimeError("Video capture is already running")
+        path = params.get("path")
+        if path:
+            if os.path.exists(path):
+                raise FileExistsError(path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._writer = SerWriter(path, instrument = params.get("instrument") or "")
+        else:
+            self._writer = None
+        self._settings = {
+            "preview_fps" : params.get("preview_fps", VIDEO_PREVIEW_FPS),
+            "preview_format" : params.get("preview_format") or "jpg",
+            "white" : params.get("white"),
+        }
+        self.ring = FrameRing(params.get("ring") or VIDEO_RING_SIZE)
+        self._queue = queue.Queue(maxsize=VIDEO_QUEUE_SIZE)
+        self._abort.clear()
+        self._preview_sent = 0.
+        self._preview_pending = False
+        self._status = {
+            "state" : "running",
+            "frames" : 0,
+            "dropped" : 0,
+            "recorded" : 0,
+            "previews" : 0,
+            "path" : path,
+            "started" : time.time(),
+            "stopped" : None,
+            "error" : None,
+        }
+        self._worker = threading.Thread(target=self._work, name="VideoWorker", daemon=True)
+        self._worker.start()
+        if camera is not None:
+            self._grabber = threading.Thread(target=self._grab, args=(camera,), name="VideoGrabber", daemon=True)
+            self._grabber.start()
+        else:
+            self._grabber = None
+
+    def stop(self, wait : bool = True) -> None:
+        """
+            Stop the capture , the frames already queued are still recorded
+            Args :
+                wait : bool # wait for the threads to finish
+            Returns : None
+        """
+        if self._queue is None:
+            return
+        self._abort.set()
+        if wait and self._grabber is not None and self._grabber is not threading.current_thread():
+            self._grabber.join()
+        if self._grabber is None and self._worker is not None and self._worker.is_alive():
+            # The stop mark may wait for a free place , the worker is still running
+            self._queue.put(None)
+        if wait and self._worker is not None:
+            self._worker.join()
+
+    def get_status(self) -> dict:
+        """
+            Get the counters of the capture
+            Args : None
+            Returns : dict
+                state : str # running , stopped or error
+                frames , dropped , recorded , previews : int
+                fps : float # measured on the ring buffer
+                path : str # SER file
+                elapsed : float
+        """
+        with self._lock:
+            status = dict(self._status)
+        if not status:
+            return {"state" : "idle"}
+        status["fps"] = round(self.ring.fps(), 2)
+        status["elapsed"] = round((status["stopped"] or time.time()) - status["started"], 3)
+        status["queued"] = self._queue.qsize() if self._queue is not None else 0
+        return status
+
+    def preview_done(self) -> None:
+        """
+            Tell that the last preview was sent , the next one can be rendered
+            Args : None
+            Returns : None
+        """
+        self._preview_pending = False
+
+    # #################################################################
+    # Sources
+    # #################################################################
+
+    def feed(self, nda : np.ndarray, t : float = None) -> bool:
+        """
+            Add a new frame , never blocks | 输入一帧
+            Args :
+                nda : np.ndarray # (h,w) , (planes,h,w) or (h,w,3)
+                t : float # unix time of the frame , now if None
+            Returns : bool # False if the frame was not queued for recording and preview
+        """
+        if self._abort.is_set():
+            return False
+        t = time.time() if t is None else t
+        with self._lock:
+            self._status["frames"] += 1
+            index = self._status["frames"]
+        self.ring.push(index, t, nda)
+        try:
+            self._queue.put_nowait((index, t, nda))
+        except queue.Full:
+            with self._lock:
+                self._status["dropped"] += 1
+            return False
+        return True
+
+    def _grab(self, camera) -> None:
+        """
+            Grab thread of a pulling camera
+        """
+        try:
+            while not self._abort.is_set():
+                nda = camera.video_grab(self._abort)
+                if nda is not None:
+                    self.feed(nda)
+        except Exception as e:
+            logger.error(_("Video capture stopped by an error : {}").format(e))
+            with self._lock:
+                self._status["error"] = str(e)
+            self._abort.set()
+        finally:
+            try:
+                camera.video_stop()
+            except Exception as e:
+                logger.warning(_("Failed to stop the camera : {}").format(e))
+            # Stop mark for the worker , it may wait for a free place
+            while self._worker.is_alive():
+                try:
+                    self._queue.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+
+    # #################################################################
+    # Worker thread
+    # #################################################################
+
+    def _work(self) -> None:
+        """
+            Record and preview the queued frames
+        """
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    break
+                index, t, nda = job
+                if self._writer is not None:
+                    self._writer.write(to_display(nda), t)
+                    with self._lock:
+                        self._status["recorded"] += 1
+                if self._preview_due():
+                    self._preview(index, t, nda)
+        except Exception as e:
+            logger.error(_("Video recording stopped by an error : {}").format(e))
+            with self._lock:
+                self._status["error"] = str(e)
+            self._abort.set()
+        finally:
+            if self._writer is not None:
+                try:
+                    self._writer.close()
+                except Exception as e:
+                    logger.error(_("Failed to close video file : {}").format(e))
+            with self._lock:
+                self._status["state"] = "error" if self._status["error"] else "stopped"
+                self._status["stopped"] = time.time()
+            logger.info(_("Video capture {} , {} frames , {} dropped , {} recorded").format(
+                self._status["state"], self._status["frames"], self._status["dropped"], self._status["recorded"]))
+
+    def _preview_due(self) -> bool:
+        """
+            Check the throttling of the preview
+        """
+        fps = self._settings["preview_fps"]
+        if self.on_preview is None or not fps:
+            return False
+        now = time.monotonic()
+        if self._preview_pending and now - self._preview_sent < VIDEO_PREVIEW_TIMEOUT:
+            return False
+        return now - self._preview_sent >= 1. / fps
+
+    def _preview(self, index : int, t : float, nda : np.ndarray) -> None:
+        """
+            Render a small stretched image of a frame and hand it to on_preview
+        """
+        white = white_level(nda, self._settings["white"])
+        img = to_display(nda)
+        factor = max(1, -(-max(img.shape[:2]) // VIDEO_PREVIEW_SIZE))
+        small = bin_image(img, factor)
+        stats = calc_stats(small, white, percentiles=())
+        data, fmt = encode_image(apply_stretch(small, calc_stretch(stats), white), self._settings["preview_format"])
+        self._preview_sent = time.monotonic()
+        self._preview_pending = True
+        with self._lock:
+            self._status["previews"] += 1
+        self.on_preview(data, {
+            "index" : index,
+            "time" : t,
+            "format" : fmt,
+            "width" : img.shape[1],
+            "height" : img.shape[0],
+            "binning" : factor,
+            "median" : stats["median"] / white,
+            "max" : stats["max"] / white,
+            "fps" : round(self.ring.fps(), 2),
+            "dropped" : self._status["dropped"],
+        })
+
+    # #################################################################
+    # Results
+    # #################################################################
+
+    def get_result(self, preview : bool = True) -> dict:
+        """
+            Get the result of the capture | 获取视频采集结果
+            Args :
+                preview : bool # register the last frame for the /preview urls
+            Returns : dict # status , plus the preview info of the last frame
+        """
+        res = self.get_status()
+        latest = self.ring.latest()
+        if latest is not None:
+            res["last_frame"] = latest[0]
+            if preview:
+                res["preview"] = preview_store.add(latest[2], white=self._settings.get("white"))
+        return res
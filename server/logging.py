@@ -43,7 +43,7 @@ logger.addHandler(file_handle)
 # Set logger level | 设置日志级别
 logger.setLevel(logging.INFO)
 
-def return_success(self,info : str , params = {}) -> dict:
+def return_success(info : str , params = {}) -> dict:
     """
         Return success message | 返回信息
         Args :
@@ -57,7 +57,7 @@ def return_success(self,info : str , params = {}) -> dict:
         "params" :  params if params is not None else {}
     }
 
-def return_error(self,info : str,params = {}) -> dict :
+def return_error(info : str,params = {}) -> dict :
     """
         Return error message | 返回错误
         Args:
@@ -71,7 +71,7 @@ def return_error(self,info : str,params = {}) -> dict :
         "params" : params if params is not None else {} 
     }
 
-def return_warning(self,info : str,params = {}) -> dict:
+def return_warning(info : str,params = {}) -> dict:
     """
         Return warning message | 返回警告
         Args:
@@ -18,14 +18,19 @@ Boston, MA 02110-1301, USA.
 
 """
 
+import errno
 import os
-import re
+import time
 import xml.etree.ElementTree as ET
-from subprocess import call, check_output, getoutput
+from subprocess import call, getoutput
 from utils.i18n import _
+from utils.indixml import INDIXMLClient
 
 from ..logging import logger , return_error,return_success,return_warning
 
+# Seconds to wait for the INDI server to open its FIFO , it is started in the background
+FIFO_TIMEOUT = 5.0
+
 class INDIDeviceContainer(object):
     """Device driver container"""
 
@@ -215,6 +220,8 @@ class INDIManager(object):
         self.fifo_path = fifo_path if fifo_path is not None and isinstance(fifo_path , str) else "/tmp/indiFIFO"
 
         self.running_drivers = {}
+        # Connection used for the properties , opened on the first call
+        self.client = INDIXMLClient(self.host, self.port)
 
     def __del__(self) -> None:
         """
@@ -222,6 +229,7 @@ class INDIManager(object):
             Args : None
             Returns : None
         """
+        self.client.close()
 
     def start_server(self) -> None:
         """
@@ -234,8 +242,9 @@ class INDIManager(object):
             self.stop_server()
         # Clear the old fifo pipe and create a new one
         logger.info(_("Deleting fifo pipe at : {}").format(self.fifo_path))
-        call(['rm', '-f', self.fifo_path])
-        call(['mkfifo', self.fifo_path])
+        if os.path.exists(self.fifo_path):
+            os.remove(self.fifo_path)
+        os.mkfifo(self.fifo_path)
         # Just start the server without driver
         cmd = 'indiserver -p {} -m 100 -v -f {} > /tmp/indiserver.log 2>&1 &'.format(self.port, self.fifo_path)
         logger.debug(cmd)
@@ -248,6 +257,7 @@ class INDIManager(object):
             Args : None
             Returns : None
         """
+        self.client.close()
         cmd = "killall indiserver >/dev/null 2>&1"
         res = call(cmd, shell=True)
         if res == 0:
@@ -271,16 +281,14 @@ class INDIManager(object):
             Args : 
                 driver : INDIDeviceContainer object
             Returns : None
+            NOTE : Raise OSError if the server does not read the FIFO , see write_fifo()
         """
         cmd = 'start %s' % driver.binary
 
         if driver.skeleton:
             cmd += ' -s "%s"' % driver.skeleton
 
-        cmd = cmd.replace('"', '\\"')
-        full_cmd = 'echo "%s" > %s' % (cmd, self.fifo_path)
-        logger.debug(full_cmd)
-        call(full_cmd, shell=True)
+        self.write_fifo(cmd)
         logger.info(_("Started driver : {}").format(driver.name))
 
         self.running_drivers[driver.label] = driver
@@ -291,20 +299,43 @@ class INDIManager(object):
             Args : 
                 driver : INDIDeviceContainer object
             Returns : None
+            NOTE : Raise OSError if the server does not read the FIFO , see write_fifo()
         """
         cmd = 'stop %s' % driver.binary
 
         if "@" not in driver.binary:
             cmd += ' -n "%s"' % driver.label
-        cmd = cmd.replace('"', '\\"')
-        full_cmd = 'echo "%s" > %s' % (cmd, self.fifo_path)
-        logger.debug(full_cmd)
-        call(full_cmd, shell=True)
+        self.write_fifo(cmd)
         logger.info(_("Stop running driver : {}").format(driver.label))
 
         del self.running_drivers[driver.label]
 
-    def set_prop(self, dev : str, prop : str, element : str, value : str) -> None:
+    def write_fifo(self, cmd : str, timeout : float = FIFO_TIMEOUT) -> None:
+        """
+            Send a command to the server via FIFO connection
+            Args :
+                cmd : str # like 'start indi_simulator_ccd'
+                timeout : float # seconds to wait for the server to open the FIFO
+            Returns : None
+            NOTE : Raise OSError if the server does not open the FIFO in time
+        """
+        logger.debug(cmd)
+        # The server opens the FIFO a moment after start_server() , wait for it but never forever
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fd = os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        try:
+            os.write(fd, (cmd + "\n").encode())
+        finally:
+            os.close(fd)
+
+    def set_prop(self, dev : str, prop : str, element : str, value : str) -> bool:
         """
             Set a property of a device
             Args : 
@@ -312,31 +343,28 @@ class INDIManager(object):
                 prop : str # name of the property
                 element : str # name of the element
                 value : str # value of the property
-            Returns : None
+            Returns : bool # False if the property is unknown
         """
-        cmd = ['indi_setprop', '%s.%s.%s=%s' % (dev, prop, element, value)]
-        call(cmd)
+        return self.client.set_prop(dev, prop, element, value)
 
-    def get_prop(self, dev : str, prop : str, element : str) -> bytes:
+    def get_prop(self, dev : str, prop : str, element : str) -> str:
         """
             Get a property of a device
             Args : 
                 dev : str # name of the device
                 prop : str # name of the property
                 element : str # name of the element
-            Returns : bytes
+            Returns : str # None if unknown
         """
-        cmd = ['indi_getprop', '%s.%s.%s' % (dev, prop, element)]
-        output = check_output(cmd)
-        return output.split('=')[1].strip()
+        return self.client.get_prop(dev, prop, element)
 
-    def get_state(self, dev : str, prop : str) -> bytes:
+    def get_state(self, dev : str, prop : str) -> str:
         """
             Get a property of a device
             Args : 
                 dev : str # name of the device
                 prop : str # name of the property
-            Returns : bytes
+            Returns : str # Idle , Ok , Busy or Alert , None if unknown
         """
         return self.get_prop(dev, prop, '_STATE')
 
@@ -348,26 +376,14 @@ class INDIManager(object):
         """
         return self.running_drivers
 
-    @staticmethod
-    def get_devices() -> list:
+    def get_devices(self) -> list:
         """
             Get a list of devices
             Args: None
             Returns:
                 list: A list of devices
         """
-        cmd = ['indi_getprop', '*.CONNECTION.CONNECT']
-        try:
-            output = check_output(cmd).decode('utf_8')
-            lines = re.split(r'[\n=]', output)
-            output = {lines[i]: lines[i + 1] for i in range(0, len(lines) - 1, 2)}
-            devices = []
-            for key, val in output.items():
-                device_name = re.match("[^.]*", key)
-                devices.append({"device": device_name.group(), "connected": val == "On"})
-            return devices
-        except Exception as e:
-            logger.error(e)
+        return self.client.get_devices()
 
 import json
 from flask import Flask,render_template,request
@@ -479,7 +495,11 @@ def create_indimanager_html(app : Flask,csrf) -> None:
         indi_server.start_server()
 
         for driver in all_drivers:
-            indi_server.start_driver(driver)
+            try:
+                indi_server.start_driver(driver)
+            except OSError as e:
+                logger.error(_("Failed to start driver {} : {}").format(driver.label, e))
+                return json.dumps({"error" : _("Failed to start driver {}").format(driver.label)})
 
         return ''
 
@@ -533,6 +553,9 @@ def create_indimanager_html(app : Flask,csrf) -> None:
                 except KeyError as e:
                     logger.error(_("No camera found or configuration is missing").format(str(e)))
                     return json.dumps({"error" : _("No camera found or configuration is missing")})
+                except OSError as e:
+                    logger.error(_("Failed to restart camera driver : {}").format(str(e)))
+                    return json.dumps({"error" : _("Failed to restart camera driver")})
                 break
             if case("telescope"):
                 try:
@@ -542,6 +565,9 @@ def create_indimanager_html(app : Flask,csrf) -> None:
                 except KeyError as e:
                     logger.error(_("No telescope found or configuration is missing : {}").format(str(e)))
                     return json.dumps({"error" : _("No telescope found or configuration is missing")})
+                except OSError as e:
+                    logger.error(_("Failed to restart telescope driver : {}").format(str(e)))
+                    return json.dumps({"error" : _("Failed to restart telescope driver")})
                 break
             if case("focuser"):
                 try:
@@ -551,6 +577,9 @@ def create_indimanager_html(app : Flask,csrf) -> None:
                 except KeyError as e:
                     logger.error(_("No focuser found or configuration is missing : {}").format(str(e)))
                     return json.dumps({"error" : _("No focuser found or configuration is missing")})
+                except OSError as e:
+                    logger.error(_("Failed to restart focuser driver : {}").format(str(e)))
+                    return json.dumps({"error" : _("Failed to restart focuser driver")})
                 break
             if case("filterwheel"):
                 try:
@@ -560,6 +589,9 @@ def create_indimanager_html(app : Flask,csrf) -> None:
                 except KeyError as e:
                     logger.error(_("No filterwheel found or configuration is missing : {}").format(str(e)))
                     return json.dumps({"error" : _("No filterwheel found or configuration is missing")})
+                except OSError as e:
+                    logger.error(_("Failed to restart filterwheel driver : {}").format(str(e)))
+                    return json.dumps({"error" : _("Failed to restart filterwheel driver")})
                 break
             logger.error(_("Unknown device type"))
             return json.dumps({"error" : _("Unknown device type")})
@@ -0,0 +1,52 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+import os
+import tornado.web
+
+from utils.blobfiles import blob_files
+
+# #################################################################
+# Download of the saved files
+# #################################################################
+
+class BlobDownloadHandler(tornado.web.StaticFileHandler):
+    """
+        Saved file offered to the clients , see utils.blobfiles
+        GET /blob/<id>
+        NOTE : Range requests , ETag and If-None-Match are handled by StaticFileHandler,
+                the file is sent in chunks and never read whole into memory
+    """
+
+    @classmethod
+    def get_absolute_path(cls, root : str, path : str) -> str:
+        try:
+            return blob_files.get(path).path
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown or expired file")
+
+    def validate_absolute_path(self, root : str, absolute_path : str) -> str:
+        if not os.path.isfile(absolute_path):
+            raise tornado.web.HTTPError(404, "File was removed")
+        return absolute_path
+
+    def set_extra_headers(self, path : str) -> None:
+        self.set_header("Content-Disposition", 'attachment; filename="{}"'.format(os.path.basename(self.absolute_path)))
+        self.set_header("Cache-Control", "private, max-age=3600")
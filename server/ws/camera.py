@@ -19,12 +19,25 @@ Boston, MA 02110-1301, USA.
 """
 
 import asyncio
-import threading
 from time import sleep
 import tornado
+import tornado.ioloop
+import tornado.websocket
 
 from utils.i18n import _
 from ..logging import logger , return_error,return_success,return_warning
+from .executor import DeviceExecutor,DEVICE_CONNECT_TIMEOUT
+from .commands import command,CONNECT_SCHEMA
+
+# Shortest and longest time between two ImageReady requests in seconds
+CAMERA_POLL_MIN = 0.02
+CAMERA_POLL_MAX = 5.0
+# Longest time between two requests once the exposure should be over (readout and download)
+CAMERA_POLL_OVERDUE = 0.5
+# Time allowed for the readout after the end of the exposure
+CAMERA_READOUT_TIMEOUT = 60
+# Time allowed to download and analyse a full frame
+CAMERA_DOWNLOAD_TIMEOUT = 300
 
 class WSCamera(object):
     """
@@ -39,8 +52,15 @@ class WSCamera(object):
         """
         self.device = None
         self.ws = ws
-        self.blob = asyncio.Event()
-        self.thread = None
+        # Every blocking call of the camera runs on this thread
+        self.executor = DeviceExecutor("camera")
+        # Exposure state machine : idle -> exposing -> ready / failed / aborted
+        self.exposure_state = "idle"
+        self.exposure_future = None
+        self.exposure_task = None
+        self.exposure_start = 0
+        self.exposure_time = 0
+        self.io_loop = None
 
     def __del__(self) -> None:
         """
@@ -57,6 +77,7 @@ class WSCamera(object):
         """
         return self.__class__.__name__
 
+    @command(CONNECT_SCHEMA)
     async def connect(self , params : dict) -> None:
         """
             Async connect to the camera 
@@ -70,15 +91,11 @@ class WSCamera(object):
         """
         if self.device is not None:
             logger.info(_("Disconnecting from existing camera ..."))
-            self.disconnect()
+            await self.disconnect()
 
+        # type and device_name are checked by the schema
         _type = params.get('type')
-        _device_name = params.get('device_name')
 
-        if _type is None or _device_name is None:
-            logger.error(_("Type or device name must be specified"))
-            return (_("Type or device name must be specified"))
-        
         if _type == "indi":
             """from server.api.indi.camera import INDICameraAPI
             self.device = INDICameraAPI()"""
@@ -89,8 +106,9 @@ class WSCamera(object):
             logger.error(_("Unknown device type : {}").format(_type))
             return (_("Unknown device type"))
 
-        return self.device.connect(params=params)
+        return await self.executor.call(self.device.connect, params, timeout=DEVICE_CONNECT_TIMEOUT)
 
+    @command()
     async def disconnect(self,params = {}) -> dict:
         """
             Async disconnect from the device
@@ -101,8 +119,9 @@ class WSCamera(object):
             logger.warning(_("Camera is not connected , please do not execute disconnect command"))
             return (_("Camera is not connected"))
         
-        return self.device.disconnect()
+        return await self._call(self.device.disconnect)
 
+    @command()
     async def reconnect(self,params : dict) -> dict:
         """
             Async reconnect to the device
@@ -114,8 +133,9 @@ class WSCamera(object):
             logger.warning(_("Camera is not connected , please do not execute reconnect command"))
             return (_("Camera is not connected"))
 
-        return self.device.reconnect()
+        return await self._call(self.device.reconnect)
 
+    @command()
     async def scanning(self,params = {}) -> dict:
         """
             Async scanning all of the devices available
@@ -126,53 +146,159 @@ class WSCamera(object):
             logger.warning(_("Camera had already been connected , please do not execute scanning command"))
             return (_("Camera has already been connected"))
 
-        return self.device.scanning()
+        return await self._call(self.device.scanning)
 
+    @command()
     async def polling(self,params = {}) -> dict:
         """
             Async polling method to get the newest camera information
             Args : None
             Returns : dict
         """
-        if self.device is not None or self.device.info._is_connected:
+        if self.device is None or not self.device.info._is_connected:
             logger.warning(_("Camera is not connected , please do not execute polling command"))
             return (_("Camera is not connected"))
 
-        return self.device.polling()
+        return await self._call(self.device.polling)
+
+    # #################################################################
+    # Exposure state machine
+    # #################################################################
+
+    async def _call(self, func, *args, timeout : float = -1) -> dict:
+        """
+            Run a blocking device method on the camera thread
+            Args :
+                func : callable
+                timeout : float # see DeviceExecutor.call()
+            Returns : dict
+        """
+        return await self.executor.call(func, *args, timeout=timeout)
 
+    async def push(self, event : str, res : dict, key = None, preview : bool = False) -> None:
+        """
+            Push an event to the client without any request
+            Args :
+                event : str # like "exposure_finished"
+                res : dict # response like return_success()
+                key : hashable # a queued event with the same key is superseded
+                preview : bool # the frame is a preview , still sent to a slow client
+            Returns : None # once written , or dropped for a slow client
+        """
+        if isinstance(res.get("params"), dict):
+            res["params"]["event"] = event
+            res["params"]["device"] = "camera"
+        try:
+            await self.ws.write_response(res, label = ("camera", event), key = key, preview = preview)
+        except tornado.websocket.WebSocketClosedError:
+            logger.warning(_("Websocket closed , camera event {} is dropped").format(event))
+
+    @command({
+        "exposure" : {"type" : "number" , "required" : True , "min" : 0 , "max" : 3600},
+        "gain" : {"type" : "number" , "min" : 0},
+        "offset" : {"type" : "number" , "min" : 0},
+        "binning" : {"type" : "integer" , "min" : 1},
+        "image" : {"type" : "object"},
+        "fetch" : {"type" : "string" , "choices" : ("base64","binary")},
+    })
     async def start_exposure(self, params = {}) -> dict:
         """
             Async start exposure event
             Args : 
                 params : dict
                     exposure : float
+                    gain , offset , binning , image : see AscomCameraAPI.start_exposure()
+                    fetch : str # "base64" or "binary" , push the exposure result as soon as it is ready
             Returns : dict
+            NOTE : Return as soon as the camera started , the end of the exposure is pushed
+                    to the client as an "exposure_finished" event
         """
         if self.device is None or not self.device.info._is_connected:
             logger.warning(_("Camera int not connected , please do not execute start exposure command"))
-            return (_("Camera is not connected"))
+            return return_error(_("Camera is not connected"))
 
-        exposure = params.get('exposure')
+        # The range is checked by the schema
+        exposure = params['exposure']
 
-        if exposure is None or not 0 <= exposure <= 3600:
-            logger.error(_("A reasonable exposure value is required"))
-            return (_("A reasonable exposure value is required"))
-        
-        self.blob.clear()
-        
-        res = self.device.start_exposure(exposure)
+        if self.exposure_state == "exposing":
+            logger.error(_("Exposure is already in progress"))
+            return return_error(_("Exposure is already in progress"))
+
+        _params = dict(params)
+        _params["wait"] = False
+        res = await self._call(self.device.start_exposure, _params)
         if res.get('status') != 0:
             return res
 
-        self.thread = threading.Thread(target=self.exposure_thread)
-        try:
-            self.thread.daemon = True
-        except:
-            self.thread.setDaemon(True)
-        self.thread.start()
+        loop = asyncio.get_running_loop()
+        self.exposure_state = "exposing"
+        self.exposure_start = loop.time()
+        self.exposure_time = exposure
+        self.exposure_future = loop.create_future()
+        self.exposure_task = asyncio.ensure_future(self.watch_exposure(exposure, params.get("fetch")))
+        return return_success(_("Start exposure successfully"),{"exposure" : exposure, "state" : self.exposure_state})
 
-        tornado.ioloop.IOLoop.instance().add_callback(self.wait_exposure_result,exposure)
+    @staticmethod
+    def poll_interval(remaining : float) -> float:
+        """
+            Time to wait before the next ImageReady request
+            Args :
+                remaining : float # seconds until the expected end , negative when overdue
+            Returns : float
+            NOTE : Halve the remaining time , so a long exposure costs a few requests and
+                    the end is caught within CAMERA_POLL_MIN , then back off slowly while the
+                    camera reads out and downloads
+        """
+        if remaining > 0:
+            return min(CAMERA_POLL_MAX, max(CAMERA_POLL_MIN, remaining / 2))
+        return min(CAMERA_POLL_OVERDUE, max(CAMERA_POLL_MIN, -remaining / 4))
 
+    async def watch_exposure(self, exposure : float, fetch : str = None) -> None:
+        """
+            Wait for the end of the exposure and push it to the client
+            Args :
+                exposure : float
+                fetch : str # push the exposure result in this mode too
+            Returns : None
+        """
+        loop = asyncio.get_running_loop()
+        end = self.exposure_start + exposure
+        deadline = end + max(self.device.info._timeout, CAMERA_READOUT_TIMEOUT)
+        try:
+            while True:
+                remaining = end - loop.time()
+                res = await self._call(self.device.get_image_ready, remaining < 0)
+                if res.get("status") != 0:
+                    break
+                if res["params"]["ready"]:
+                    break
+                if res["params"].get("state") == 5 or loop.time() > deadline:
+                    res = return_error(_("Camera exposure failed or timed out"),
+                        {"state" : res["params"].get("state")})
+                    break
+                await asyncio.sleep(self.poll_interval(remaining))
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            res = return_error(_("Failed to get the exposure state"),{"error" : str(e)})
+        elapsed = round(loop.time() - self.exposure_start, 3)
+        if res.get("status") == 0:
+            self.exposure_state = "ready"
+            res = return_success(_("Exposure finished successfully"),{"exposure" : exposure, "elapsed" : elapsed})
+            logger.info(_("Camera exposure finished in {} seconds").format(elapsed))
+            await self.push("exposure_finished", res)
+        else:
+            self.exposure_state = "failed"
+            self.device.info._is_exposure = False
+            logger.error(_("Camera exposure failed : {}").format(res.get("message")))
+            await self.push("exposure_failed", res)
+        if not self.exposure_future.done():
+            self.exposure_future.set_result(res)
+        if fetch and self.exposure_state == "ready":
+            result = await self.get_exposure_result({"mode" : fetch})
+            await self.push("exposure_result", result)
+
+    @command()
     async def abort_exposure(self,params = {}) -> dict:
         """
             Async abort the exposure operation
@@ -181,83 +307,275 @@ class WSCamera(object):
         """
         if self.device is None or not self.device.info._is_connected:
             logger.warning(_("Camera is not connected , please do not execute start exposure command"))
-            return (_("Camera int not connected"))
+            return return_error(_("Camera int not connected"))
 
-        if not self.device.info._is_exposure:
+        if self.exposure_state != "exposing":
             logger.error(_("Exposure is not started, please do not execute abort exposure command"))
-            return (_("Exposure is not started"))
-
-        return self.device.abort_exposure()
-
-    def exposure_thread(self,params = {}) -> None:
-        """
-            Guard thread during the exposure and read the the status of the camera each second
-            Args : None
-            Returns : None
-        """
-        used_time = 0
-        while self.get_exposure_status().get("params").get('status') and used_time <= self.device.info._timeout:
-            sleep(1)
-            used_time += 1
+            return return_error(_("Exposure is not started"))
+
+        if self.exposure_task is not None:
+            self.exposure_task.cancel()
+        res = await self.executor.call(self.device.abort_exposure, bypass=True)
+        self.exposure_state = "aborted"
+        if not self.exposure_future.done():
+            self.exposure_future.set_result(return_warning(_("Exposure aborted"),{}))
+        await self.push("exposure_aborted", return_warning(_("Exposure aborted"),{}))
+        return res
 
+    @command()
     async def get_exposure_status(self,params = {}) -> dict:
         """
             Async get status of the exposure process
             Args : None
-            Returns : None
+            Returns : dict
+                state : str # idle , exposing , ready , failed or aborted
+                elapsed : float # seconds since the start
+                remaining : float # seconds until the expected end
+            NOTE : Answered from the state machine , the camera is not asked
         """
         if self.device is None or not self.device.info._is_connected:
             logger.warning(_("Camera is not connected , please do not execute start exposure command"))
-            return (_("Camera is not connected"))
+            return return_error(_("Camera is not connected"))
 
-        if not self.device.info._is_exposure:
-            logger.error(_("Exposure is not started, please do not execute get exposure status command"))
-            return (_("Exposure is not started"))
+        if self.exposure_state == "idle":
+            return return_warning(_("Exposure is not started"),{"state" : self.exposure_state})
 
-        res = self.device.get_exposure_status()
-        if res.get('status') != 0:
-            self.blob.clear()
-        
-        if res.get('params').get('status') is True:
-            self.blob.set()
-        else:
-            self.blob.clear()
-        
-        return res
+        elapsed = asyncio.get_running_loop().time() - self.exposure_start
+        return return_success(_("Get exposure status successfully"),{
+            "state" : self.exposure_state,
+            "exposure" : self.exposure_time,
+            "elapsed" : round(elapsed, 3),
+            "remaining" : round(max(0, self.exposure_time - elapsed), 3) if self.exposure_state == "exposing" else 0,
+        })
 
-    async def get_exposure_result(self) -> None:
+    @command({"timeout" : {"type" : "number" , "min" : 0}})
+    async def wait_exposure_result(self, params = {}) -> dict:
+        """
+            Wait for the end of the running exposure
+            Args :
+                params : dict
+                    timeout : float # seconds , default until the end
+            Returns : dict # same as the "exposure_finished" or "exposure_failed" event
+        """
+        if self.exposure_future is None:
+            return return_error(_("Exposure is not started"))
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.exposure_future), timeout=params.get("timeout"))
+        except asyncio.TimeoutError:
+            logger.info(_("Camera exposure timed out"))
+            return return_error(_("Camera exposure timed out"))
+
+    @command({
+        "mode" : {"type" : "string" , "choices" : ("base64","binary")},
+        "bins" : {"type" : "integer" , "min" : 2},
+        "preview" : {"type" : "boolean"},
+        "save" : {"type" : "boolean"},
+        "template" : {"type" : "string"},
+    })
+    async def get_exposure_result(self,params = {}) -> dict:
         """
             Get the result of the exposure operation
+            Args : 
+                params : dict
+                    mode : str # "base64" or "binary"
+                    preview : bool # register the frame for the /preview urls , default True
+            Returns : dict
+            NOTE : In binary mode the frame is sent as a binary message just after the response.
+                    params["preview"] of the response gives the urls of the downsampled previews,
+                    the client can show them long before the full frame is downloaded
+        """
+        if self.device is None or not self.device.info._is_connected:
+            logger.warning(_("Camera is not connected , please do not execute get exposure result command"))
+            return return_error(_("Camera is not connected"))
+
+        # The download and the analysis take a while , keep the event loop free
+        return await self._call(self.device.get_exposure_result, params, timeout=CAMERA_DOWNLOAD_TIMEOUT)
+
+    # #################################################################
+    # Sequence exposure
+    # #################################################################
+
+    def _change_filter(self, position : int) -> dict:
+        """
+            Sequence action , move the filter wheel and wait until it arrives
+            Args :
+                position : int
+            Returns : dict
+            NOTE : Called on the sequence engine thread , blocking is fine
+        """
+        filterwheel = self.ws.filterwheel.device
+        if filterwheel is None or not filterwheel.info._is_connected:
+            return return_error(_("Filterwheel is not connected"))
+        res = filterwheel.slew_to({"position" : position})
+        if res.get("status") != 0:
+            return res
+        # ASCOM filter wheels report -1 while moving
+        for attempt in range(600):
+            if filterwheel.cache.get("Position") == position:
+                return res
+            sleep(0.1)
+        return return_error(_("Filterwheel did not reach the target position"))
+
+    @command({
+        "sequence_count" : {"type" : "integer" , "min" : 1},
+        "sequence" : {"type" : "array" , "required" : True},
+    })
+    async def start_sequence_exposure(self, params = {}) -> dict:
+        """
+            Start a sequence , see AscomCameraAPI.start_sequence_exposure()
+            Args :
+                params : dict
+            Returns : dict
+            NOTE : The filter changes use the filter wheel connected on the same websocket
+        """
+        if self.device is None or not self.device.info._is_connected:
+            logger.warning(_("Camera is not connected , please do not execute start sequence exposure command"))
+            return return_error(_("Camera is not connected"))
+        self.device.sequence.hooks["filter"] = self._change_filter
+        return await self._call(self.device.start_sequence_exposure, params)
+
+    @command()
+    async def abort_sequence_exposure(self, params = {}) -> dict:
+        """
+            Abort the sequence , wait in a thread for the engine to stop
             Args : None
-            Returns : None
+            Returns : dict
+        """
+        if self.device is None or not self.device.info._is_connected:
+            logger.warning(_("Camera is not connected , please do not execute abort sequence exposure command"))
+            return return_error(_("Camera is not connected"))
+        return await self.executor.call(self.device.abort_sequence_exposure, bypass=True)
+
+    @command()
+    async def pause_sequence_exposure(self, params = {}) -> dict:
+        """
+            Pause the sequence after the current frame
+            Args : None
+            Returns : dict
         """
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return self.device.pause_sequence_exposure()
 
-    async def wait_exposure_result(self) -> dict:
+    @command()
+    async def continue_sequence_exposure(self, params = {}) -> dict:
         """
-            Wait for exposure result and return it as a dict with image
+            Continue a paused sequence
             Args : None
             Returns : dict
         """
-        r = {
-            "status" : 0,
-            "message" : "",
-            "params" : {}
-        }
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return self.device.continue_sequence_exposure()
+
+    @command()
+    async def get_sequence_exposure_status(self, params = {}) -> dict:
+        """
+            Get the progress of the sequence
+            Args : None
+            Returns : dict
+        """
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return self.device.get_sequence_exposure_status()
+
+    @command({"since" : {"type" : "integer" , "min" : 0}})
+    async def get_sequence_exposure_result(self, params = {}) -> dict:
+        """
+            Get the results of the processed frames
+            Args :
+                params : dict
+                    since : int # only the frames after this index
+            Returns : dict
+        """
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return self.device.get_sequence_exposure_result(params)
+
+    # #################################################################
+    # Live video
+    # #################################################################
+
+    def _on_video_preview(self, data : bytes, info : dict) -> None:
+        """
+            Called on the video worker thread with a new preview image
+            Args :
+                data : bytes # encoded image
+                info : dict # see VideoCapture._preview()
+            Returns : None
+        """
+        self.io_loop.add_callback(self._push_video_preview, data, info)
+
+    async def _push_video_preview(self, data : bytes, info : dict) -> None:
+        """
+            Push a preview as a "video_frame" event followed by the image as a binary message
+        """
+        info["frame"] = data
         try:
-            await asyncio.wait_for(self.blob, timeout=self.device.info._timeout)
-            logger.info(_("Camera exposure finished"))
-            r["message"] = _("Exposure finished successfully")
-        except TimeoutError:
-            logger.info(_("Camera exposure timed out"))
-            r["status"] = 1
-            r["message"] = _("Camera exposure timed out")
+            # A preview still queued for a slow client is replaced by the new one
+            await self.push("video_frame", return_success(_("New video frame"),info), key = "video_frame", preview = True)
         finally:
-            self.device.info._is_exposure = False
-            self.blob.clear()
-        
-        
+            # The next preview is rendered only once this one is written
+            if self.device is not None:
+                self.device.video.preview_done()
+
+    @command({
+        "exposure" : {"type" : "number" , "min" : 0},
+        "path" : {"type" : "string"},
+        "ring" : {"type" : "integer" , "min" : 1},
+        "preview_fps" : {"type" : "number" , "min" : 0},
+        "preview_format" : {"type" : "string" , "choices" : ("jpg","png")},
+    })
+    async def start_video_capture(self, params = {}) -> dict:
+        """
+            Start the live video , see AscomCameraAPI.start_video_capture()
+            Args :
+                params : dict
+            Returns : dict
+            NOTE : The previews are pushed to the client as "video_frame" events , never faster
+                    than the client reads them
+        """
+        if self.device is None or not self.device.info._is_connected:
+            logger.warning(_("Camera is not connected , please do not execute start video capture command"))
+            return return_error(_("Camera is not connected"))
+        if self.exposure_state == "exposing":
+            logger.error(_("Exposure is already in progress"))
+            return return_error(_("Exposure is already in progress"))
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.device.video.on_preview = self._on_video_preview
+        return await self._call(self.device.start_video_capture, params)
+
+    @command()
+    async def abort_video_capture(self, params = {}) -> dict:
+        """
+            Stop the live video , wait in a thread for the queued frames to be recorded
+            Args : None
+            Returns : dict
+        """
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return await self.executor.call(self.device.abort_video_capture, bypass=True)
 
-        
-        
+    @command()
+    async def get_video_capture_status(self, params = {}) -> dict:
+        """
+            Get the counters of the live video
+            Args : None
+            Returns : dict
+        """
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return self.device.get_video_capture_status()
 
-        
\ No newline at end of file
+    @command({"preview" : {"type" : "boolean"}})
+    async def get_video_capture_result(self, params = {}) -> dict:
+        """
+            Get the result of the live video
+            Args :
+                params : dict
+                    preview : bool # register the last frame for the /preview urls , default True
+            Returns : dict
+        """
+        if self.device is None:
+            return return_error(_("Camera is not connected"))
+        return await self._call(self.device.get_video_capture_result, params)
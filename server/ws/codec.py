@@ -0,0 +1,219 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Message encodings of the websockets
+#
+# The encoding is chosen once per connection during the handshake :
+#   - websocket subprotocol : new WebSocket(url , ["lightapt.msgpack"])
+#   - or query argument : ws://host/device?encoding=msgpack
+# JSON is used if nothing is asked or the encoding is not available.
+#
+#   name      subprotocol        messages   needs
+#   json      lightapt.json      text       -
+#   msgpack   lightapt.msgpack   binary     msgpack
+#   cbor      lightapt.cbor      binary     cbor2
+#
+# With a binary encoding the image frames are sent inside the message
+# as raw bytes , there is no base64 and no second message.
+#
+# permessage-deflate is negotiated by tornado when it is enabled in the
+# "ws" section of the configuration and offered by the client :
+#   "compression" : {"enable" : true , "level" : 1}
+#
+# The messages are written through the bounded outbound queue of the
+# connection , see server.ws.outbound
+#
+# #################################################################
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+import server.config as c
+from .outbound import OutboundQueue
+
+SUBPROTOCOL_PREFIX = "lightapt."
+
+def _default(obj):
+    """
+        Convert the objects the binary encoders do not know , numpy values become numbers or lists
+    """
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+class JsonCodec(object):
+    """
+        Default text encoding
+    """
+    name = "json"
+    binary = False
+
+    def encode(self, obj) -> str:
+        return json.dumps(obj, default=str)
+
+    def decode(self, message):
+        return json.loads(message)
+
+class MsgpackCodec(object):
+    """
+        MessagePack encoding
+    """
+    name = "msgpack"
+    binary = True
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+    def decode(self, message):
+        return msgpack.unpackb(message, raw=False)
+
+class CborCodec(object):
+    """
+        CBOR encoding
+    """
+    name = "cbor"
+    binary = True
+
+    def encode(self, obj) -> bytes:
+        return cbor2.dumps(obj, default=lambda encoder, value : encoder.encode(_default(value)))
+
+    def decode(self, message):
+        return cbor2.loads(message)
+
+JSON_CODEC = JsonCodec()
+
+CODECS = {"json" : JSON_CODEC}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+if cbor2 is not None:
+    CODECS["cbor"] = CborCodec()
+
+def get_codec(name : str):
+    """
+        Get an available codec by name
+        Args :
+            name : str # "json" , "msgpack" or "cbor" , with or without the subprotocol prefix
+        Returns : codec object , None if not available
+    """
+    if not name:
+        return None
+    name = name.lower()
+    if name.startswith(SUBPROTOCOL_PREFIX):
+        name = name[len(SUBPROTOCOL_PREFIX):]
+    return CODECS.get(name)
+
+class CodecWebSocketMixin(object):
+    """
+        Encoding negotiation for tornado.websocket.WebSocketHandler | 消息编码协商
+        NOTE : Put it before WebSocketHandler in the bases , call select_codec() in open()
+                and close_outbound() in on_close()
+    """
+
+    codec = JSON_CODEC
+    _outbound = None
+
+    def select_subprotocol(self, subprotocols : list):
+        """
+            Pick the first encoding offered by the client that is available
+            Args :
+                subprotocols : list # like ["lightapt.msgpack" , "lightapt.json"]
+            Returns : str # selected subprotocol , None to select none
+        """
+        for subprotocol in subprotocols:
+            codec = get_codec(subprotocol)
+            if codec is not None and subprotocol.lower().startswith(SUBPROTOCOL_PREFIX):
+                self.codec = codec
+                return subprotocol
+        return None
+
+    def select_codec(self) -> None:
+        """
+            Fall back to the "encoding" query argument if no subprotocol was selected
+            Args : None
+            Returns : None
+        """
+        if self.selected_subprotocol is None:
+            self.codec = get_codec(self.get_query_argument("encoding", None)) or JSON_CODEC
+
+    def get_compression_options(self):
+        """
+            Enable permessage-deflate if it is configured
+            Returns : dict or None
+        """
+        options = (c.config.get("ws") or {}).get("compression") or {}
+        if not options.get("enable"):
+            return None
+        return {"compression_level" : options.get("level", 1)}
+
+    def decode_message(self, message):
+        """
+            Decode a message of the client , text messages are always JSON
+            Args :
+                message : str or bytes
+            Returns : decoded object
+            NOTE : Raise ValueError if the message is invalid
+        """
+        if isinstance(message, str):
+            return json.loads(message)
+        try:
+            return self.codec.decode(message)
+        except Exception as e:
+            raise ValueError(e)
+
+    @property
+    def outbound(self) -> OutboundQueue:
+        """
+            Outbound queue of the connection , created on first use
+        """
+        if self._outbound is None:
+            self._outbound = OutboundQueue(self)
+        return self._outbound
+
+    def write_encoded(self, obj, frames : list = None, **kwargs):
+        """
+            Encode and queue a message
+            Args :
+                obj : dict or list , bytes are sent as a binary message
+                frames : list # binary messages following obj
+                **kwargs : key , merge , preview , label , see OutboundQueue.put()
+            Returns : Future # bytes written once the message is sent , 0 if dropped
+            NOTE : Raise WebSocketClosedError if the connection is closed
+        """
+        return self.outbound.put(obj, frames, **kwargs)
+
+    def close_outbound(self) -> None:
+        """
+            Drop the messages still queued
+            Args : None
+            Returns : None
+        """
+        if self._outbound is not None:
+            self._outbound.close()
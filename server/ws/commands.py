@@ -0,0 +1,255 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Command table of the websocket server
+#
+# The methods of the device wrappers which can be called by a client
+# are marked with @command , with the schema of their parameters :
+#
+#   @command({
+#       "exposure" : {"type" : "number" , "required" : True , "min" : 0 , "max" : 3600},
+#       "fetch" : {"type" : "string" , "choices" : ("base64","binary")},
+#   })
+#   async def start_exposure(self , params = {}) -> dict:
+#
+# The table is built once at startup , every schema is compiled into a
+# list of checks. A message is looked up by (device , event) in a dict
+# and its parameters are checked before the handler is called.
+#
+#   type : "number" , "integer" , "string" , "boolean" , "array" , "object"
+#          or a tuple of them , bool is never taken as a number
+#   required : bool , default False
+#   default : value used when the parameter is missing
+#   min , max : bounds of a number
+#   choices : allowed values
+#
+# Parameters not in the schema are passed as they are.
+#
+# #################################################################
+
+# Commands never waiting for the lock of their device : aborts must get through while a
+# long command is running and reading the state is always safe
+UNLOCKED_PREFIXES = ("abort_","get_","wait_","list_")
+UNLOCKED_COMMANDS = ("polling","pause_sequence_exposure","continue_sequence_exposure","subscribe","unsubscribe")
+
+# Parameters of connect() , the same for every device
+CONNECT_SCHEMA = {
+    "type" : {"type" : "string" , "required" : True , "choices" : ("ascom","indi")},
+    "device_name" : {"type" : "string" , "required" : True},
+    "host" : {"type" : "string"},
+    "port" : {"type" : "integer" , "min" : 1 , "max" : 65535},
+    "device_number" : {"type" : "integer" , "min" : 0},
+}
+
+_TYPES = {
+    "number" : (int, float),
+    "integer" : (int,),
+    "string" : (str,),
+    "boolean" : (bool,),
+    "array" : (list, tuple),
+    "object" : (dict,),
+}
+
+def command(schema : dict = None, locked : bool = None):
+    """
+        Mark a method of a device wrapper as a websocket command | 注册命令
+        Args :
+            schema : dict # {parameter : spec} , see the header of this file
+            locked : bool # wait for the lock of the device , guessed from the name if None
+        Returns : decorator
+    """
+    def decorator(func):
+        func._command = {"schema" : schema or {}, "locked" : locked}
+        return func
+    return decorator
+
+def _compile_field(name : str, spec : dict):
+    """
+        Compile the checks of one parameter into a function returning an error or None
+    """
+    types = spec.get("type")
+    if isinstance(types, str):
+        types = (types,)
+    for t in types or ():
+        if t not in _TYPES:
+            raise ValueError("Unknown type {} of parameter {}".format(t, name))
+    python_types = tuple(pt for t in (types or ()) for pt in _TYPES[t])
+    numbers = bool(types) and ("number" in types or "integer" in types) and "boolean" not in types
+    low = spec.get("min")
+    high = spec.get("max")
+    choices = tuple(spec["choices"]) if spec.get("choices") is not None else None
+
+    def check(value):
+        if python_types:
+            if not isinstance(value, python_types) or (numbers and isinstance(value, bool)):
+                return "{} must be {}".format(name, " or ".join(types))
+        if low is not None and isinstance(value, (int, float)) and value < low:
+            return "{} must be at least {}".format(name, low)
+        if high is not None and isinstance(value, (int, float)) and value > high:
+            return "{} must be at most {}".format(name, high)
+        if choices is not None and value not in choices:
+            return "{} must be one of {}".format(name, ", ".join(str(choice) for choice in choices))
+        return None
+    return check
+
+def compile_schema(schema : dict):
+    """
+        Compile a parameter schema into a validation function
+        Args :
+            schema : dict # {parameter : spec}
+        Returns : callable # validate(params) -> (params , error) , error is None if valid
+        NOTE : Raise ValueError if the schema itself is invalid
+    """
+    fields = []
+    for name, spec in schema.items():
+        fields.append((name, bool(spec.get("required")), "default" in spec, spec.get("default"), _compile_field(name, spec)))
+
+    def validate(params):
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            return params, "params must be an object"
+        for name, required, has_default, default, check in fields:
+            if name not in params or params[name] is None:
+                if required:
+                    return params, "{} is required".format(name)
+                if has_default:
+                    params = dict(params)
+                    params[name] = default
+                continue
+            error = check(params[name])
+            if error is not None:
+                return params, error
+        return params, None
+    return validate
+
+class Command(object):
+    """
+        One entry of the command table
+    """
+
+    def __init__(self, device : str, event : str, func, schema : dict, locked : bool = None, generic : bool = False) -> None:
+        """
+            Args :
+                device : str
+                event : str
+                func : callable # method of the wrapper , or handler(ws , device , params) if generic
+                schema : dict
+                locked : bool # guessed from the name if None
+                generic : bool # handled by the websocket server itself , not by the device wrapper
+        """
+        self.device = device
+        self.event = event
+        self.func = func
+        self.schema = schema
+        self.validate = compile_schema(schema)
+        if locked is None:
+            locked = not (event.startswith(UNLOCKED_PREFIXES) or event in UNLOCKED_COMMANDS)
+        self.locked = locked
+        self.generic = generic
+
+    def describe(self) -> dict:
+        """
+            Description of the command for list_commands
+        """
+        params = {}
+        for name, spec in self.schema.items():
+            params[name] = {k : (list(v) if isinstance(v, tuple) else v) for k, v in spec.items()}
+        doc = (self.func.__doc__ or "").strip().splitlines()
+        return {
+            "device" : self.device,
+            "event" : self.event,
+            "description" : doc[0].strip() if doc else "",
+            "params" : params,
+            "locked" : self.locked,
+        }
+
+class CommandTable(object):
+    """
+        Registered commands , looked up by (device , event)
+    """
+
+    def __init__(self) -> None:
+        self._commands = {}
+        self._aliases = {}
+
+    def register_wrapper(self, device : str, cls) -> None:
+        """
+            Register all of the @command methods of a device wrapper class
+            Args :
+                device : str # like "camera"
+                cls : class # like WSCamera
+            Returns : None
+        """
+        self._commands.setdefault(device, {})
+        for name in dir(cls):
+            func = getattr(cls, name)
+            options = getattr(func, "_command", None)
+            if options is not None:
+                self._commands[device][name] = Command(device, name, func, options["schema"], options["locked"])
+
+    def register_generic(self, event : str, func, schema : dict = None, devices : tuple = None, locked : bool = None) -> None:
+        """
+            Register a command handled by the websocket server for several devices
+            Args :
+                event : str
+                func : callable # handler(ws , device , params)
+                schema : dict
+                devices : tuple # all the registered devices if None
+                locked : bool
+            Returns : None
+        """
+        for device in (devices or list(self._commands.keys())):
+            self._commands.setdefault(device, {})[event] = Command(device, event, func, schema or {}, locked, generic=True)
+
+    def add_alias(self, alias : str, device : str) -> None:
+        """
+            Accept another name for a device , like an old misspelling
+        """
+        self._aliases[alias] = device
+
+    def resolve(self, device : str) -> str:
+        """
+            Get the registered name of a device , None if unknown
+        """
+        device = self._aliases.get(device, device)
+        return device if device in self._commands else None
+
+    def get(self, device : str, event : str) -> Command:
+        """
+            Look up a command
+            Args :
+                device : str # registered name , see resolve()
+                event : str
+            Returns : Command or None
+        """
+        return self._commands.get(device, {}).get(event)
+
+    def list_commands(self, device : str = None) -> list:
+        """
+            Describe the registered commands
+            Args :
+                device : str # only this device , all if None
+            Returns : list # see Command.describe()
+        """
+        devices = [device] if device is not None else sorted(self._commands.keys())
+        return [self._commands[d][e].describe() for d in devices for e in sorted(self._commands.get(d, {}).keys())]
@@ -0,0 +1,223 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Device execution layer
+#
+# The device APIs are blocking (HTTP requests , INDI round trips) and
+# must never run on the IOLoop. Every websocket device wrapper owns a
+# single thread executor , so the calls of one device run one after
+# another in the order they were made and a slow driver only delays
+# its own device.
+#
+#   websocket handler --await--> DeviceExecutor.call() --> device thread
+#
+# A call waiting in the queue is removed when it times out or when its
+# task is cancelled. A call already running on the device thread can
+# not be interrupted , the caller gets the timeout error and the thread
+# is busy until the driver returns. Aborts use bypass = True so they
+# never wait behind the call they are aborting.
+#
+# #################################################################
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.i18n import _
+from ..logging import logger, return_error
+
+# Default time allowed for one device call in seconds , None means no limit
+DEVICE_CALL_TIMEOUT = 30.0
+# Connecting reads the whole configuration of the device
+DEVICE_CONNECT_TIMEOUT = 60.0
+
+class DeviceExecutor(object):
+    """
+        Single thread executor of one device with call metrics
+    """
+
+    def __init__(self, name : str, timeout : float = DEVICE_CALL_TIMEOUT) -> None:
+        """
+            Args :
+                name : str # device name like "camera" , used for the thread name
+                timeout : float # default timeout of a call
+        """
+        self.name = name
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._max_queued = 0
+        # (name of the call , start time) of the call on the device thread
+        self._running = None
+        self._calls = {}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+            Create the device thread on the first call
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="{}-device".format(self.name))
+            return self._executor
+
+    async def call(self, func, *args, timeout : float = -1, bypass : bool = False):
+        """
+            Run a blocking device method and wait for its result | 在设备线程执行
+            Args :
+                func : callable
+                *args : arguments of func
+                timeout : float # seconds , the default of the executor if -1 , no limit if None
+                bypass : bool # run at once in the shared executor , not behind the queued calls
+            Returns : the result of func , or an error response if the call timed out
+            NOTE : Exceptions of func are raised to the caller
+        """
+        timeout = self.timeout if timeout == -1 else timeout
+        label = getattr(func, "__name__", str(func))
+        submitted = time.monotonic()
+
+        def run():
+            start = time.monotonic()
+            if not bypass:
+                with self._lock:
+                    self._queued -= 1
+                    self._running = (label, start)
+            error = True
+            try:
+                res = func(*args)
+                error = False
+                return res
+            finally:
+                end = time.monotonic()
+                with self._lock:
+                    if not bypass:
+                        self._running = None
+                    self._record(label, start - submitted, end - start, error = error)
+
+        if bypass:
+            future = asyncio.get_running_loop().run_in_executor(None, run)
+            cfuture = None
+        else:
+            with self._lock:
+                self._queued += 1
+                self._max_queued = max(self._max_queued, self._queued)
+            cfuture = self._get_executor().submit(run)
+            future = asyncio.wrap_future(cfuture)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            started = not self._discard(cfuture)
+            with self._lock:
+                self._record(label, 0, 0, timeout = True)
+            logger.error(_("{} call {} timed out after {} seconds").format(self.name, label, timeout))
+            return return_error(_("Device call timed out"), {
+                "call" : label,
+                "timeout" : timeout,
+                "started" : started,
+            })
+        except asyncio.CancelledError:
+            self._discard(cfuture)
+            raise
+
+    def _discard(self, cfuture) -> bool:
+        """
+            Remove a call from the queue if it did not start yet
+            Returns : bool # True if the call will never run
+        """
+        if cfuture is not None and cfuture.cancel():
+            with self._lock:
+                self._queued -= 1
+            return True
+        return False
+
+    def _record(self, label : str, wait : float, elapsed : float, error : bool = False, timeout : bool = False) -> None:
+        """
+            Add a call to the metrics , the lock must be held
+        """
+        stats = self._calls.get(label)
+        if stats is None:
+            stats = self._calls[label] = {
+                "count" : 0,
+                "errors" : 0,
+                "timeouts" : 0,
+                "total_time" : 0.,
+                "max_time" : 0.,
+                "total_wait" : 0.,
+                "max_wait" : 0.,
+            }
+        if timeout:
+            stats["timeouts"] += 1
+            return
+        stats["count"] += 1
+        stats["errors"] += int(error)
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def get_stats(self) -> dict:
+        """
+            Get the metrics of the device calls | 获取调用统计
+            Args : None
+            Returns : dict
+                queued : int # calls waiting for the device thread
+                max_queued : int
+                running : dict # call on the device thread and its elapsed time , None if idle
+                calls : dict # {name : count , errors , timeouts , mean_time , max_time , mean_wait , max_wait}
+        """
+        now = time.monotonic()
+        with self._lock:
+            running = None
+            if self._running is not None:
+                running = {"call" : self._running[0], "elapsed" : round(now - self._running[1], 4)}
+            calls = {}
+            for label, stats in self._calls.items():
+                count = max(stats["count"], 1)
+                calls[label] = {
+                    "count" : stats["count"],
+                    "errors" : stats["errors"],
+                    "timeouts" : stats["timeouts"],
+                    "mean_time" : round(stats["total_time"] / count, 4),
+                    "max_time" : round(stats["max_time"], 4),
+                    "mean_wait" : round(stats["total_wait"] / count, 4),
+                    "max_wait" : round(stats["max_wait"], 4),
+                }
+            return {
+                "device" : self.name,
+                "queued" : self._queued,
+                "max_queued" : self._max_queued,
+                "running" : running,
+                "calls" : calls,
+            }
+
+    def shutdown(self) -> None:
+        """
+            Stop the device thread once the queued calls returned
+            Args : None
+            Returns : None
+            NOTE : Cancel the tasks waiting for the calls first to drop the queued calls
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
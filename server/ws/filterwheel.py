@@ -20,6 +20,8 @@ Boston, MA 02110-1301, USA.
 
 from utils.i18n import _
 from ..logging import logger,return_error
+from .executor import DeviceExecutor,DEVICE_CONNECT_TIMEOUT
+from .commands import command,CONNECT_SCHEMA
 
 class WSFilterwheel(object):
     """
@@ -35,6 +37,8 @@ class WSFilterwheel(object):
         self.device = None
         self.ws = ws
         self.thread = None
+        # Every blocking call of the filterwheel runs on this thread
+        self.executor = DeviceExecutor("filterwheel")
 
     def __del__(self) -> None:
         """
@@ -51,6 +55,7 @@ class WSFilterwheel(object):
         """
         return self.__class__.__name__
 
+    @command(CONNECT_SCHEMA)
     async def connect(self , params = {}) -> None:
         """
             Async connect to the filterwheel 
@@ -65,15 +70,11 @@ class WSFilterwheel(object):
         """
         if self.device is not None:
             logger.info(_("Disconnecting from existing filterwheel ..."))
-            self.disconnect()
+            await self.disconnect()
 
+        # type and device_name are checked by the schema
         _type = params.get('type')
-        _device_name = params.get('device_name')
 
-        if _type is None or _device_name is None:
-            logger.error(_("Type or device name must be specified"))
-            return return_error(_("Type or device name must be specified"))
-        
         if _type == "indi":
             """from server.api.indi.filterwheel import INDIFilterwheelAPI
             self.device = INDIFilterwheelAPI()"""
@@ -84,8 +85,9 @@ class WSFilterwheel(object):
             logger.error(_("Unknown device type : {}").format(_type))
             return return_error(_("Unknown device type"))
 
-        return self.device.connect(params=params)
+        return await self.executor.call(self.device.connect, params, timeout=DEVICE_CONNECT_TIMEOUT)
 
+    @command()
     async def disconnect(self,params = {}) -> dict:
         """
             Async disconnect from the device
@@ -96,8 +98,9 @@ class WSFilterwheel(object):
             logger.warning(_("Filterwheel is not connected , please do not execute disconnect command"))
             return return_error(_("Filterwheel is not connected"))
         
-        return self.device.disconnect()
+        return await self.executor.call(self.device.disconnect)
 
+    @command()
     async def reconnect(self,params = {}) -> dict:
         """
             Async reconnect to the device
@@ -110,8 +113,9 @@ class WSFilterwheel(object):
             logger.warning(_("Filterwheel is not connected , please do not execute reconnect command"))
             return return_error(_("Filterwheel is not connected"))
 
-        return self.device.reconnect()
+        return await self.executor.call(self.device.reconnect)
 
+    @command()
     async def scanning(self,params = {}) -> dict:
         """
             Async scanning all of the devices available
@@ -123,8 +127,9 @@ class WSFilterwheel(object):
             logger.warning(_("Filterwheel had already been connected , please do not execute scanning command"))
             return return_error(_("Filterwheel has already been connected"))
 
-        return self.device.scanning()
+        return await self.executor.call(self.device.scanning)
 
+    @command()
     async def polling(self,params = {}) -> dict:
         """
             Async polling method to get the newest filterwheel information
@@ -132,11 +137,11 @@ class WSFilterwheel(object):
             Returns : dict
                 info : dict # usually generated from get_dict() function
         """
-        if self.device is not None or self.device.info._is_connected:
+        if self.device is None or not self.device.info._is_connected:
             logger.warning(_("Filterwheel is not connected , please do not execute polling command"))
             return return_error(_("Filterwheel is not connected"))
 
-        return self.device.polling()
+        return await self.executor.call(self.device.polling)
 
     # #############################################################
     #
@@ -148,6 +153,7 @@ class WSFilterwheel(object):
     # Current filter
     # #############################################################
 
+    @command()
     async def get_current_filter(self,params = {}) -> dict:
         """
             Get the current filter of the filter wheel
@@ -160,6 +166,7 @@ class WSFilterwheel(object):
     # Slew
     # #############################################################
 
+    @command({"id" : {"type" : "integer" , "required" : True , "min" : 0}})
     async def slew(self,params = {}) -> dict:
         """
             Filter wheel slew to the current filter
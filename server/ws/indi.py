@@ -21,6 +21,8 @@ Boston, MA 02110-1301, USA.
 import json
 import tornado.web
 from ..api.indi import ws_indi_worker
+from .codec import CodecWebSocketMixin
+from ..logging import logger
 
 # #################################################################
 # INDI Debug 
@@ -67,12 +69,17 @@ class INDIFIFOGetAllDevice(tornado.web.RequestHandler):
 # INDI Client
 # #################################################################
 
-class INDIClientWebSocket(tornado.websocket.WebSocketHandler):
+class INDIClientWebSocket(CodecWebSocketMixin, tornado.websocket.WebSocketHandler):
+    """
+    the encoding (json, msgpack or cbor) is negotiated at the handshake, see server.ws.codec
+    the messages go through the bounded outbound queue of the connection, see server.ws.outbound
+    """
     def check_origin(self, origin: str) -> bool:
         return True
 
     def open(self):
-        print("Client Instruction WS opened")
+        self.select_codec()
+        logger.debug(f"Client Instruction WS opened, encoding {self.codec.name}")
 
     async def on_message(self, message):
         """
@@ -83,16 +90,19 @@ class INDIClientWebSocket(tornado.websocket.WebSocketHandler):
         }
         :return:
         """
-        command_json = json.loads(message)
+        command_json = self.decode_message(message)
         return_struct = await ws_indi_worker.accept_instruction(
             command_json['device_name'],
             command_json['instruction'],
             command_json['params'],
             self
         )
-        await self.write_message(json.dumps(return_struct))
+        # bytes are sent as a binary message
+        await self.write_encoded(return_struct)
 
     def on_close(self):
+        ws_indi_worker.properties.drop_subscription(self)
+        self.close_outbound()
         print("Client Instruction WS  closed")
 
 class INDIDebugHtml(tornado.web.RequestHandler):
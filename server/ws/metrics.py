@@ -0,0 +1,352 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Metrics of the websocket server
+#
+# One registry per process , filled by MainWebsocketServer :
+#   - per (device , event) : latency histogram , errors , payload sizes
+#   - open websocket connections
+#   - IOLoop lag , how late a periodic sleep wakes up
+#   - outbound queue events , see server.ws.outbound
+#
+# The percentiles are estimated from the histogram buckets like
+# histogram_quantile() of Prometheus , so recording costs the same
+# whatever the number of commands.
+#
+#   GET /system/api/metrics              JSON
+#   GET /system/api/metrics/prometheus   Prometheus text format
+#
+# #################################################################
+
+import asyncio
+import bisect
+import json
+import threading
+import time
+
+import tornado.web
+
+# Upper bounds of the latency buckets in seconds , the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Upper bounds of the IOLoop lag buckets in seconds
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# Interval of the IOLoop lag probe in seconds
+LAG_INTERVAL = 0.5
+
+# Counters of the outbound queues , with their help text
+COUNTERS = {
+    "outbound_coalesced" : "Queued messages replaced by a newer one",
+    "outbound_dropped" : "Queued previews dropped for a slow client",
+    "outbound_frames_dropped" : "Full frames removed for a downgraded client",
+    "slow_downgrades" : "Slow clients downgraded to previews only",
+    "slow_disconnects" : "Slow clients disconnected",
+}
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Histogram(object):
+    """
+        Fixed buckets histogram , not thread safe
+    """
+
+    def __init__(self, buckets : tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value : float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q : float) -> float:
+        """
+            Estimate a quantile with a linear interpolation inside its bucket
+            Args :
+                q : float # between 0 and 1
+            Returns : float # 0 if empty
+        """
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.max
+                low = self.buckets[index - 1] if index else 0.
+                high = min(self.buckets[index], self.max)
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count" : self.count,
+            "mean" : round(self.sum / self.count, 6) if self.count else 0.,
+            "max" : round(self.max, 6),
+            "p50" : round(self.quantile(0.5), 6),
+            "p95" : round(self.quantile(0.95), 6),
+            "p99" : round(self.quantile(0.99), 6),
+        }
+
+class CommandMetrics(object):
+    """
+        Metrics of one (device , event)
+    """
+
+    def __init__(self) -> None:
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+        self.received = 0
+        self.sent = 0
+        self.max_received = 0
+        self.max_sent = 0
+        self.messages_in = 0
+        self.messages_out = 0
+
+class WebsocketMetrics(object):
+    """
+        Registry of the websocket server metrics | 服务器统计
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._connections = 0
+        self._connections_total = 0
+        self._lag = Histogram(LAG_BUCKETS)
+        self._last_lag = 0.
+        self._lag_task = None
+        self._started = time.time()
+        self._counters = dict.fromkeys(COUNTERS, 0)
+
+    def _get(self, device : str, event : str) -> CommandMetrics:
+        """
+            Get the metrics of a command , the lock must be held
+        """
+        key = (device, event)
+        metrics = self._commands.get(key)
+        if metrics is None:
+            metrics = self._commands[key] = CommandMetrics()
+        return metrics
+
+    def observe_command(self, device : str, event : str, elapsed : float, failed : bool) -> None:
+        """
+            Record one executed command
+            Args :
+                device : str # registered device name , "unknown" if not registered
+                event : str
+                elapsed : float # seconds
+                failed : bool # the response has the error status
+            Returns : None
+        """
+        with self._lock:
+            metrics = self._get(device, event)
+            metrics.latency.observe(elapsed)
+            metrics.errors += int(failed)
+
+    def observe_payload(self, device : str, event : str, received : int = 0, sent : int = 0) -> None:
+        """
+            Record the size of a message and its response
+            Args :
+                device : str
+                event : str
+                received : int # bytes of the request , 0 for a pushed event
+                sent : int # bytes written to the client , frames included
+            Returns : None
+        """
+        with self._lock:
+            metrics = self._get(device, event)
+            if received:
+                metrics.received += received
+                metrics.messages_in += 1
+                metrics.max_received = max(metrics.max_received, received)
+            if sent:
+                metrics.sent += sent
+                metrics.messages_out += 1
+                metrics.max_sent = max(metrics.max_sent, sent)
+
+    def count(self, name : str, value : int = 1) -> None:
+        """
+            Increase one of the COUNTERS
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self._connections += 1
+            self._connections_total += 1
+
+    def connection_closed(self) -> None:
+        with self._lock:
+            self._connections = max(self._connections - 1, 0)
+
+    def start_lag_monitor(self, interval : float = LAG_INTERVAL) -> None:
+        """
+            Start the IOLoop lag probe on the running loop , once
+            Args :
+                interval : float # seconds between two probes
+            Returns : None
+        """
+        if self._lag_task is not None and not self._lag_task.done():
+            return
+        self._lag_task = asyncio.ensure_future(self._probe_lag(interval))
+
+    async def _probe_lag(self, interval : float) -> None:
+        """
+            Sleep and measure how late the loop wakes up , a blocked loop delays every client
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - expected, 0.)
+            with self._lock:
+                self._lag.observe(lag)
+                self._last_lag = lag
+
+    def get_dict(self) -> dict:
+        """
+            Get all of the metrics for the JSON endpoint | 获取统计
+            Args : None
+            Returns : dict
+                uptime : float
+                connections : dict # open , total
+                ioloop_lag : dict # last , count , mean , max , p50 , p95 , p99 in seconds
+                outbound : dict # see COUNTERS
+                commands : list # device , event , count , errors , latency , payload
+        """
+        with self._lock:
+            commands = []
+            for (device, event), metrics in sorted(self._commands.items()):
+                commands.append({
+                    "device" : device,
+                    "event" : event,
+                    "count" : metrics.latency.count,
+                    "errors" : metrics.errors,
+                    "latency" : metrics.latency.summary(),
+                    "payload" : {
+                        "received" : metrics.received,
+                        "sent" : metrics.sent,
+                        "max_received" : metrics.max_received,
+                        "max_sent" : metrics.max_sent,
+                        "mean_received" : metrics.received // metrics.messages_in if metrics.messages_in else 0,
+                        "mean_sent" : metrics.sent // metrics.messages_out if metrics.messages_out else 0,
+                    },
+                })
+            lag = self._lag.summary()
+            lag["last"] = round(self._last_lag, 6)
+            return {
+                "uptime" : round(time.time() - self._started, 3),
+                "connections" : {"open" : self._connections, "total" : self._connections_total},
+                "ioloop_lag" : lag,
+                "outbound" : dict(self._counters),
+                "commands" : commands,
+            }
+
+    def render_prometheus(self) -> str:
+        """
+            Get all of the metrics in the Prometheus text format
+            Args : None
+            Returns : str
+        """
+        lines = []
+
+        def header(name : str, kind : str, text : str) -> None:
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        def histogram(name : str, hist : Histogram, labels : str) -> None:
+            cumulative = 0
+            sep = "," if labels else ""
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, bound, cumulative))
+            lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(name, labels, sep, hist.count))
+            lines.append("{}_sum{} {}".format(name, "{" + labels + "}" if labels else "", hist.sum))
+            lines.append("{}_count{} {}".format(name, "{" + labels + "}" if labels else "", hist.count))
+
+        with self._lock:
+            items = sorted(self._commands.items())
+            labels = {key : 'device="{}",event="{}"'.format(_escape(key[0]), _escape(key[1])) for key, _m in items}
+
+            header("lightapt_ws_command_duration_seconds", "histogram", "Time spent executing a websocket command")
+            for key, metrics in items:
+                histogram("lightapt_ws_command_duration_seconds", metrics.latency, labels[key])
+            for name, kind, text, attr in (
+                ("lightapt_ws_command_errors_total", "counter", "Commands answered with an error", "errors"),
+                ("lightapt_ws_received_bytes_total", "counter", "Bytes of the messages received from the clients", "received"),
+                ("lightapt_ws_sent_bytes_total", "counter", "Bytes written to the clients , frames included", "sent"),
+                ("lightapt_ws_received_bytes_max", "gauge", "Biggest message received from the clients", "max_received"),
+                ("lightapt_ws_sent_bytes_max", "gauge", "Biggest response written to the clients", "max_sent"),
+            ):
+                header(name, kind, text)
+                for key, metrics in items:
+                    lines.append("{}{{{}}} {}".format(name, labels[key], getattr(metrics, attr)))
+
+            header("lightapt_ws_connections", "gauge", "Open websocket connections")
+            lines.append("lightapt_ws_connections {}".format(self._connections))
+            header("lightapt_ws_connections_total", "counter", "Websocket connections opened since the start")
+            lines.append("lightapt_ws_connections_total {}".format(self._connections_total))
+            header("lightapt_ioloop_lag_seconds", "histogram", "Delay of the IOLoop callbacks")
+            histogram("lightapt_ioloop_lag_seconds", self._lag, "")
+            for name, value in sorted(self._counters.items()):
+                header("lightapt_ws_{}_total".format(name), "counter", COUNTERS.get(name, name))
+                lines.append("lightapt_ws_{}_total {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+def _escape(value : str) -> str:
+    """
+        Escape a Prometheus label value
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = WebsocketMetrics()
+
+# #################################################################
+# HTTP endpoints
+# #################################################################
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+        Metrics of the websocket server in JSON
+        GET /system/api/metrics
+    """
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(metrics.get_dict()))
+
+class PrometheusMetricsHandler(tornado.web.RequestHandler):
+    """
+        Metrics of the websocket server for Prometheus
+        GET /system/api/metrics/prometheus
+    """
+    def get(self):
+        self.set_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.write(metrics.render_prometheus())
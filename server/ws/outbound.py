@@ -0,0 +1,373 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Outbound queue of a websocket connection
+#
+# Everything written to a client goes through one queue , written by
+# one task which waits for tornado to flush each message before the
+# next one. A message and its binary frames are one entry , so nothing
+# can be written between them.
+#
+#   put() --> [ entry , entry , ... ] --> writer task --> write_message()
+#
+# A message with a key replaces the queued message with the same key ,
+# telemetry is merged and an old video preview is superseded by the
+# new one. The queue has limits , configured in the "ws" section :
+#
+#   "outbound" : {
+#       "max_messages" : 256 ,     # queued entries
+#       "max_bytes" : 67108864 ,   # queued bytes , frames included
+#       "max_age" : 15 ,           # seconds the oldest entry waited
+#       "policy" : "preview"       # or "disconnect"
+#   }
+#
+# The next entry to be written is not counted in max_bytes , so a single
+# frame bigger than the limit still goes to an idle client. max_age is
+# measured on the queued entries only , a frame slow to write is not
+# downgraded or cut while it is written. It is also checked by a timer ,
+# a stalled client is caught without new messages.
+#
+# A client over a limit is slow. The queued previews are dropped first ,
+# then with the "preview" policy the client is downgraded : the full
+# frames are removed from its messages (params.frame_dropped is set ,
+# the image is still available at /preview/<id>/) and only previews and
+# small messages are sent. A downgraded client still over a limit , or
+# any slow client with the "disconnect" policy , is disconnected. A
+# downgraded client gets the full frames again once its queue is empty.
+#
+# #################################################################
+
+import asyncio
+import collections
+import time
+
+import tornado.websocket
+
+from utils.i18n import _
+from ..logging import logger
+from .metrics import metrics
+import server.config as c
+
+OUTBOUND_DEFAULTS = {
+    "max_messages" : 256,
+    "max_bytes" : 64 * 1024 * 1024,
+    "max_age" : 15.0,
+    "policy" : "preview",
+}
+
+# Close code sent to a client which could not keep up
+SLOW_CLIENT_CODE = 1008
+
+def drop_frames(res) -> bool:
+    """
+        Remove the full frames of a response and of its batch results
+        Args :
+            res : dict
+        Returns : bool # True if a frame was removed
+    """
+    dropped = False
+    if not isinstance(res, dict) or not isinstance(res.get("params"), dict):
+        return False
+    for _res in [res] + (res["params"].get("batch") or []):
+        params = _res.get("params") if isinstance(_res, dict) else None
+        if not isinstance(params, dict):
+            continue
+        frame = params.pop("frame", None)
+        if frame is not None or params.pop("binary", False):
+            params.pop("size", None)
+            params["frame_dropped"] = True
+            dropped = True
+    return dropped
+
+class Entry(object):
+    """
+        One queued message with its frames
+    """
+
+    __slots__ = ("obj", "frames", "messages", "size", "time", "key", "merge", "preview", "label", "future")
+
+    def __init__(self, obj, frames : list, key, merge, preview : bool, label : tuple) -> None:
+        self.obj = obj
+        self.frames = frames
+        self.messages = []
+        self.size = 0
+        self.time = time.monotonic()
+        self.key = key
+        self.merge = merge
+        self.preview = preview
+        self.label = label
+        self.future = asyncio.get_running_loop().create_future()
+
+    def encode(self, codec) -> None:
+        data = self.obj if isinstance(self.obj, (bytes, bytearray, memoryview)) else codec.encode(self.obj)
+        self.messages = [(data, codec.binary or not isinstance(data, str))] + [(frame, True) for frame in self.frames]
+        self.size = sum(len(message) for message, _b in self.messages)
+
+    def has_frames(self) -> bool:
+        """
+            Whether the entry carries a full resolution frame , previews are not counted
+        """
+        if self.preview or isinstance(self.obj, (bytes, bytearray, memoryview)):
+            return False
+        if self.frames:
+            return True
+        params = self.obj.get("params") if isinstance(self.obj, dict) else None
+        return isinstance(params, dict) and params.get("frame") is not None
+
+    def resolve(self, sent : int) -> None:
+        if not self.future.done():
+            self.future.set_result(sent)
+
+class OutboundQueue(object):
+    """
+        Bounded outbound queue of one websocket connection | 发送队列
+    """
+
+    def __init__(self, ws, options : dict = None) -> None:
+        """
+            Args :
+                ws : websocket handler with a codec , see server.ws.codec
+                options : dict # see OUTBOUND_DEFAULTS , read from the configuration if None
+        """
+        if options is None:
+            options = (c.config.get("ws") or {}).get("outbound") or {}
+        self.options = dict(OUTBOUND_DEFAULTS)
+        self.options.update(options)
+        self.ws = ws
+        self.entries = collections.deque()
+        self.keys = {}
+        self.bytes = 0
+        self.task = None
+        # Timer checking max_age
+        self.timer = None
+        self.closed = False
+        self.preview_only = False
+        self.stats = {
+            "sent_messages" : 0,
+            "sent_bytes" : 0,
+            "coalesced" : 0,
+            "dropped" : 0,
+            "frames_dropped" : 0,
+            "downgrades" : 0,
+            "max_messages" : 0,
+            "max_bytes" : 0,
+        }
+
+    def put(self, obj, frames : list = None, key = None, merge = None, preview : bool = False, label : tuple = None) -> asyncio.Future:
+        """
+            Queue a message
+            Args :
+                obj : dict or bytes # encoded with the codec of the connection , bytes are sent as they are
+                frames : list # binary messages following obj , JSON connections only
+                key : hashable # replace the queued message with the same key
+                merge : callable # merge(old , new) -> obj , used instead of replacing
+                preview : bool # the frames are previews , kept for a downgraded client
+                label : tuple # (device , event) of the metrics
+            Returns : Future # bytes written once sent , 0 if dropped or superseded
+            NOTE : Raise WebSocketClosedError if the connection is closed
+        """
+        if self.closed:
+            raise tornado.websocket.WebSocketClosedError()
+        entry = Entry(obj, list(frames or ()), key, merge, preview, label)
+        if self.preview_only and entry.has_frames():
+            self._drop_frames(entry)
+        entry.encode(self.ws.codec)
+
+        old = self.keys.get(key) if key is not None else None
+        if old is not None:
+            # Keep the place of the old message , it already waited
+            if merge is not None:
+                entry.obj = merge(old.obj, entry.obj)
+                entry.encode(self.ws.codec)
+            entry.time = old.time
+            self.entries[self.entries.index(old)] = entry
+            self.bytes -= old.size
+            old.resolve(0)
+            self.stats["coalesced"] += 1
+            metrics.count("outbound_coalesced")
+        else:
+            self.entries.append(entry)
+        if key is not None:
+            self.keys[key] = entry
+        self.bytes += entry.size
+        self.stats["max_messages"] = max(self.stats["max_messages"], len(self.entries))
+        self.stats["max_bytes"] = max(self.stats["max_bytes"], self.bytes)
+
+        self._check()
+        if not self.closed and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self._run())
+        if not self.closed and self.timer is None:
+            self._schedule()
+        return entry.future
+
+    def _oldest(self) -> Entry:
+        """
+            Get the queued entry waiting for the longest time , the one being written is not queued
+        """
+        return self.entries[0] if self.entries else None
+
+    def _schedule(self) -> None:
+        """
+            Check max_age when the oldest entry reaches it
+        """
+        oldest = self._oldest()
+        if oldest is None:
+            return
+        delay = max(oldest.time + self.options["max_age"] - time.monotonic(), 0.05)
+        self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self.timer = None
+        if self.closed:
+            return
+        self._check()
+        if not self.closed:
+            self._schedule()
+
+    def _over(self) -> str:
+        """
+            Get the exceeded limit , None if the queue is within its limits
+        """
+        if len(self.entries) > self.options["max_messages"]:
+            return "max_messages"
+        # The next entry is written anyway , only the ones behind it are counted
+        if self.entries and self.bytes - self.entries[0].size > self.options["max_bytes"]:
+            return "max_bytes"
+        oldest = self._oldest()
+        if oldest is not None and time.monotonic() - oldest.time > self.options["max_age"]:
+            return "max_age"
+        return None
+
+    def _check(self) -> None:
+        """
+            Handle a slow client , see the header of this file
+        """
+        if self._over() is None:
+            return
+        for entry in [e for e in self.entries if e.preview]:
+            self._remove(entry)
+            self.stats["dropped"] += 1
+            metrics.count("outbound_dropped")
+        limit = self._over()
+        if limit is None:
+            return
+        if self.options["policy"] == "preview" and not self.preview_only:
+            self.preview_only = True
+            self.stats["downgrades"] += 1
+            metrics.count("slow_downgrades")
+            logger.warning(_("Websocket client is too slow ({}) , sending previews only").format(limit))
+            for entry in self.entries:
+                if entry.has_frames():
+                    self.bytes -= entry.size
+                    self._drop_frames(entry)
+                    entry.encode(self.ws.codec)
+                    self.bytes += entry.size
+            limit = self._over()
+            if limit is None:
+                return
+        logger.error(_("Websocket client is too slow ({}) , disconnecting").format(limit))
+        metrics.count("slow_disconnects")
+        self.close()
+        self.ws.close(SLOW_CLIENT_CODE, "Client too slow")
+
+    def _drop_frames(self, entry : Entry) -> None:
+        if drop_frames(entry.obj) or entry.frames:
+            self.stats["frames_dropped"] += 1
+            metrics.count("outbound_frames_dropped")
+        entry.frames = []
+
+    def _remove(self, entry : Entry) -> None:
+        self.entries.remove(entry)
+        if entry.key is not None and self.keys.get(entry.key) is entry:
+            del self.keys[entry.key]
+        self.bytes -= entry.size
+        entry.resolve(0)
+
+    async def _run(self) -> None:
+        """
+            Writer task , one entry at a time
+        """
+        while self.entries and not self.closed:
+            entry = self.entries.popleft()
+            if entry.key is not None and self.keys.get(entry.key) is entry:
+                del self.keys[entry.key]
+            self.bytes -= entry.size
+            try:
+                for data, binary in entry.messages:
+                    await self.ws.write_message(data, binary=binary)
+            except tornado.websocket.WebSocketClosedError:
+                entry.resolve(0)
+                self.close()
+                return
+            except asyncio.CancelledError:
+                entry.resolve(0)
+                raise
+            self.stats["sent_messages"] += 1
+            self.stats["sent_bytes"] += entry.size
+            if entry.label is not None:
+                metrics.observe_payload(entry.label[0], entry.label[1], sent = entry.size)
+            entry.resolve(entry.size)
+        if self.preview_only and not self.entries:
+            self.preview_only = False
+            logger.info(_("Websocket client caught up , sending full frames again"))
+
+    def close(self) -> None:
+        """
+            Drop the queued messages , their futures get 0
+            Args : None
+            Returns : None
+        """
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.entries:
+            self.entries.popleft().resolve(0)
+        self.keys.clear()
+        self.bytes = 0
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def get_stats(self) -> dict:
+        """
+            Get the state of the queue | 获取队列统计
+            Args : None
+            Returns : dict
+                queued : int # entries waiting
+                queued_bytes : int
+                oldest_age : float # seconds the oldest queued entry waited
+                preview_only : bool # the client is downgraded
+                policy : str
+                sent_messages , sent_bytes , coalesced , dropped , frames_dropped , downgrades : int
+                max_messages , max_bytes : int # highest queue length and size
+                limits : dict
+        """
+        res = dict(self.stats)
+        res.update({
+            "queued" : len(self.entries),
+            "queued_bytes" : self.bytes,
+            "oldest_age" : round(time.monotonic() - self._oldest().time, 3) if self._oldest() is not None else 0.,
+            "preview_only" : self.preview_only,
+            "policy" : self.options["policy"],
+            "limits" : {k : self.options[k] for k in ("max_messages", "max_bytes", "max_age")},
+        })
+        return res
@@ -0,0 +1,106 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+import json
+import tornado.ioloop
+import tornado.web
+
+from utils.preview import preview_store, CONTENT_TYPES
+
+# Frame ids are never reused , so the previews never change
+PREVIEW_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+# #################################################################
+# Preview of the captured frames
+# #################################################################
+
+class BasePreviewHandler(tornado.web.RequestHandler):
+    """
+        Common part of the preview handlers , the ETag is known before rendering
+    """
+
+    def compute_etag(self):
+        return getattr(self, "_preview_etag", None)
+
+    def get_preview(self, frame_id : str):
+        """
+            Get the preview of a frame or answer 404
+        """
+        try:
+            return preview_store.get(frame_id)
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown or expired frame")
+
+    def not_modified(self, etag : str) -> bool:
+        """
+            Set the caching headers and check if the client already has the content
+        """
+        self._preview_etag = '"{}"'.format(etag)
+        self.set_header("Cache-Control", PREVIEW_CACHE_CONTROL)
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    async def write_image(self, func, *args) -> None:
+        """
+            Render in an executor , so big levels do not block the websocket clients
+        """
+        try:
+            data, fmt = await tornado.ioloop.IOLoop.current().run_in_executor(None, func, *args)
+        except KeyError:
+            raise tornado.web.HTTPError(404, "No such level or tile")
+        self.set_header("Content-Type", CONTENT_TYPES[fmt])
+        self.write(data)
+
+class PreviewInfoHandler(BasePreviewHandler):
+    """
+        Description of the pyramid of a frame
+        GET /preview/<id>/
+    """
+    def get(self, frame_id):
+        preview = self.get_preview(frame_id)
+        if self.not_modified(frame_id):
+            return
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(preview.get_info()))
+
+class PreviewLevelHandler(BasePreviewHandler):
+    """
+        Whole level of a frame , level 0 is the full resolution
+        GET /preview/<id>/<level>.(png|jpg)
+    """
+    async def get(self, frame_id, level, fmt):
+        preview = self.get_preview(frame_id)
+        if self.not_modified("{}-{}-{}".format(frame_id, level, fmt)):
+            return
+        await self.write_image(preview.get_level, int(level), fmt)
+
+class PreviewTileHandler(BasePreviewHandler):
+    """
+        Tile of a level for the zoomed views
+        GET /preview/<id>/<level>/<x>/<y>.(png|jpg)
+    """
+    async def get(self, frame_id, level, x, y, fmt):
+        preview = self.get_preview(frame_id)
+        if self.not_modified("{}-{}-{}-{}-{}".format(frame_id, level, x, y, fmt)):
+            return
+        await self.write_image(preview.get_tile, int(level), int(x), int(y), fmt)
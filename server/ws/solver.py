@@ -32,6 +32,7 @@ Boston, MA 02110-1301, USA.
 
 from utils.i18n import _
 from ..logging import logger
+from .commands import command
 
 class WSSolver(object):
     """
@@ -72,6 +73,7 @@ class WSSolver(object):
             Returns : None
         """
 
+    @command({"type" : {"type" : "string" , "required" : True , "choices" : ("astrometry","astap")}})
     async def init(self,params = {}) -> dict:
         """
             Init the solver , until the function is just used to change the command line format
@@ -81,6 +83,7 @@ class WSSolver(object):
             Returns : dict
         """
 
+    @command({"filename" : {"type" : "string" , "required" : True}})
     async def solve_image(self,params = {}) -> dict:
         """
             Solve the image and return the information
@@ -93,6 +96,7 @@ class WSSolver(object):
                 starindex : int # number of stars in the image
         """
 
+    @command({"path" : {"type" : "string"}})
     async def get_template(self,params = {}) -> dict:
         """
             Get all of the template in specified folder and return a list of the templates
@@ -103,6 +107,7 @@ class WSSolver(object):
                 list : list # list of templates
         """
 
+    @command({"path" : {"type" : "string"}})
     async def scan_template(self, params = {}) -> dict:
         """
             Scan all the templates available and return a list of the templates to download
@@ -112,6 +117,10 @@ class WSSolver(object):
             Returns : dict
         """
 
+    @command({
+        "name" : {"type" : "string" , "required" : True},
+        "folder" : {"type" : "string"},
+    })
     async def download_template(self,params = {}) -> dict:
         """
             Download the specified template to specified folder
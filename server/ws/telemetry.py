@@ -0,0 +1,290 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Push based device telemetry
+#
+# One sampler per device polls it at the fastest rate asked by its
+# subscribers , compares the values with the last sample and pushes
+# only the changes. Every subscriber has its own field set and max
+# rate , changes arriving faster are merged until it is due. The
+# samplers are shared by all the websockets , so N browser tabs on
+# the same device cost one poll.
+#
+# The values are the flattened info dict of polling() , nested keys
+# are joined with a dot like "current.ra".
+#
+# The pushes are queued without waiting for the client , a push still
+# queued for a slow client is merged with the next one , see
+# server.ws.outbound.
+#
+# #################################################################
+
+import asyncio
+import time
+
+import tornado.websocket
+
+from utils.i18n import _
+from ..logging import logger, return_success, return_error
+
+# Fastest and default rates in pushes per second
+TELEMETRY_MAX_RATE = 10.0
+TELEMETRY_DEFAULT_RATE = 1.0
+
+def flatten(info : dict, prefix : str = "") -> dict:
+    """
+        Flatten a nested info dict | 展开嵌套字典
+        Args :
+            info : dict
+            prefix : str
+        Returns : dict # {"current.ra" : value}
+    """
+    res = {}
+    for key, value in info.items():
+        key = prefix + str(key)
+        if isinstance(value, dict):
+            res.update(flatten(value, key + "."))
+        else:
+            res[key] = value
+    return res
+
+def _match(key : str, fields : tuple) -> bool:
+    """
+        Check if a flattened key is one of the fields , or below one of them
+    """
+    if not fields:
+        return True
+    for field in fields:
+        if key == field or key.startswith(field + "."):
+            return True
+    return False
+
+def merge_telemetry(old : dict, new : dict) -> dict:
+    """
+        Merge a telemetry push still queued with the next one
+        Args :
+            old : dict # queued push
+            new : dict # newer push of the same device
+        Returns : dict
+    """
+    changes = dict(old["params"]["changes"])
+    changes.update(new["params"]["changes"])
+    new["params"]["changes"] = changes
+    new["params"]["full"] = old["params"]["full"] or new["params"]["full"]
+    return new
+
+class Subscription(object):
+    """
+        One websocket subscribed to one device
+    """
+
+    def __init__(self, ws, device : str, wrapper, fields : tuple = None, rate : float = TELEMETRY_DEFAULT_RATE) -> None:
+        """
+            Args :
+                ws : MainWebsocketServer
+                device : str # like "telescope"
+                wrapper : WSCamera like object # device API and DeviceExecutor of this websocket
+                fields : tuple # keys or prefixes of keys , all if empty
+                rate : float # max pushes per second
+        """
+        self.ws = ws
+        self.device = device
+        self.wrapper = wrapper
+        self.fields = tuple(fields or ())
+        self.interval = 1. / min(max(rate or TELEMETRY_DEFAULT_RATE, 0.01), TELEMETRY_MAX_RATE)
+        self.last = 0.
+        self.pending = {}
+
+    def add_changes(self, changes : dict) -> None:
+        """
+            Merge the changes of a sample into the ones waiting to be sent
+        """
+        for key, value in changes.items():
+            if _match(key, self.fields):
+                self.pending[key] = value
+
+    async def flush(self, now : float, full : bool = False) -> None:
+        """
+            Push the waiting changes if the subscriber is due
+            Args :
+                now : float # loop time
+                full : bool # this is the first snapshot
+            Returns : None
+        """
+        if not self.pending or (not full and now - self.last < self.interval):
+            return
+        changes, self.pending = self.pending, {}
+        self.last = now
+        res = return_success(_("Device telemetry"), {
+            "event" : "telemetry",
+            "device" : self.device,
+            "full" : full,
+            "changes" : changes,
+            "time" : time.time(),
+        })
+        try:
+            self.ws.write_response(res, label = (self.device, "telemetry"),
+                                    key = ("telemetry", self.device), merge = merge_telemetry)
+        except tornado.websocket.WebSocketClosedError:
+            unsubscribe(self.ws)
+
+class TelemetrySampler(object):
+    """
+        Poll one device for all of its subscribers
+    """
+
+    def __init__(self, key : tuple) -> None:
+        """
+            Args :
+                key : tuple # see device_key()
+        """
+        self.key = key
+        # Wrapper of a live subscriber , its device is polled on its device thread
+        self.wrapper = None
+        self.values = {}
+        self.subscriptions = []
+        self.task = None
+
+    def interval(self) -> float:
+        """
+            Time between two samples , the fastest subscriber sets it
+        """
+        return min((sub.interval for sub in self.subscriptions), default=1. / TELEMETRY_DEFAULT_RATE)
+
+    async def add(self, sub : Subscription) -> None:
+        """
+            Add a subscriber , it gets the last values at once
+        """
+        # The newest websocket is the one surely alive
+        self.wrapper = sub.wrapper
+        self.subscriptions.append(sub)
+        sub.add_changes(self.values)
+        await sub.flush(asyncio.get_running_loop().time(), True)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+
+    def remove(self, sub : Subscription) -> None:
+        """
+            Remove a subscriber , the sampler stops with the last one
+        """
+        if sub in self.subscriptions:
+            self.subscriptions.remove(sub)
+        if self.subscriptions and self.wrapper is sub.wrapper:
+            self.wrapper = self.subscriptions[-1].wrapper
+        if not self.subscriptions:
+            if self.task is not None:
+                self.task.cancel()
+            _samplers.pop(self.key, None)
+
+    async def _run(self) -> None:
+        """
+            Sampling loop
+        """
+        loop = asyncio.get_running_loop()
+        first = not self.values
+        while self.subscriptions:
+            start = loop.time()
+            try:
+                # Queued on the device thread like the commands , the API is not thread safe
+                res = await self.wrapper.executor.call(self.wrapper.device.polling)
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                logger.warning(_("Failed to sample {} telemetry : {}").format(self.key[0], e))
+                res = None
+            if isinstance(res, dict) and res.get("status") == 0:
+                values = flatten(res["params"].get("info") or {})
+                changes = {k : v for k, v in values.items() if k not in self.values or self.values[k] != v}
+                self.values = values
+                now = loop.time()
+                for sub in list(self.subscriptions):
+                    sub.add_changes(changes)
+                    await sub.flush(now, first)
+                first = False
+            try:
+                await asyncio.sleep(max(0., self.interval() - (loop.time() - start)))
+            except asyncio.CancelledError:
+                return
+
+_samplers = {}
+
+def device_key(device : str, api) -> tuple:
+    """
+        Identify a device , the same ASCOM device opened by two websockets has the same key
+        Args :
+            device : str # like "telescope"
+            api : object # device API
+        Returns : tuple
+    """
+    remote = getattr(api, "device", None)
+    address = getattr(remote, "address", None)
+    if address is not None:
+        return (device, address, getattr(remote, "device_number", None))
+    return (device, id(api))
+
+async def subscribe(ws, device : str, wrapper, params : dict) -> dict:
+    """
+        Subscribe a websocket to the telemetry of a device | 订阅设备遥测
+        Args :
+            ws : MainWebsocketServer
+            device : str # like "telescope"
+            wrapper : WSCamera like object # with device , the API with a polling() method , and executor
+            params : dict
+                fields : list # keys like "current.ra" or prefixes like "current" , all if empty
+                max_rate : float # max pushes per second , default 1
+        Returns : dict
+        NOTE : A new subscription of the same websocket and device replaces the old one.
+                The changes are pushed as "telemetry" events , the first one with full = True
+    """
+    api = wrapper.device
+    if api is None or not getattr(api.info, "_is_connected", False):
+        return return_error(_("Device is not connected"))
+    unsubscribe(ws, device)
+    key = device_key(device, api)
+    sampler = _samplers.get(key)
+    if sampler is None:
+        sampler = _samplers[key] = TelemetrySampler(key)
+    sub = Subscription(ws, device, wrapper, params.get("fields"), params.get("max_rate"))
+    await sampler.add(sub)
+    logger.debug(_("Subscribed to {} telemetry , {} subscribers").format(device, len(sampler.subscriptions)))
+    return return_success(_("Subscribed to device telemetry"), {
+        "device" : device,
+        "fields" : list(sub.fields),
+        "max_rate" : round(1. / sub.interval, 3),
+        "subscribers" : len(sampler.subscriptions),
+    })
+
+def unsubscribe(ws, device : str = None) -> dict:
+    """
+        Remove the subscriptions of a websocket | 取消订阅
+        Args :
+            ws : MainWebsocketServer
+            device : str # only this device , all if None
+        Returns : dict
+    """
+    count = 0
+    for sampler in list(_samplers.values()):
+        for sub in list(sampler.subscriptions):
+            if sub.ws is ws and (device is None or sub.device == device):
+                sampler.remove(sub)
+                count += 1
+    return return_success(_("Unsubscribed from device telemetry"), {"removed" : count})
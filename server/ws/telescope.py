@@ -20,6 +20,8 @@ Boston, MA 02110-1301, USA.
 
 from utils.i18n import _
 from ..logging import logger , return_error,return_success,return_warning
+from .executor import DeviceExecutor,DEVICE_CONNECT_TIMEOUT
+from .commands import command,CONNECT_SCHEMA
 
 class WSTelescope(object):
     """
@@ -35,6 +37,8 @@ class WSTelescope(object):
         self.device = None
         self.ws = ws
         self.thread = None
+        # Every blocking call of the telescope runs on this thread
+        self.executor = DeviceExecutor("telescope")
 
     def __del__(self) -> None:
         """
@@ -51,6 +55,7 @@ class WSTelescope(object):
         """
         return self.__class__.__name__
 
+    @command(CONNECT_SCHEMA)
     async def connect(self , params = {}) -> None:
         """
             Async connect to the telescope 
@@ -65,15 +70,11 @@ class WSTelescope(object):
         """
         if self.device is not None:
             logger.info(_("Disconnecting from existing telescope ..."))
-            self.disconnect()
+            await self.disconnect()
 
+        # type and device_name are checked by the schema
         _type = params.get('type')
-        _device_name = params.get('device_name')
 
-        if _type is None or _device_name is None:
-            logger.error(_("Type or device name must be specified"))
-            return return_error(_("Type or device name must be specified"))
-        
         if _type == "indi":
             """from server.api.indi.telescope import INDITelescopeAPI
             self.device = INDITelescopeAPI()"""
@@ -84,8 +85,9 @@ class WSTelescope(object):
             logger.error(_("Unknown device type : {}").format(_type))
             return return_error(_("Unknown device type"))
 
-        return self.device.connect(params=params)
+        return await self.executor.call(self.device.connect, params, timeout=DEVICE_CONNECT_TIMEOUT)
 
+    @command()
     async def disconnect(self,params = {}) -> dict:
         """
             Async disconnect from the device
@@ -96,8 +98,9 @@ class WSTelescope(object):
             logger.warning(_("Telescope is not connected , please do not execute disconnect command"))
             return return_error(_("Telescope is not connected"))
         
-        return self.device.disconnect()
+        return await self.executor.call(self.device.disconnect)
 
+    @command()
     async def reconnect(self,params = {}) -> dict:
         """
             Async reconnect to the device
@@ -110,8 +113,9 @@ class WSTelescope(object):
             logger.warning(_("Telescope is not connected , please do not execute reconnect command"))
             return return_error(_("Telescope is not connected"))
 
-        return self.device.reconnect()
+        return await self.executor.call(self.device.reconnect)
 
+    @command()
     async def scanning(self,params = {}) -> dict:
         """
             Async scanning all of the devices available
@@ -123,8 +127,9 @@ class WSTelescope(object):
             logger.warning(_("Telescope had already been connected , please do not execute scanning command"))
             return return_error(_("Telescope has already been connected"))
 
-        return self.device.scanning()
+        return await self.executor.call(self.device.scanning)
 
+    @command()
     async def polling(self,params = {}) -> dict:
         """
             Async polling method to get the newest telescope information
@@ -132,11 +137,11 @@ class WSTelescope(object):
             Returns : dict
                 info : dict # usually generated from get_dict() function
         """
-        if self.device is not None or self.device.info._is_connected:
+        if self.device is None or not self.device.info._is_connected:
             logger.warning(_("Telescope is not connected , please do not execute polling command"))
             return return_error(_("Telescope is not connected"))
 
-        return self.device.polling()
+        return await self.executor.call(self.device.polling)
 
     # #############################################################
     #
@@ -148,6 +153,13 @@ class WSTelescope(object):
     # Goto
     # #############################################################
 
+    @command({
+        "ra" : {"type" : ("number","string")},
+        "dec" : {"type" : ("number","string")},
+        "az" : {"type" : ("number","string")},
+        "alt" : {"type" : ("number","string")},
+        "j2000" : {"type" : "boolean"},
+    })
     async def goto(self,params = {}) -> dict:
         """
             Async goto operation to let the telescope target at a specific point\n
@@ -167,6 +179,7 @@ class WSTelescope(object):
                     format of J2000 , if true , they need to be converted before send to telescope
         """
 
+    @command()
     async def abort_goto(self,params = {}) -> dict:
         """
             Async abort goto operation
@@ -175,6 +188,7 @@ class WSTelescope(object):
             NOTE : This function must be called before shutting down the main server
         """
 
+    @command()
     async def get_goto_status(self,params = {}) -> dict:
         """
             Async get the status of the goto operation
@@ -185,6 +199,7 @@ class WSTelescope(object):
                 dec : float # current dec
         """
 
+    @command()
     async def get_goto_result(self,params = {}) -> dict:
         """
             Async get the result of the goto operation
@@ -198,6 +213,7 @@ class WSTelescope(object):
     # Park
     # #############################################################
 
+    @command()
     async def park(self,params = {}) -> dict:
         """
             Async park the telescope and after this operation , we cannot control the telescope
@@ -206,6 +222,7 @@ class WSTelescope(object):
             Returns : dict
         """
 
+    @command()
     async def unpark(self,params = {}) -> dict:
         """
             Async unpark the parked telescope
@@ -214,6 +231,7 @@ class WSTelescope(object):
             NOTE : If a telescope is not parked , please do not execute this function
         """
 
+    @command()
     async def get_park_position(self,params = {}) -> dict:
         """
             Async get the position of the park operation
@@ -223,6 +241,10 @@ class WSTelescope(object):
                 dec : str # dec of the parking position
         """
 
+    @command({
+        "ra" : {"type" : ("number","string") , "required" : True},
+        "dec" : {"type" : ("number","string") , "required" : True},
+    })
     async def set_park_position(self,params = {}) -> dict:
         """
             Async set the position of the park operation
@@ -236,6 +258,7 @@ class WSTelescope(object):
     # Home
     # #############################################################
 
+    @command()
     async def home(self,params = {}) -> dict:
         """
             Async Let the telescope slew to home position
@@ -243,6 +266,7 @@ class WSTelescope(object):
             Returns : dict
         """
 
+    @command()
     async def get_home_position(self,params = {}) -> dict:
         """
             Async get the home position
@@ -256,6 +280,7 @@ class WSTelescope(object):
     # Track
     # #############################################################
 
+    @command()
     async def track(self,params = {}) -> dict:
         """
             Async start tracking mode without any parameters
@@ -263,6 +288,7 @@ class WSTelescope(object):
             Returns : dict
         """
 
+    @command()
     async def abort_track(self,params = {}) -> dict:
         """
             Async abort the tracking
@@ -270,6 +296,7 @@ class WSTelescope(object):
             Returns : dict
         """
 
+    @command()
     async def get_track_mode(self,params = {}) -> dict:
         """
             Async get the track mode of the current telescope
@@ -278,6 +305,7 @@ class WSTelescope(object):
                 mode : str
         """
 
+    @command()
     async def get_track_rate(self,params = {}) -> dict:
         """
             Async get the track rate of the current telescope
@@ -287,6 +315,7 @@ class WSTelescope(object):
                 def_rate : float
         """
 
+    @command({"mode" : {"type" : "string" , "required" : True}})
     async def set_track_mode(self,params = {}) -> dict:
         """
             Async set the track mode of the current telescope
@@ -295,6 +324,10 @@ class WSTelescope(object):
             Returns : dict
         """
 
+    @command({
+        "ra_rate" : {"type" : "number"},
+        "dec_rate" : {"type" : "number"},
+    })
     async def set_track_rate(self,params = {}) -> dict:
         """
             Async set the track rate of the current telescope
@@ -307,6 +340,7 @@ class WSTelescope(object):
     # GPS Location
     # #############################################################
 
+    @command()
     async def get_gps_location(self,params = {}) -> dict:
         """
             Async get GPS location
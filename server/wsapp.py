@@ -19,8 +19,8 @@ Boston, MA 02110-1301, USA.
 """
 
 import asyncio
-import json
 import os
+import time
 
 # Tornoda server , provide websocket services
 import tornado.web
@@ -29,18 +29,50 @@ import tornado.options
 import tornado.auth
 
 from utils.i18n import _
-from .logging import logger,return_error
+from .logging import logger,return_error,return_success,return_warning
 
 from .ws.camera import WSCamera
 from .ws.telescope import WSTelescope
 from .ws.focuser import WSFocuser
 from .ws.filterwheel import WSFilterwheel
 from .ws.solver import WSSolver
+from .ws import telemetry
+from .ws.codec import CodecWebSocketMixin
+from .ws.commands import CommandTable
+from .ws.metrics import metrics
+
+# Devices with a blocking API , an executor and telemetry
+DEVICES = ("camera","telescope","focuser","filterwheel")
+
+# Command table , built once below the server class
+COMMANDS = CommandTable()
+COMMANDS.register_wrapper("camera", WSCamera)
+COMMANDS.register_wrapper("telescope", WSTelescope)
+COMMANDS.register_wrapper("focuser", WSFocuser)
+COMMANDS.register_wrapper("filterwheel", WSFilterwheel)
+COMMANDS.register_wrapper("solver", WSSolver)
+# Old clients spell it this way
+COMMANDS.add_alias("sovler", "solver")
+
+def command_key(device : str, event : str) -> tuple:
+    """
+        Metrics key of a message , the names sent by the clients are only used if registered
+        Args :
+            device : str
+            event : str
+        Returns : tuple # (device , event) , "unknown" for the unregistered parts
+    """
+    name = COMMANDS.resolve(device) if isinstance(device,str) else None
+    if name is None:
+        return ("unknown","unknown")
+    return (name, event if COMMANDS.get(name, event) is not None else "unknown")
 
-class MainWebsocketServer(tornado.websocket.WebSocketHandler):
+class MainWebsocketServer(CodecWebSocketMixin, tornado.websocket.WebSocketHandler):
     """
         Main websocket server to process all of the commands
         url : /device
+        NOTE : The encoding of the messages (json , msgpack or cbor) is negotiated at the handshake,
+                see server.ws.codec
     """
 
     def __init__(self, application, request, **kwargs) -> None:
@@ -56,8 +88,19 @@ class MainWebsocketServer(tornado.websocket.WebSocketHandler):
         self.telescope = WSTelescope(self)
         self.focuser = WSFocuser(self)
         self.filterwheel = WSFilterwheel(self)
-        self.sovler = WSSolver(self)
+        self.solver = WSSolver(self)
         self.guider = None
+        self.wrappers = {
+            "camera" : self.camera,
+            "telescope" : self.telescope,
+            "focuser" : self.focuser,
+            "filterwheel" : self.filterwheel,
+            "solver" : self.solver,
+        }
+        # Commands running in their own task , see on_message()
+        self.tasks = set()
+        # Per device locks , see run_command()
+        self.locks = {}
 
     def __del__(self) -> None:
         """
@@ -80,7 +123,10 @@ class MainWebsocketServer(tornado.websocket.WebSocketHandler):
             Args : None
             Returns : None
         """
-        logger.debug(_("Opening websocket connection with the client"))
+        self.select_codec()
+        metrics.connection_opened()
+        metrics.start_lag_monitor()
+        logger.debug(_("Opening websocket connection with the client , encoding : {}").format(self.codec.name))
 
     def on_close(self, code = None, reason = None) -> None:
         """
@@ -91,6 +137,14 @@ class MainWebsocketServer(tornado.websocket.WebSocketHandler):
             Returns : None
         """
         logger.debug(_("Closing websocket connection with status code : {} and reason : {}").format(code,reason))
+        for task in list(self.tasks):
+            task.cancel()
+        telemetry.unsubscribe(self)
+        self.close_outbound()
+        metrics.connection_closed()
+        # The cancelled tasks dropped their queued device calls
+        for wrapper in (self.camera, self.telescope, self.focuser, self.filterwheel):
+            wrapper.executor.shutdown()
 
     def on_ping(self, data: bytes) -> None:
         """
@@ -103,7 +157,7 @@ class MainWebsocketServer(tornado.websocket.WebSocketHandler):
     async def on_message(self, message) -> None:
         """
             Event handler for message from the client and need to use asynchronously\n
-            Args : message : str
+            Args : message : str or bytes # text messages are JSON , binary ones use the negotiated encoding
             Returns : None
 
             Message Example: following format is a dictionary
@@ -111,6 +165,7 @@ class MainWebsocketServer(tornado.websocket.WebSocketHandler):
                 event : str # Like "connect" or "disconnect"
                 params : dict # all of the parameters should be put inside the dict
                     info : dict # this is a example , you can put everything
+                id : any # optional , copied into the response
 
                 {
                     "device" : "camera",
@@ -137,90 +192,300 @@ class MainWebsocketServer(tornado.websocket.WebSocketHandler):
                         "info" : camera information
                     }
                 }
+
+            A list of commands , or {"batch" : [...] , "ordered" : true} , is executed by
+            run_batch() and answered with one response
         """
         # Parser the message
         command = None
-        if isinstance(message,dict):
-            try:
-                command = json.loads(message)
-            except json.JSONDecodeError as e:
-                logger.error(_("Failed to parse message to a dictionary : {}").format(e))
-                await self.write_message(json.dumps(return_error(_("Failed to parse message to a dictionary"))))
-                return
-        elif isinstance(message,list):
-            # TODO : will we add a multi-command message , just like a sequence
-            pass
-        # Run the command and wait for the response
         try:
-            res = await self.run_command(
-                command["device"],
-                command["event"],
-                command["params"],
-            )
-        except KeyError as e:
-            logger.error(_("Failed to execute command : {}").format(e))
-            await self.write_message({"status": 1, "message": "Failed to execute command"})
+            command = self.decode_message(message)
+        except ValueError as e:
+            logger.error(_("Failed to parse message to a dictionary : {}").format(e))
+            await self.write_encoded(return_error(_("Failed to parse message to a dictionary")))
+            return
+        # Every message runs in its own task , so the next message is read at once and the
+        # responses are written as the commands complete , not in the order of the requests
+        task = asyncio.ensure_future(self.handle_message(command, len(message)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_message(self, command, size : int = 0) -> None:
+        """
+            Execute a parsed message and write its response\n
+            Args :
+                command : dict or list # see on_message()
+                size : int # length of the raw message , for the metrics
+            Returns : None
+            NOTE : The "id" given by the client is copied into the response , so it can match
+                    the responses which may come back in any order
+        """
+        request_id = command.get("id") if isinstance(command,dict) else None
+        if isinstance(command,list) or (isinstance(command,dict) and "batch" in command):
+            key = ("batch","batch")
+            start = time.monotonic()
+            res = await self.run_batch(command)
+            metrics.observe_command(*key, time.monotonic() - start, res.get("status") == 1)
+        else:
+            key = command_key(command.get("device"), command.get("event")) if isinstance(command,dict) else ("unknown","unknown")
+            # Run the command and wait for the response
+            try:
+                res = await self.run_command(
+                    command["device"],
+                    command["event"],
+                    command.get("params"),
+                )
+            except (KeyError,TypeError) as e:
+                logger.error(_("Failed to execute command : {}").format(e))
+                res = return_error(_("Failed to execute command"))
+        if request_id is not None:
+            res = dict(res)
+            res["id"] = request_id
         # Return the response to client
-        await self.write_message(json.dumps(res))
+        metrics.observe_payload(key[0], key[1], received = size)
+        try:
+            await self.write_response(res, label = key)
+        except tornado.websocket.WebSocketClosedError:
+            logger.debug(_("Websocket closed , response of request {} is dropped").format(request_id))
+
+    def write_response(self, res : dict, label : tuple = None, **kwargs) -> asyncio.Future:
+        """
+            Queue the response of a command for the client\n
+            Args :
+                res : dict # response returned by the device
+                label : tuple # (device , event) of the metrics
+                **kwargs : key , merge , preview , see OutboundQueue.put()
+            Returns : Future # bytes written , frames included , once sent . 0 if dropped
+            NOTE : If the response carries a binary frame (params.frame),
+                    the JSON envelope is sent first and the frame follows as a binary message.
+                    The envelope tells the client the id and size of the frame to expect.
+                    With a binary encoding the frame stays in params.frame as raw bytes.
+                    The response and its frames are one entry of the outbound queue , a slow
+                    client may get it without the frames , see server.ws.outbound.
+                    Raise WebSocketClosedError if the connection is closed.
+        """
+        frames = []
+        if not self.codec.binary and isinstance(res,dict) and isinstance(res.get("params"),dict):
+            # Results of a batch may carry their own frames , sent in the order of the batch
+            for _res in [res] + (res["params"].get("batch") or []):
+                if not isinstance(_res.get("params"),dict):
+                    continue
+                frame = _res["params"].pop("frame",None)
+                if frame is not None:
+                    _res["params"]["binary"] = True
+                    _res["params"]["size"] = len(frame)
+                    frames.append(frame)
+        return self.write_encoded(res, frames, label = label, **kwargs)
         
+    async def run_batch(self, batch) -> dict:
+        """
+            Execute several commands sent in one message and return one response\n
+            Args :
+                batch : list or dict
+                    [{"device" , "event" , "params" , "id"}] # independent commands
+                    {"batch" : [...] , "ordered" : bool , "stop_on_error" : bool}
+            Returns : dict
+                status : int # 0 if no command failed (status 1) , else 2
+                message : str
+                params : dict
+                    batch : list # one result per command , in the order of the request
+                        index : int
+                        id : any # given by the client , to match the results
+                        device , event : str
+                        status , message , params : the response of the command
+                        elapsed : float # seconds spent in the command
+                    elapsed : float # seconds for the whole batch
+            NOTE : Commands of different devices run concurrently , the commands of one device
+                    always run one after another in the given order. With "ordered" the whole
+                    batch runs in order , and "stop_on_error" skips the commands after a failure.
+                    Binary frames of the results are sent after the response , in the order of
+                    the batch , each result tells its size.
+        """
+        ordered = False
+        stop_on_error = False
+        if isinstance(batch,dict):
+            ordered = bool(batch.get("ordered"))
+            stop_on_error = bool(batch.get("stop_on_error"))
+            batch = batch.get("batch")
+        if not isinstance(batch,list):
+            return return_error(_("Batch must be a list of commands"))
+        start = time.monotonic()
+        results = [None] * len(batch)
+
+        async def execute(index : int, command) -> bool:
+            _start = time.monotonic()
+            try:
+                res = await self.run_command(command["device"], command["event"], command.get("params") or {})
+            except (KeyError,TypeError) as e:
+                logger.error(_("Failed to execute command : {}").format(e))
+                res = return_error(_("Failed to execute command"),{"error" : e})
+            res = dict(res)
+            res.update({
+                "index" : index,
+                "id" : command.get("id") if isinstance(command,dict) else None,
+                "device" : command.get("device") if isinstance(command,dict) else None,
+                "event" : command.get("event") if isinstance(command,dict) else None,
+                "elapsed" : round(time.monotonic() - _start, 4),
+            })
+            results[index] = res
+            return res.get("status") != 1
+
+        async def execute_in_order(indexes : list) -> None:
+            for i, index in enumerate(indexes):
+                if not await execute(index, batch[index]) and stop_on_error:
+                    for skipped in indexes[i + 1:]:
+                        results[skipped] = return_warning(_("Skipped after a failed command"),{})
+                        results[skipped].update({"index" : skipped, "elapsed" : 0,
+                            "id" : batch[skipped].get("id") if isinstance(batch[skipped],dict) else None})
+                    return
+
+        if ordered:
+            await execute_in_order(list(range(len(batch))))
+        else:
+            groups = {}
+            for index, command in enumerate(batch):
+                device = command.get("device") if isinstance(command,dict) else None
+                groups.setdefault(device, []).append(index)
+            await asyncio.gather(*(execute_in_order(indexes) for indexes in groups.values()))
+
+        # Warnings , like the skipped commands , are not failures
+        failed = sum(1 for res in results if res.get("status") == 1)
+        params = {"batch" : results, "elapsed" : round(time.monotonic() - start, 4)}
+        if failed:
+            return return_warning(_("{} of {} commands failed").format(failed, len(results)), params)
+        return return_success(_("Batch executed successfully"), params)
+
+    def get_wrapper(self, device : str):
+        """
+            Get the websocket wrapper of a device\n
+            Args :
+                device : str # "camera" , "telescope" , "focuser" , "filterwheel" or "solver"
+            Returns : WSCamera like object , None if unknown
+        """
+        return self.wrappers.get(device)
+
+    async def get_call_stats(self, device : str, params : dict) -> dict:
+        """
+            Get the metrics of the blocking calls of a device\n
+            Args :
+                device : str # one of DEVICES
+                params : dict # not used
+            Returns : dict # see DeviceExecutor.get_stats()
+        """
+        return return_success(_("Get device call statistics successfully"), self.get_wrapper(device).executor.get_stats())
+
+    async def get_queue_stats(self, device : str, params : dict) -> dict:
+        """
+            Get the state of the outbound queue of this connection\n
+            Args :
+                device : str # "server"
+                params : dict # not used
+            Returns : dict # see OutboundQueue.get_stats()
+        """
+        return return_success(_("Get outbound queue statistics successfully"), self.outbound.get_stats())
+
+    async def subscribe(self, device : str, params : dict) -> dict:
+        """
+            Subscribe to the telemetry of a device\n
+            Args :
+                device : str # one of DEVICES
+                params : dict
+                    fields : list # keys of the polling() info like "current.ra" , all if empty
+                    max_rate : float # max pushes per second
+            Returns : dict
+            NOTE : See server.ws.telemetry , the changes are pushed as "telemetry" events
+        """
+        return await telemetry.subscribe(self, device, self.get_wrapper(device), params)
+
+    async def unsubscribe(self, device : str, params : dict) -> dict:
+        """
+            Unsubscribe from the telemetry of a device\n
+            Args :
+                device : str # one of DEVICES
+                params : dict # not used
+            Returns : dict
+        """
+        return telemetry.unsubscribe(self, device)
+
+    async def list_commands(self, device : str, params : dict) -> dict:
+        """
+            Describe the available commands , with their parameters\n
+            Args :
+                device : str # "server" for all of the devices
+                params : dict
+                    device : str # only this device , with device "server"
+            Returns : dict
+                commands : list # device , event , description , params , locked
+        """
+        if device == "server":
+            device = COMMANDS.resolve(params.get("device")) if params.get("device") else None
+        return return_success(_("List commands successfully"), {"commands" : COMMANDS.list_commands(device)})
+
     async def run_command(self, device : str, command : str , params : dict) -> dict:
         """
             Execute the command asynchronously and return the response\n
             Args : 
-                device : str # device type like "cameras" or "telescope"
+                device : str # device type like "camera" or "telescope"
                 command : str # command to execute
-                params : dict # parameters
+                params : dict # parameters , checked with the schema of the command
             Returns : dict
                 status : int # status code
                 message : str # message
-                params : dict # parameters to return to client
+                params : dict # parameters to return to client , device , event and error if failed
+            NOTE : The commands are registered in COMMANDS , see server.ws.commands
+                    A command returning something else than a dict , like an error message
+                    of a device , is answered with an error
         """
-        _command = None
-        if device == "camera":
-            # Pay attention to if the camera command is available , the following devices are the same
-            try:
-                _command = getattr(self.camera,command)
-            except AttributeError as e:
-                logger.error(_("Camera command not available : {}").format(e))
-                return return_error(_("Camera command not available"),{"error":e})
-        elif device == "telescope":
-            try:
-                _command = getattr(self.telescope,command)
-            except AttributeError as e:
-                logger.error(_("Telescope command not available : {}").format(e))
-                return return_error(_("Telescope command not available"),{"error":e})
-        elif device == "focuser":
-            try:
-                _command = getattr(self.focuser,command)
-            except AttributeError as e:
-                logger.error(_("Focuser command not available : {}").format(e))
-                return return_error(_("Focuser command not available"),{"error":e})
-        elif device == "filterwheel":
-            try:
-                _command = getattr(self.filterwheel,command)
-            except AttributeError as e:
-                logger.error(_("Filterwheel command not available : {}").format(e))
-                return return_error(_("Filterwheel command not available"),{"error":e})
-        elif device == "guider":
-            pass
-        elif device == "sovler":
-            pass
-        else:
-            logger.error(_("Unknown device type specified : {}").format(device))
-            return return_error(_("Unknown device type"))
+        start = time.monotonic()
+        res = await self.execute_command(device, command, params)
+        if not isinstance(res,dict):
+            logger.error(_("Command {} {} returned an invalid response : {}").format(device, command, res))
+            res = return_error(str(res) if res is not None else _("Invalid response of the command"),
+                                {"device" : device, "event" : command})
+        metrics.observe_command(*command_key(device, command), time.monotonic() - start, res.get("status") == 1)
+        return res
 
-        res = {
-            "status": 0,
-            "message": "",
-            "params": {}
-        }
+    async def execute_command(self, device : str, command : str , params : dict) -> dict:
+        """
+            Look up , check and execute a command , see run_command()
+        """
+        name = COMMANDS.resolve(device)
+        if name is None:
+            logger.error(_("Unknown device type specified : {}").format(device))
+            return return_error(_("Unknown device type"),{"device" : device, "event" : command})
+        spec = COMMANDS.get(name, command)
+        if spec is None:
+            logger.error(_("Command not available : {} {}").format(device, command))
+            return return_error(_("Command not available"),{"device" : device, "event" : command})
+        params, error = spec.validate(params)
+        if error is not None:
+            logger.error(_("Invalid parameters of {} {} : {}").format(device, command, error))
+            return return_error(_("Invalid parameters"),{"device" : device, "event" : command, "error" : error})
+
+        target, args = (self, (name, params)) if spec.generic else (self.wrappers[name], (params,))
         try:
-            res = await _command(params)
+            if spec.locked:
+                # Commands changing the state of one device run one at a time
+                async with self.locks.setdefault(name, asyncio.Lock()):
+                    res = await spec.func(target, *args)
+            else:
+                res = await spec.func(target, *args)
         except Exception as e:
             logger.error(_("Error executing command : {}").format(e))
-            return return_error(_("Error executing command"),{"error":e})
+            return return_error(_("Error executing command"),{"device" : device, "event" : command, "error" : str(e)})
         return res
 
+COMMANDS.register_generic("subscribe", MainWebsocketServer.subscribe, {
+    "fields" : {"type" : "array"},
+    "max_rate" : {"type" : "number" , "min" : 0},
+}, devices = DEVICES)
+COMMANDS.register_generic("unsubscribe", MainWebsocketServer.unsubscribe, devices = DEVICES)
+COMMANDS.register_generic("get_call_stats", MainWebsocketServer.get_call_stats, devices = DEVICES)
+COMMANDS.register_generic("get_queue_stats", MainWebsocketServer.get_queue_stats, devices = ("server",))
+COMMANDS.register_generic("list_commands", MainWebsocketServer.list_commands, {
+    "device" : {"type" : "string"},
+}, devices = DEVICES + ("solver","server"))
+
 # #################################################################
 # Login Module
 # #################################################################
@@ -292,6 +557,11 @@ from .webserver import NoVNCHtml,BugReportHtml
 from .webserver import DesktopBrowserHtml,DesktopStoreHtml,DesktopSystemHtml
 from .ws.indi import (INDIClientWebSocket,INDIDebugWebSocket,INDIDebugHtml,
                         INDIFIFODeviceStartStop,INDIFIFOGetAllDevice)
+from .ws.preview import PreviewInfoHandler,PreviewLevelHandler,PreviewTileHandler
+from utils.preview import preview_store
+import server.config as c
+from .ws.metrics import MetricsHandler,PrometheusMetricsHandler
+from .ws.blobs import BlobDownloadHandler
 
 def make_server() -> tornado.web.Application:
     """
@@ -300,6 +570,8 @@ def make_server() -> tornado.web.Application:
         Returns : tornado.web.Application
     """
 
+    preview_store.configure(c.config.get("preview"))
+
     return tornado.web.Application([
             (r"/", IndexHtml),
             (r"/client",ClientHtml),
@@ -323,6 +595,15 @@ def make_server() -> tornado.web.Application:
             (r"/ws/indi_client/", INDIClientWebSocket),
             (r"/FIFO/([^/]+)/([^/]+)/([^/]+)/", INDIFIFODeviceStartStop),
             (r"/get/all/devices/", INDIFIFOGetAllDevice),
+
+            (r"/preview/([0-9a-f]+)/", PreviewInfoHandler),
+            (r"/preview/([0-9a-f]+)/([0-9]+)\.(png|jpg)", PreviewLevelHandler),
+            (r"/preview/([0-9a-f]+)/([0-9]+)/([0-9]+)/([0-9]+)\.(png|jpg)", PreviewTileHandler),
+
+            (r"/blob/([0-9a-f]+)", BlobDownloadHandler, {"path" : "/"}),
+
+            (r"/system/api/metrics", MetricsHandler),
+            (r"/system/api/metrics/prometheus", PrometheusMetricsHandler),
         ],
         template_path=os.path.join(
             os.getcwd(),"client","templates"
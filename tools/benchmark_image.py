@@ -0,0 +1,151 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Benchmark the image filters in utils/image.py against the old
+# per-pixel loop versions they replaced.
+#
+# Usage : python tools/benchmark_image.py [--sizes 1k 4k full] [--legacy-max 256]
+#
+# The old versions need minutes to hours on big frames , so they are
+# timed on a crop of at most --legacy-max pixels per side and scaled by
+# the number of pixels , those numbers are marked with "~".
+#
+# #################################################################
+
+import argparse
+import os
+import sys
+import time
+from random import random
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import image
+
+SIZES = {
+    "1k" : (1024, 1024),
+    "4k" : (2160, 3840),
+    "full" : (4176, 6248),   # 26 MP APS-C sensor
+}
+
+# #################################################################
+# Old versions , same algorithms as before the vectorized rewrite
+# #################################################################
+
+def legacy_medianfliter(img : np.ndarray) -> np.ndarray:
+    output1 = np.zeros(img.shape, img.dtype)
+    for i in range(1, img.shape[0]-1):
+        for j in range(1, img.shape[1]-1):
+            value1 = [img[i-1][j-1], img[i-1][j], img[i-1][j+1], img[i][j-1], img[i][j], img[i][j+1], img[i+1][j-1], img[i+1][j], img[i+1][j+1]]
+            output1[i][j] = np.sort(value1)[4]
+    return output1
+
+def legacy_meanflite(img : np.ndarray) -> np.ndarray:
+    window = np.ones((3, 3)) / 3 ** 2
+    output1 = np.zeros(img.shape, img.dtype)
+    for i in range(1, img.shape[0] - 1):
+        for j in range(1, img.shape[1] - 1):
+            output1[i][j] = np.sum(img[i-1:i+2, j-1:j+2] * window)
+    return output1
+
+def legacy_gaussianfilter(img : np.ndarray, sigma = 1.5, kernel_size = 3) -> np.ndarray:
+    h, w = img.shape
+    padding = kernel_size // 2
+    out = np.zeros((h + 2*padding, w + 2*padding), dtype=np.float64)
+    out[padding:padding+h, padding:padding+w] = img
+    kernel = np.zeros((kernel_size, kernel_size), dtype=np.float64)
+    for x in range(-padding, -padding+kernel_size):
+        for y in range(-padding, -padding+kernel_size):
+            kernel[y+padding, x+padding] = np.exp(-(x**2+y**2)/(2*(sigma**2)))
+    kernel /= kernel.sum()
+    tmp = out.copy()
+    for y in range(h):
+        for x in range(w):
+            out[padding+y, padding+x] = np.sum(kernel*tmp[y:y+kernel_size, x:x+kernel_size])
+    return out[padding:padding+h, padding:padding+w].astype(img.dtype)
+
+def legacy_add_salt_pepper_noise(img : np.ndarray, threshold = 0.05) -> np.ndarray:
+    output = np.zeros(img.shape, img.dtype)
+    for i in range(img.shape[0]):
+        for j in range(img.shape[1]):
+            randomnum = random()
+            if randomnum < threshold:
+                output[i][j] = 0
+            elif randomnum > 1 - threshold:
+                output[i][j] = 65535
+            else:
+                output[i][j] = img[i][j]
+    return output
+
+def legacy_add_gaussian_noise(img : np.ndarray, mean = 0, var = 0.001) -> np.ndarray:
+    output = img / 65535 + np.random.normal(mean, var ** 0.5, img.shape)
+    output_handle = np.zeros(output.shape)
+    for i in range(output.shape[0]):
+        for j in range(output.shape[1]):
+            if output[i][j] < 0:
+                output_handle[i][j] = 0
+            elif output[i][j] > 1.0:
+                output_handle[i][j] = 1.0
+            else:
+                output_handle[i][j] = output[i][j]
+    return np.uint16(output_handle * 65535)
+
+CASES = [
+    ("medianfliter 3x3", legacy_medianfliter, lambda img : image.medianfliter(img, 3)),
+    ("meanflite 3x3", legacy_meanflite, lambda img : image.meanflite(img, 3)),
+    ("gaussianfilter 3x3", legacy_gaussianfilter, lambda img : image.gaussianfilter(img, 1.5, 3)),
+    ("add_salt_pepper_noise", legacy_add_salt_pepper_noise, lambda img : image.add_salt_pepper_noise(img, 0.05)),
+    ("add_gaussian_noise", legacy_add_gaussian_noise, lambda img : image.add_gaussian_noise(img, 0, 0.001)),
+]
+
+def timeit(func, img : np.ndarray) -> float:
+    """
+        Time one call of the function in seconds
+    """
+    start = time.perf_counter()
+    func(img)
+    return time.perf_counter() - start
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark utils/image.py filters")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES.keys()), choices=list(SIZES.keys()))
+    parser.add_argument("--legacy-max", type=int, default=256,
+                        help="Largest crop side the old loop versions are timed on")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("{:<24}{:>8}{:>14}{:>14}{:>10}".format("case", "size", "old (s)", "new (s)", "speedup"))
+    for size in args.sizes:
+        h, w = SIZES[size]
+        img = rng.integers(0, 65535, (h, w), dtype=np.uint16)
+        crop = img[:min(h, args.legacy_max), :min(w, args.legacy_max)]
+        ratio = img.size / crop.size
+        for name, old, new in CASES:
+            t_old = timeit(old, crop) * ratio
+            t_new = timeit(new, img)
+            mark = "~" if ratio > 1 else " "
+            print("{:<24}{:>8}{:>13.3f}{}{:>14.3f}{:>9.0f}x".format(name, size, t_old, mark, t_new, t_old / t_new))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Files offered to the clients
+#
+# A saved frame is registered here and gets an id , the clients can
+# then download it without knowing the path on the server :
+#   - HTTP : GET /blob/<id> , Range requests are supported
+#   - websocket : stream_file() , a "File Stream" signal followed by
+#     the file as binary chunks and a "File Stream End" signal
+#
+# The chunks are read on a worker thread and the next one is read
+# only once the previous one is written , so a 100 MB file never sits
+# in memory and the IOLoop only forwards the chunks.
+#
+# #################################################################
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+# Files kept in the registry , the files themselves are never deleted
+BLOB_MAX_FILES = 256
+# Default size of the websocket chunks
+BLOB_CHUNK_SIZE = 1024 * 1024
+BLOB_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+class BlobFile(object):
+    """
+        One file offered for download
+    """
+
+    def __init__(self, file_id : str, path : str, blob_format : str = None, info : dict = None) -> None:
+        self.id = file_id
+        self.path = path
+        self.name = os.path.basename(path)
+        self.format = blob_format or os.path.splitext(path)[1]
+        self.size = os.path.getsize(path)
+        self.created = time.time()
+        self.info = info or {}
+
+    def get_info(self) -> dict:
+        """
+            Description sent to the clients
+            Returns : dict # id , name , format , size , url , created and the given info
+        """
+        res = dict(self.info)
+        res.update({
+            "id" : self.id,
+            "name" : self.name,
+            "format" : self.format,
+            "size" : self.size,
+            "url" : "/blob/{}".format(self.id),
+            "created" : self.created,
+        })
+        return res
+
+class BlobFileRegistry(object):
+    """
+        Registry of the last saved files
+    """
+
+    def __init__(self, max_files : int = BLOB_MAX_FILES) -> None:
+        self.max_files = max_files
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, path : str, blob_format : str = None, info : dict = None) -> dict:
+        """
+            Offer a saved file to the clients | 登记可下载文件
+            Args :
+                path : str # file already written
+                blob_format : str # like ".fits" , the extension of the file if None
+                info : dict # extra fields of the description , like the device
+            Returns : dict # see BlobFile.get_info()
+        """
+        blob_file = BlobFile(uuid4().hex, path, blob_format, info)
+        with self._lock:
+            self._files[blob_file.id] = blob_file
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+        return blob_file.get_info()
+
+    def get(self, file_id : str) -> BlobFile:
+        """
+            Get a registered file
+            Args :
+                file_id : str
+            Returns : BlobFile
+            NOTE : Raise KeyError if the file is unknown or was dropped
+        """
+        with self._lock:
+            return self._files[file_id]
+
+    def last(self) -> BlobFile:
+        """
+            Get the last registered file , None if empty
+        """
+        with self._lock:
+            return next(reversed(self._files.values()), None)
+
+blob_files = BlobFileRegistry()
+
+def write_buffer(f, data, chunk_size : int = BLOB_CHUNK_SIZE) -> int:
+    """
+        Write a big buffer in memoryview slices , the data is never copied
+        Args :
+            f : binary file
+            data : bytes , bytearray or memoryview
+            chunk_size : int
+        Returns : int # bytes written
+    """
+    view = memoryview(data).cast("B")
+    for offset in range(0, len(view), chunk_size):
+        f.write(view[offset:offset + chunk_size])
+    return len(view)
+
+async def stream_file(ws, blob_file : BlobFile, chunk_size : int = BLOB_CHUNK_SIZE, offset : int = 0) -> int:
+    """
+        Send a file to a websocket as binary chunks | 分块发送文件
+        Args :
+            ws : websocket handler with write_encoded() , see server.ws.codec
+            blob_file : BlobFile
+            chunk_size : int
+            offset : int # resume a download from this byte
+        Returns : int # bytes sent
+        NOTE : Raise WebSocketClosedError if the connection is closed , OSError if the file is gone
+    """
+    chunk_size = min(max(int(chunk_size), 4096), BLOB_MAX_CHUNK_SIZE)
+    offset = min(max(int(offset), 0), blob_file.size)
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, blob_file.path, "rb")
+    sent = 0
+    try:
+        await loop.run_in_executor(None, f.seek, offset)
+        ws.write_encoded({
+            "type" : "signal",
+            "message" : "File Stream",
+            "data" : dict(blob_file.get_info(), offset=offset, chunk_size=chunk_size),
+        })
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, chunk_size)
+            if not chunk:
+                break
+            # The next chunk is read once this one is written , 0 if it was dropped
+            if not await ws.write_encoded(chunk):
+                break
+            sent += len(chunk)
+    finally:
+        await loop.run_in_executor(None, f.close)
+    ws.write_encoded({
+        "type" : "signal",
+        "message" : "File Stream End",
+        "data" : {"id" : blob_file.id, "offset" : offset, "sent" : sent, "complete" : offset + sent == blob_file.size},
+    })
+    return sent
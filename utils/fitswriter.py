@@ -0,0 +1,333 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Asynchronous FITS writer
+#
+# Frames are put into a bounded queue and written by a pool of worker
+# threads , so the exposure loop never waits for the disk. Files are
+# created exclusively , an existing file is never overwritten , a
+# "_1" , "_2" ... suffix is added instead.
+#
+# Path template fields :
+#   {target} {filter} {exposure} {index} {frame_type} {binning} ...
+#   any keyword given to submit() , plus {date} and {date_time}
+#   taken when the frame is submitted. Unknown fields are empty.
+#
+# #################################################################
+
+import os
+import queue
+import string
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from itertools import count
+
+import numpy as np
+import astropy.io.fits as fits
+
+from utils.i18n import _
+from utils.blobfiles import write_buffer
+from server.logging import logger
+
+DEFAULT_TEMPLATE = "{date}/{target}_{filter}_{exposure}s_{index:04d}.fits"
+
+# Tiled compression of astropy , "rice" is the same as fpack default
+COMPRESSION_TYPES = {
+    "rice" : "RICE_1",
+    "gzip" : "GZIP_1",
+    "hcompress" : "HCOMPRESS_1",
+}
+
+# fsync policies
+#   none : let the OS flush
+#   always : fsync every file and its directory before the job is done
+#   periodic : sync the disks at most every fsync_interval seconds
+FSYNC_POLICIES = ("none","always","periodic")
+
+class _Fields(dict):
+    """
+        Template fields , missing ones are empty
+    """
+    def __missing__(self, key):
+        return ""
+
+def _clean(value) -> str:
+    """
+        Make a field value safe to use in a file name
+    """
+    value = str(value).strip()
+    for c in ("/","\\",":","*","?","\"","<",">","|"):
+        value = value.replace(c, "_")
+    return value
+
+class FitsWriter(object):
+    """
+        Pool of threads writing FITS files from a bounded queue
+    """
+
+    def __init__(self, root : str = "images", template : str = DEFAULT_TEMPLATE, workers : int = 2,
+                    queue_size : int = 8, compression : str = None, fsync : str = "none",
+                    fsync_interval : float = 10.0) -> None:
+        """
+            Args :
+                root : str # directory the templates are relative to
+                template : str # default path template , see the header of this file
+                workers : int # number of writer threads
+                queue_size : int # frames waiting to be written , submit() fails when it is full
+                compression : str # None , "rice" , "gzip" or "hcompress"
+                fsync : str # "none" , "always" or "periodic"
+                fsync_interval : float # seconds between two syncs with the periodic policy
+        """
+        if compression is not None and compression not in COMPRESSION_TYPES:
+            raise ValueError("Unknown FITS compression : {}".format(compression))
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy : {}".format(fsync))
+        self.root = root
+        self.template = template
+        self.compression = compression
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._workers = max(1, int(workers))
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._threads = []
+        self._index = count(1)
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._status = {
+            "written" : 0,
+            "failed" : 0,
+            "bytes" : 0,
+            "last_path" : None,
+            "last_error" : None,
+        }
+
+    def start(self) -> None:
+        """
+            Start the worker threads , called by submit() if needed
+            Args : None
+            Returns : None
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._run, name="FitsWriter-{}".format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, wait : bool = True) -> None:
+        """
+            Stop the worker threads after the queued frames are written
+            Args :
+                wait : bool # wait for the threads to finish
+            Returns : None
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def get_status(self) -> dict:
+        """
+            Get the counters of the writer
+            Args : None
+            Returns : dict # queued , written , failed , bytes , last_path , last_error
+        """
+        with self._lock:
+            status = dict(self._status)
+        status["queued"] = self._queue.qsize()
+        return status
+
+    def submit(self, data, header : dict = None, template : str = None, root : str = None,
+                block : bool = False, timeout : float = None, **fields) -> Future:
+        """
+            Queue a frame to be written | 提交待保存的图像
+            Args :
+                data : np.ndarray or bytes # image , or a FITS file already encoded (INDI blobs)
+                header : dict # {keyword : value} or {keyword : (value , comment)} , only for arrays
+                template : str # path template , the default one of the writer if None
+                root : str # base directory , the default one of the writer if None
+                block : bool # wait for a free place in the queue
+                timeout : float # longest wait if block is True
+                **fields : template fields like target , filter , exposure , index
+            Returns : Future # result is the path of the written file
+            NOTE : Raise queue.Full if the queue is full , the frame is not written
+                    Raise ValueError if the template is invalid , the index is not an integer
+                    or the path is outside of the root directory
+                    The array must not be modified until the future is done
+        """
+        path = self.get_path(template, root, **fields)
+        self.start()
+        future = Future()
+        self._queue.put((future, data, header, path), block=block, timeout=timeout)
+        return future
+
+    def get_path(self, template : str = None, root : str = None, **fields) -> str:
+        """
+            Build the path of a frame from the template
+            Args :
+                template : str # path template , the default one of the writer if None
+                root : str # base directory , the default one of the writer if None
+                **fields : template fields
+            Returns : str # absolute path , inside of the root directory
+            NOTE : Raise ValueError if the template is invalid , the index is not an integer
+                    or the path is outside of the root directory
+        """
+        now = datetime.now()
+        fields = _Fields({k : _clean(v) for k, v in fields.items() if v is not None})
+        fields.setdefault("date", now.strftime("%Y-%m-%d"))
+        fields.setdefault("date_time", now.strftime("%Y-%m-%d-%H-%M-%S"))
+        if "index" not in fields:
+            fields["index"] = next(self._index)
+        elif fields["index"].isdigit():
+            fields["index"] = int(fields["index"])
+        else:
+            raise ValueError("FITS index must be an integer : {}".format(fields["index"]))
+        try:
+            path = string.Formatter().vformat(template or self.template, (), fields)
+        except (KeyError, IndexError, AttributeError, TypeError, ValueError) as e:
+            raise ValueError("Invalid FITS path template {} : {}".format(template or self.template, e))
+        # The template comes from the clients , it must not escape the root directory
+        root = os.path.realpath(root or self.root)
+        path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, path]) != root or path == root:
+            raise ValueError("FITS path is outside of {} : {}".format(root, path))
+        return path
+
+    # #################################################################
+    # Worker side
+    # #################################################################
+
+    def _run(self) -> None:
+        """
+            Worker loop
+        """
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, data, header, path = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                path, size = self._write(data, header, path)
+            except Exception as e:
+                logger.error(_("Failed to write FITS file {} , error : {}").format(path, e))
+                with self._lock:
+                    self._status["failed"] += 1
+                    self._status["last_error"] = str(e)
+                future.set_exception(e)
+                continue
+            with self._lock:
+                self._status["written"] += 1
+                self._status["bytes"] += size
+                self._status["last_path"] = path
+            future.set_result(path)
+
+    def _open_exclusive(self, path : str) -> tuple:
+        """
+            Create a new file , never overwrite an existing one
+            Returns : tuple # (file object , path really used)
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        base, ext = os.path.splitext(path)
+        if ext == ".fz":
+            base, _ext = os.path.splitext(base)
+            ext = _ext + ext
+        candidate = path
+        for i in count(1):
+            try:
+                fd = os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                return os.fdopen(fd, "wb"), candidate
+            except FileExistsError:
+                candidate = "{}_{}{}".format(base, i, ext)
+
+    def _to_hdulist(self, data : np.ndarray, header : dict) -> fits.HDUList:
+        """
+            Build the FITS structure of a frame , tile compressed if asked
+        """
+        hdr = fits.Header()
+        for key, value in (header or {}).items():
+            hdr[key] = value
+        if self.compression is not None:
+            return fits.HDUList([fits.PrimaryHDU(),
+                fits.CompImageHDU(data, header=hdr, compression_type=COMPRESSION_TYPES[self.compression])])
+        return fits.HDUList([fits.PrimaryHDU(data, header=hdr)])
+
+    def _write(self, data, header : dict, path : str) -> tuple:
+        """
+            Write one frame
+            Returns : tuple # (path , size in bytes)
+        """
+        if self.compression is not None and not isinstance(data, (bytes, bytearray, memoryview)) \
+                and not path.endswith(".fz"):
+            path += ".fz"
+        f, path = self._open_exclusive(path)
+        try:
+            with f:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    # INDI blobs are big , written in slices without a copy
+                    write_buffer(f, data)
+                else:
+                    self._to_hdulist(data, header).writeto(f)
+                f.flush()
+                if self.fsync == "always":
+                    os.fsync(f.fileno())
+                size = f.tell()
+        except BaseException:
+            os.remove(path)
+            raise
+        if self.fsync == "always":
+            dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        elif self.fsync == "periodic":
+            with self._lock:
+                due = time.monotonic() - self._last_sync >= self.fsync_interval
+                if due:
+                    self._last_sync = time.monotonic()
+            if due:
+                os.sync()
+        return path, size
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_fits_writer(options : dict = None) -> FitsWriter:
+    """
+        Get the shared FITS writer , created on the first call | 获取全局FITS写入器
+        Args :
+            options : dict # keyword arguments of FitsWriter , only used on the first call
+        Returns : FitsWriter
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = FitsWriter(**(options or {}))
+        return _writer
@@ -0,0 +1,118 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Binary frame format used to send raw images over websocket
+#
+#   offset  size  content
+#   0       4     magic b"LAPT"
+#   4       2     version (little endian uint16)
+#   6       2     reserved
+#   8       4     length of the JSON header (little endian uint32)
+#   12      n     JSON header (utf-8)
+#   ...     pad   zero padding , so the pixels start on an 8 bytes boundary
+#   offset  ...   raw pixels , little endian , row-major (C order)
+#
+# The JSON header contains at least "shape" , "dtype" and "offset",
+# so the client can build a typed array directly on the received buffer.
+#
+# #################################################################
+
+import json
+import struct
+from itertools import count
+
+import numpy as np
+
+FRAME_MAGIC = b"LAPT"
+FRAME_VERSION = 1
+FRAME_PREFIX = struct.Struct("<4sHHI")
+FRAME_ALIGN = 8
+
+# Only these types are allowed on the wire , JavaScript has typed arrays for all of them
+FRAME_DTYPES = ("uint8","uint16","int16","int32","uint32","float32","float64")
+
+_frame_id = count(1)
+
+def new_frame_id() -> int:
+    """
+        Get a new unique frame id for the current process
+        Args : None
+        Returns : int
+    """
+    return next(_frame_id)
+
+def pack_frame(nda : np.ndarray, **info) -> tuple:
+    """
+        Pack an image into a binary frame | 打包二进制图像帧
+        Args :
+            nda : np.ndarray # image data , 2D (height,width) or 3D (planes,height,width)
+            **info : dict # extra information put into the header like binning and exposure
+        Returns : tuple
+            header : dict # the JSON header written into the frame
+            frame : bytes # the whole binary message
+        NOTE : The pixels are copied only once , directly from the array into the message
+    """
+    dtype = np.dtype(nda.dtype).newbyteorder("<")
+    if dtype.name not in FRAME_DTYPES:
+        raise ValueError("Unsupported frame data type : {}".format(dtype.name))
+    # Only make a contiguous copy if the array is transposed or byte swapped
+    data = np.ascontiguousarray(nda, dtype=dtype)
+
+    header = dict(info)
+    header["id"] = header.get("id") or new_frame_id()
+    header["shape"] = list(data.shape)
+    header["dtype"] = dtype.name
+    header["size"] = data.nbytes
+
+    # The offset depends on the header length , so encode it until it is stable
+    offset = 0
+    while True:
+        header["offset"] = offset
+        _header = json.dumps(header).encode("utf-8")
+        _offset = FRAME_PREFIX.size + len(_header)
+        _offset += -_offset % FRAME_ALIGN
+        if _offset == offset:
+            break
+        offset = _offset
+
+    padding = b"\x00" * (offset - FRAME_PREFIX.size - len(_header))
+    prefix = FRAME_PREFIX.pack(FRAME_MAGIC, FRAME_VERSION, 0, len(_header))
+    return header, b"".join((prefix, _header, padding, memoryview(data).cast("B")))
+
+def unpack_frame(frame : bytes) -> tuple:
+    """
+        Unpack a binary frame | 解析二进制图像帧
+        Args :
+            frame : bytes # message created by pack_frame()
+        Returns : tuple
+            header : dict
+            nda : np.ndarray # read-only view on the frame , no copy
+    """
+    magic, version, _, length = FRAME_PREFIX.unpack_from(frame)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a LightAPT binary frame")
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version : {}".format(version))
+    header = json.loads(bytes(frame[FRAME_PREFIX.size:FRAME_PREFIX.size + length]).decode("utf-8"))
+    nda = np.frombuffer(frame, dtype=np.dtype(header["dtype"]).newbyteorder("<"),
+                        count=int(np.prod(header["shape"])), offset=header["offset"])
+    return header, nda.reshape(header["shape"])
@@ -0,0 +1,219 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Histogram , statistics and auto stretch of camera frames
+#
+# All the values sent to the client are normalized by the white level,
+# so the same screen transfer function works for 8 , 16 and 32 bits.
+#
+# #################################################################
+
+import numpy as np
+
+# Pixels used for the median and the percentiles
+STATS_SAMPLES = 1 << 20
+# Integer images with a white level above this use np.histogram instead of np.bincount
+BINCOUNT_MAX = 1 << 24
+# Scale from the median absolute deviation to the standard deviation of a normal distribution
+MAD_TO_SIGMA = 1.4826
+# Default percentiles returned with the statistics
+PERCENTILES = (0.1, 1, 5, 50, 95, 99, 99.9)
+
+# Auto stretch defaults , the same as the PixInsight screen transfer function
+STRETCH_SHADOWS_CLIP = -2.8
+STRETCH_TARGET_BACKGROUND = 0.25
+
+def white_level(nda : np.ndarray, white : float = None) -> float:
+    """
+        Get the white level used to normalize an image | 获取图像的白点
+        Args :
+            nda : np.ndarray
+            white : float # known white level like the max ADU of the camera
+        Returns : float
+    """
+    if white:
+        return float(white)
+    if nda.dtype.kind in "ui":
+        if nda.dtype.itemsize <= 2:
+            return float(np.iinfo(nda.dtype).max)
+        # 32 bits cameras rarely use the whole range
+        return float(max(1, nda.max()))
+    return 1.0
+
+def _sample(nda : np.ndarray, samples : int) -> np.ndarray:
+    """
+        Take a regular subsample of an image , no copy for small images
+        Args :
+            nda : np.ndarray
+            samples : int # wanted number of pixels
+        Returns : np.ndarray # 1D
+    """
+    flat = nda.ravel(order="K")
+    step = max(1, flat.size // samples)
+    return flat[::step]
+
+def calc_histogram(nda : np.ndarray, bins : int = 256, white : float = None) -> list:
+    """
+        Calculate the histogram of an image over the whole range | 计算直方图
+        Args :
+            nda : np.ndarray # image , any shape
+            bins : int # number of bins between 0 and the white level
+            white : float # white level , see white_level()
+        Returns : list # counts , bin i covers [i * white / bins , (i+1) * white / bins)
+        NOTE : Integer images are counted at full resolution with np.bincount and then merged,
+                no value is dropped , values above the white level go into the last bin
+    """
+    white = white_level(nda, white)
+    bins = max(1, int(bins))
+    if nda.dtype.kind in "ui" and white < BINCOUNT_MAX and (nda.dtype.kind == "u" or nda.min() >= 0):
+        flat = nda.ravel(order="K")
+        if flat.dtype.itemsize > 2:
+            flat = np.minimum(flat, int(white))
+        counts = np.bincount(flat, minlength=int(white) + 1)
+        # Merge the full resolution counts into the wanted bins
+        edges = (np.arange(len(counts)) * bins // (int(white) + 1)).clip(max=bins - 1)
+        hist = np.bincount(edges, weights=counts, minlength=bins).astype(np.int64)
+    else:
+        data = np.clip(nda.ravel(order="K"), 0, white)
+        hist, _ = np.histogram(data, bins=bins, range=(0, white))
+    return hist.tolist()
+
+def calc_stats(nda : np.ndarray, white : float = None, samples : int = STATS_SAMPLES,
+                percentiles : tuple = PERCENTILES) -> dict:
+    """
+        Calculate the statistics of an image | 计算图像统计信息
+        Args :
+            nda : np.ndarray # image , any shape
+            white : float # white level , see white_level()
+            samples : int # pixels used for the median , MAD and percentiles
+            percentiles : tuple # percentiles to return
+        Returns : dict
+            min , max , mean : float # on the whole image
+            median , mad , sigma : float # on the subsample , mad is not scaled , sigma = 1.4826 * mad
+            percentiles : dict # {"99.9" : value}
+            white : float
+        NOTE : All the values are in ADU , divide by white to normalize them
+    """
+    white = white_level(nda, white)
+    sample = _sample(nda, samples).astype(np.float32)
+    median = float(np.median(sample))
+    mad = float(np.median(np.abs(sample - median)))
+    values = np.percentile(sample, percentiles) if len(percentiles) else []
+    return {
+        "min" : float(nda.min()),
+        "max" : float(nda.max()),
+        "mean" : float(nda.mean(dtype=np.float64)),
+        "median" : median,
+        "mad" : mad,
+        "sigma" : mad * MAD_TO_SIGMA,
+        "percentiles" : {str(p) : float(v) for p, v in zip(percentiles, values)},
+        "white" : white,
+    }
+
+def mtf(midtones : float, x):
+    """
+        Midtones transfer function | 中间调传递函数
+        Args :
+            midtones : float # balance between 0 and 1 , 0.5 is linear
+            x : float or np.ndarray # normalized values between 0 and 1
+        Returns : same type as x
+    """
+    if midtones <= 0:
+        return x * 0
+    if midtones >= 1:
+        return x * 0 + 1
+    return ((midtones - 1) * x) / ((2 * midtones - 1) * x - midtones)
+
+def calc_stretch(stats : dict, shadows_clip : float = STRETCH_SHADOWS_CLIP,
+                    target_background : float = STRETCH_TARGET_BACKGROUND) -> dict:
+    """
+        Calculate the auto stretch parameters | 计算自动拉伸参数
+        Args :
+            stats : dict # result of calc_stats()
+            shadows_clip : float # shadows clipping point in sigma from the median
+            target_background : float # normalized background level after the stretch
+        Returns : dict
+            shadows : float # normalized black point
+            midtones : float # midtones balance of the MTF
+            highlights : float # normalized white point
+        NOTE : The client renders y = mtf(midtones, clip((x - shadows) / (highlights - shadows)))
+                with x = pixel / white
+    """
+    white = stats["white"] or 1.0
+    median = stats["median"] / white
+    sigma = stats["sigma"] / white
+    shadows = min(max(median + shadows_clip * sigma, 0.), 1.)
+    highlights = 1.0
+    if median - shadows <= 0 or shadows >= highlights:
+        midtones = 0.5
+    else:
+        midtones = float(mtf(target_background, (median - shadows) / (highlights - shadows)))
+    return {
+        "shadows" : shadows,
+        "midtones" : midtones,
+        "highlights" : highlights,
+    }
+
+def apply_stretch(nda : np.ndarray, stretch : dict, white : float = None) -> np.ndarray:
+    """
+        Render an image to 8 bits with the stretch parameters | 按拉伸参数渲染8位图像
+        Args :
+            nda : np.ndarray
+            stretch : dict # result of calc_stretch()
+            white : float # white level , see white_level()
+        Returns : np.ndarray # uint8 with the same shape
+        NOTE : 8 and 16 bits images go through a lookup table , one indexing pass
+    """
+    white = white_level(nda, white)
+    shadows, midtones, highlights = stretch["shadows"], stretch["midtones"], stretch["highlights"]
+    scale = max(highlights - shadows, 1e-12)
+    if nda.dtype.kind == "u" and nda.dtype.itemsize <= 2:
+        x = np.arange(np.iinfo(nda.dtype).max + 1, dtype=np.float64) / white
+        lut = mtf(midtones, np.clip((x - shadows) / scale, 0, 1))
+        lut = np.rint(lut * 255).astype(np.uint8)
+        return lut[nda]
+    x = nda.astype(np.float32) / np.float32(white)
+    x -= shadows
+    x /= scale
+    np.clip(x, 0, 1, out=x)
+    x = mtf(midtones, x)
+    return np.rint(x * 255).astype(np.uint8)
+
+def analyse_frame(nda : np.ndarray, bins : int = 256, white : float = None) -> dict:
+    """
+        Histogram , statistics and auto stretch of a frame in one call | 分析图像
+        Args :
+            nda : np.ndarray
+            bins : int # number of histogram bins
+            white : float # white level , see white_level()
+        Returns : dict
+            histogram : list # see calc_histogram()
+            stats : dict # see calc_stats()
+            stretch : dict # see calc_stretch()
+    """
+    white = white_level(nda, white)
+    stats = calc_stats(nda, white)
+    return {
+        "histogram" : calc_histogram(nda, bins, white),
+        "stats" : stats,
+        "stretch" : calc_stretch(stats),
+    }
@@ -20,6 +20,75 @@ Boston, MA 02110-1301, USA.
 
 from math import sqrt
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# #################################################################
+# Helpers shared by the filters
+# #################################################################
+
+# Rows processed at once by the median filter , keeps the window copies small on full frames
+MEDIAN_BLOCK_PIXELS = 1 << 21
+
+def _max_value(dtype : np.dtype) -> float:
+    """
+        Get the white level of an image type | 获取图像类型的最大值
+        Args :
+            dtype : np.dtype
+        Returns : float # 255 for uint8 , 65535 for uint16 , 1.0 for float images
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        return float(np.iinfo(dtype).max)
+    return 1.0
+
+def _restore_dtype(output : np.ndarray, dtype : np.dtype) -> np.ndarray:
+    """
+        Convert the float result of a filter back to the type of the input image
+        Args :
+            output : np.ndarray # float result
+            dtype : np.dtype # type of the input image
+        Returns : np.ndarray
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        output = np.clip(np.rint(output), info.min, info.max, out=output)
+    return output.astype(dtype, copy=False)
+
+def _pad(img : np.ndarray, padding : int) -> np.ndarray:
+    """
+        Reflect padding on the two image axes only , colour channels are not padded
+        Args :
+            img : np.ndarray # (height,width) or (height,width,channels)
+            padding : int
+        Returns : np.ndarray
+    """
+    pad_width = [(padding,padding),(padding,padding)] + [(0,0)] * (img.ndim - 2)
+    return np.pad(img, pad_width, mode="reflect")
+
+def _separable_filter(img : np.ndarray, kernel : np.ndarray) -> np.ndarray:
+    """
+        Convolve an image with a separable kernel , first on rows then on columns.
+        Each tap is a whole-image multiply-add , so the cost is 2 * k passes instead of k * k per pixel
+        Args :
+            img : np.ndarray # (height,width) or (height,width,channels)
+            kernel : np.ndarray # 1D normalized kernel with odd length
+        Returns : np.ndarray # float image with the same shape as the input
+    """
+    k = len(kernel)
+    padding = k // 2
+    h, w = img.shape[:2]
+    work = np.float32 if img.dtype.itemsize <= 2 else np.float64
+    padded = _pad(img, padding).astype(work, copy=False)
+    # Along the rows
+    rows = np.zeros((h + 2 * padding, w) + img.shape[2:], dtype=work)
+    for i in range(k):
+        rows += kernel[i] * padded[:, i:i + w]
+    # Along the columns
+    output = np.zeros(img.shape, dtype=work)
+    for i in range(k):
+        output += kernel[i] * rows[i:i + h]
+    return output
 
 # #################################################################
 # Some functions about filter
@@ -29,118 +98,79 @@ def medianfliter(img : np.ndarray, template_size : int) -> np.ndarray:
     """
         Median-fliter function | 中值滤波
         Args:
-            img : np.ndarray # image to calculate
+            img : np.ndarray # image to calculate , uint8 , uint16 or float , gray or colour
             template_size : int # template size , 3 or 5
         Returns:
-            np.ndarray: median-fliter image
-    """
-    output = img
-    if template_size == 3 :
-        output1 = np.zeros(img.shape, np.uint8)
-        # Complete the 9 surrounding squares and templates for bubble sorting
-        for i in range(1, output.shape[0]-1):
-            for j in range(1, output.shape[1]-1):
-                value1 = [output[i-1][j-1], output[i-1][j], output[i-1][j+1], output[i][j-1], output[i][j], output[i][j+1], output[i+1][j-1], output[i+1][j], +output[i+1][j+1]]
-                output1[i-1][j-1] = np.sort(value1)[4]
-    elif template_size == 5:
-        output1 = np.zeros(img.shape, np.uint8)
-        # Complete 25 squares around to convolve with the template
-        for i in range(2, output.shape[0]-2):
-            for j in range(2, output.shape[1]-2):
-                value1 = [output[i-2][j-2],output[i-2][j-1],output[i-2][j],output[i-2][j+1],output[i-2][j+2],output[i-1][j-2],output[i-1][j-1],output[i-1][j],output[i-1][j+1],\
-                            output[i-1][j+2],output[i][j-2],output[i][j-1],output[i][j],output[i][j+1],output[i][j+2],output[i+1][j-2],output[i+1][j-1],output[i+1][j],output[i+1][j+1],\
-                            output[i+1][j+2],output[i+2][j-2],output[i+2][j-1],output[i+2][j],output[i+2][j+1],output[i+2][j+2]]
-                output1[i-2][j-2] = value1.sort()[12]
-    else :
-        print("Unknown template size , choose from 3 or 5")
-    return output1
+            np.ndarray: median-fliter image , same shape and type as the input
+        NOTE : Borders are reflected , so the output is not shifted and has no black edges
+    """
+    if template_size not in (3,5):
+        raise ValueError("Unknown template size , choose from 3 or 5")
+    padding = template_size // 2
+    h, w = img.shape[:2]
+    padded = _pad(img, padding)
+    output = np.empty_like(img)
+    # Work on blocks of rows , each window is copied once by np.partition
+    block = max(1, MEDIAN_BLOCK_PIXELS // max(1, w * template_size))
+    middle = template_size * template_size // 2
+    for top in range(0, h, block):
+        bottom = min(h, top + block)
+        windows = sliding_window_view(padded[top:bottom + 2 * padding], (template_size,template_size), axis=(0,1))
+        windows = windows.reshape(windows.shape[:-2] + (-1,))
+        output[top:bottom] = np.partition(windows, middle, axis=-1)[..., middle]
+    return output
 
 def meanflite(img : np.ndarray, template_size : int) -> np.ndarray:
     """
-        Mean-flite function | 中值滤波
+        Mean-flite function | 均值滤波
         Args:
-            a : np.ndarray # image to calculate
-            windowsize : int # window size, 3 or 5
+            img : np.ndarray # image to calculate , uint8 , uint16 or float , gray or colour
+            template_size : int # window size, 3 or 5
         Returns:
-            output : np.ndarray # image after mean filter process
-    """
-    output = img
-    if template_size == 3:
-        # Generate 3x3 templates
-        window = np.ones((3, 3)) / 3 ** 2
-        output1 = np.zeros(img.shape, np.uint8)
-        # Complete the 9 surrounding squares and templates for bubble sorting
-        for i in range(1, output.shape[0] - 1):
-            for j in range(1, output.shape[1] - 1):
-                value = (output[i - 1][j - 1] * window[0][0] + output[i - 1][j] * window[0][1] + output[i - 1][j + 1] *
-                         window[0][2] + \
-                         output[i][j - 1] * window[1][0] + output[i][j] * window[1][1] + output[i][j + 1] * window[1][
-                             2] +\
-                         output[i + 1][j - 1] * window[2][0] + output[i + 1][j] * window[2][1] + output[i + 1][j + 1] *
-                         window[2][2])
-                output1[i - 1][j - 1] = value
-    elif template_size == 5:
-        # Generate 5x5 templates
-        window = np.ones((5, 5)) / 5 ** 2
-        output1 = np.zeros(img.shape, np.uint8)
-        # Complete 25 squares around to convolve with the template
-        for i in range(2, output.shape[0] - 2):
-            for j in range(2, output.shape[1] - 2):
-                value = (output[i - 2][j - 2] * window[0][0] + output[i - 2][j - 1] * window[0][1] + output[i - 2][j] *
-                         window[0][2] + output[i - 2][j + 1] * window[0][3] + output[i - 2][j + 2] * window[0][4] + \
-                         output[i - 1][j - 2] * window[1][0] + output[i - 1][j - 1] * window[1][1] + output[i - 1][j] *
-                         window[1][2] + output[i - 1][j + 1] * window[1][3] + output[i - 1][j + 2] * window[1][4] + \
-                         output[i][j - 2] * window[2][0] + output[i][j - 1] * window[2][1] + output[i][j] * window[2][
-                             2] + output[i][j + 1] * window[2][3] + output[i][j + 2] * window[2][4] + \
-                         output[i + 1][j - 2] * window[3][0] + output[i + 1][j - 1] * window[3][1] + output[i + 1][j] *
-                         window[3][2] + output[i + 1][j + 1] * window[3][3] + output[i + 1][j + 2] * window[3][4] + \
-                         output[i + 2][j - 2] * window[4][0] + output[i + 2][j - 1] * window[4][1] + output[i + 2][j] *
-                         window[4][2] + output[i + 2][j + 1] * window[4][3] + output[i + 2][j + 2] * window[4][4])
-                output1[i - 2][j - 2] = value
-    else:
-        print("Invalid template size was given")
-    return output1
+            output : np.ndarray # image after mean filter process , same type as the input
+    """
+    if template_size not in (3,5):
+        raise ValueError("Invalid template size was given , choose from 3 or 5")
+    # A box filter is separable , two 1D passes of 1/n
+    kernel = np.full(template_size, 1.0 / template_size)
+    return _restore_dtype(_separable_filter(img, kernel), img.dtype)
+
+def gaussian_kernel(sigma : float, kernel_size : int) -> np.ndarray:
+    """
+        Create a normalized 1D Gaussian kernel | 生成一维高斯核
+        Args :
+            sigma : float # sigma of the Gaussian
+            kernel_size : int # odd size of the kernel
+        Returns : np.ndarray
+    """
+    x = np.arange(kernel_size) - kernel_size // 2
+    kernel = np.exp(-(x ** 2) / (2 * sigma ** 2))
+    return kernel / kernel.sum()
 
 def gaussianfilter(img : np.ndarray,sigma : float,kernel_size : int) -> np.ndarray:
     """
         Gaussian filter | 高斯滤波
         Args:
-            img : np.ndarray # image to filter
+            img : np.ndarray # image to filter , gray (h,w) or colour (h,w,c)
             sigma : float # sigma of the Gaussian filter
             kernel_size : int # kernel size of the Gaussian filter
         Returns:
-            np.ndarray # filtered image
+            np.ndarray # filtered image , same type as the input
         Examples:
             gaussianfilter(image,1.5,3)
+        NOTE : The 2D Gaussian is the product of two 1D Gaussians , so it is applied as two passes
     """
-    h,w,c = img.shape
-    # Zero padding | 零填充
-    padding = kernel_size//2
-    out = np.zeros((h + 2*padding,w + 2*padding,c),dtype=np.float)
-    out[padding:padding+h,padding:padding+w] = img.copy().astype(np.float)
-    # Define filter kernel | 定义滤波核
-    kernel = np.zeros((kernel_size,kernel_size),dtype=np.float)
-    
-    for x in range(-padding,-padding+kernel_size):
-        for y in range(-padding,-padding+kernel_size):
-            kernel[y+padding,x+padding] = np.exp(-(x**2+y**2)/(2*(sigma**2)))
-    kernel /= (sigma*np.sqrt(2*np.pi))
-    kernel /= kernel.sum()
-    
-    # Convolution process | 卷积过程
-    tmp = out.copy()
-    for y in range(h):
-        for x in range(w):
-            for ci in range(c):
-                out[padding+y,padding+x,ci] = np.sum(kernel*tmp[y:y+kernel_size,x:x+kernel_size,ci])
-    
-    return out[padding:padding+h,padding:padding+w].astype(np.uint8)
+    if kernel_size % 2 == 0:
+        raise ValueError("Kernel size of the Gaussian filter must be odd")
+    return _restore_dtype(_separable_filter(img, gaussian_kernel(sigma, kernel_size)), img.dtype)
 
 # #########################################################################
 # Some functions about adding noise to image
 # #########################################################################
 
-from random import random,randint
+from random import randint
+
+_rng = np.random.default_rng()
 
 def add_salt_pepper_noise(image : np.ndarray, threshold : float) -> np.ndarray:
     """
@@ -151,22 +181,13 @@ def add_salt_pepper_noise(image : np.ndarray, threshold : float) -> np.ndarray:
         Returns:
             np.ndarray
     """
-    output = np.zeros(image.shape, np.uint8)
-    thres = 1 - threshold
-    # Traverse the grayscale of the entire image | 遍历整个图片的灰度级
-    for i in range(image.shape[0]):
-        for j in range(image.shape[1]):
-            # Generate a random number between 0-1 | 生成一个随机0-1之间的随机数
-            randomnum = random()
-            # If the random number is greater than the salt noise threshold of 0.1, set the gray level value at this position to 0, that is, add salt noise
-            if randomnum < threshold:  # 如果随机数大于盐噪声阈值0.1，则将此位置灰度级的值设为0，即添加盐噪声
-                output[i][j] = 0
-            # If the random number is greater than the pepper noise threshold of 1-0.1, set the output of the gray level at this position to 255, that is, add pepper noise
-            elif randomnum > thres:  # 如果随机数大于胡椒噪声阈值1-0.1，则将此位置灰度级的输出设为255，即添加胡椒噪声
-                output[i][j] = 255
-            # If the random number is between the two, the gray level value at this position is equal to the gray level value of the original image
-            else:  # 如果随机数处于两者之间，则此位置的灰度级的值等于原图的灰度级值
-                output[i][j] = image[i][j]
+    output = image.copy()
+    # One random number per pixel , colour channels of a pixel share it
+    randomnum = _rng.random(image.shape[:2])
+    # If the random number is less than the threshold , add salt noise (black)
+    output[randomnum < threshold] = 0
+    # If the random number is greater than 1 - threshold , add pepper noise (white)
+    output[randomnum > 1 - threshold] = _max_value(image.dtype)
     return output
 
 def add_gaussian_noise(image : np.ndarray, mean : float, var : float) -> np.ndarray:
@@ -174,100 +195,274 @@ def add_gaussian_noise(image : np.ndarray, mean : float, var : float) -> np.ndar
         Add gaussian noise to image | 为图像添加高斯噪声
         Args:
             image: np.ndarray # image to add noise
-            mean: float # mean value 均值
-            var: float # variance value 方差
+            mean: float # mean value 均值 , relative to the white level
+            var: float # variance value 方差 , relative to the white level
         Returns:
             np.ndarray # image with gaussian noise
     """
-    image = np.array(image/255, dtype=float)
-    noise = np.normal(mean, var ** 0.5, image.shape)
-    output = image + noise
-    output_handle = np.array([[[0]*3 for i in range(output.shape[1])] for i in range(output.shape[0])], dtype=float)
-    if output.min() < 0:
-        low_clip = -1.
-    else:
-        low_clip = 0.
-    for i in range (output.shape[0]):
-        for j in range (output.shape[1]):
-            for k in range (output.shape[2]):
-                if output[i][j][k] < low_clip:
-                    output_handle[i][j][k] = low_clip
-                elif output[i][j][k] > 1.0:
-                    output_handle[i][j][k] = 1.0
-                else:
-                    output_handle[i][j][k] = output[i][j][k]
-    output = np.uint8(output_handle*255)
-    return output
+    scale = _max_value(image.dtype)
+    output = image / scale + _rng.normal(mean, var ** 0.5, image.shape)
+    low_clip = -1. if output.min() < 0 and image.dtype.kind == "f" else 0.
+    np.clip(output, low_clip, 1.0, out=output)
+    return _restore_dtype(output * scale, image.dtype)
 
 def add_random_noise(image : np.ndarray,threshold : float) -> np.ndarray:
     """
         Add random noise to image | 为图像添加随机噪声
         Args:
-            image: np.ndarray # image to add noise
+            image: np.ndarray # image to add noise , modified in place
             threshold: float # probability to add noise
         Returns:
             np.ndarray # image with random noise
     """
     output = image
+    scale = _max_value(image.dtype) / 255
+    channels = image.shape[2:]
     n = randint(1, 1000) + int(threshold*20000)
-    for k in range(n-500):
-        a = randint(0, 50)
-        b = randint(0, 50)
-        c = randint(0, 50)
-        i = randint(0, image.shape[0]-1)
-        j = randint(0, image.shape[1]-1)
-        output[i][j][0] = 255-a
-        output[i][j][1] = 255-b
-        output[i][j][2] = 255-c
-    for k in range(n):
-        a = randint(0, 50)
-        b = randint(0, 50)
-        c = randint(0, 50)
-        i = randint(0, image.shape[0]-1)
-        j = randint(0, image.shape[1]-1)
-        output[i][j][0] = a
-        output[i][j][1] = b
-        output[i][j][2] = c
+    # Bright points
+    count = max(0, n - 500)
+    i = _rng.integers(0, image.shape[0], count)
+    j = _rng.integers(0, image.shape[1], count)
+    output[i, j] = (255 - _rng.integers(0, 51, (count,) + channels)) * scale
+    # Dark points
+    i = _rng.integers(0, image.shape[0], n)
+    j = _rng.integers(0, image.shape[1], n)
+    output[i, j] = _rng.integers(0, 51, (n,) + channels) * scale
     return output
 
 # #################################################################
 # Calculate the HFD
 # #################################################################
 
+# Pixels used to estimate the background , a regular subsample is enough and much faster
+BACKGROUND_SAMPLES = 1 << 18
+# Scale from the median absolute deviation to the standard deviation of a normal distribution
+MAD_TO_SIGMA = 1.4826
+# Scale from the Gaussian sigma to the FWHM , 2 * sqrt(2 * ln(2))
+SIGMA_TO_FWHM = 2.3548
+
+# Forward neighbours of a pixel in an 8-connected image , the backward ones are the same edges reversed
+_NEIGHBOURS = ((0,1),(1,-1),(1,0),(1,1))
+
+def _luminance(image : np.ndarray) -> np.ndarray:
+    """
+        Get a 2D float image to detect stars on | 获取用于寻星的灰度图像
+        Args :
+            image : np.ndarray # gray (h,w) , colour (h,w,c) or planes (c,h,w)
+        Returns : np.ndarray
+    """
+    if image.ndim == 3:
+        # The colour axis is always the shortest one
+        image = image.mean(axis=int(np.argmin(image.shape)), dtype=np.float32)
+    if image.ndim != 2:
+        raise ValueError("Star detection needs a 2D image")
+    return image
+
+def estimate_background(image : np.ndarray) -> tuple:
+    """
+        Estimate the background level and noise of an image | 估计背景与噪声
+        Args :
+            image : np.ndarray # 2D image
+        Returns : tuple
+            background : float # median of the image
+            noise : float # robust standard deviation from the MAD
+    """
+    step = max(1, int(sqrt(image.size / BACKGROUND_SAMPLES)))
+    sample = image[::step, ::step].astype(np.float32).ravel()
+    background = float(np.median(sample))
+    noise = float(np.median(np.abs(sample - background))) * MAD_TO_SIGMA
+    if noise == 0:
+        # Bias frames or heavily quantized images
+        noise = float(sample.std()) or 1.0
+    return background, noise
+
+def label_pixels(ys : np.ndarray, xs : np.ndarray, width : int) -> tuple:
+    """
+        8-connected component labelling of a sparse set of pixels | 连通域标记
+        Args :
+            ys : np.ndarray # rows of the pixels , in row-major order as given by np.nonzero()
+            xs : np.ndarray # columns of the pixels
+            width : int # width of the image
+        Returns : tuple
+            labels : np.ndarray # component index of each pixel , 0 to count-1
+            count : int # number of components
+        NOTE : Only the foreground pixels are touched , so the cost does not depend on the frame size
+    """
+    n = len(ys)
+    if n == 0:
+        return np.zeros(0, dtype=np.intp), 0
+    flat = ys.astype(np.int64) * width + xs
+    index = np.arange(n)
+    # Build the edges between neighbouring foreground pixels with a binary search
+    src, dst = [], []
+    for dy, dx in _NEIGHBOURS:
+        valid = (xs + dx >= 0) & (xs + dx < width)
+        target = flat + (dy * width + dx)
+        pos = np.minimum(np.searchsorted(flat, target), n - 1)
+        hit = valid & (flat[pos] == target)
+        src.append(index[hit])
+        dst.append(pos[hit])
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+    # Propagate the smallest index over the edges , pointer jumping makes it converge in a few rounds
+    parent = index.copy()
+    while True:
+        low = np.minimum(parent[src], parent[dst])
+        changed = parent.copy()
+        np.minimum.at(changed, src, low)
+        np.minimum.at(changed, dst, low)
+        while True:
+            jumped = changed[changed]
+            if np.array_equal(jumped, changed):
+                break
+            changed = jumped
+        if np.array_equal(changed, parent):
+            break
+        parent = changed
+    roots, labels = np.unique(parent, return_inverse=True)
+    return labels, len(roots)
+
+def detect_stars(image : np.ndarray, threshold : float = 5.0, min_area : int = 5, max_area : int = 10000,
+                    max_stars : int = 1000) -> dict:
+    """
+        Find the stars in an image | 寻星
+        Args :
+            image : np.ndarray # image to search
+            threshold : float # detection level in sigma above the background
+            min_area : int # smallest star in pixels , hot pixels and noise are smaller
+            max_area : int # biggest star in pixels , galaxies and nebulae are bigger
+            max_stars : int # keep only the brightest stars
+        Returns : dict
+            x , y : np.ndarray # flux weighted centroids
+            peak , area : np.ndarray # highest pixel above the background and number of pixels
+            background , noise : float
+    """
+    image = _luminance(image)
+    background, noise = estimate_background(image)
+    ys, xs = np.nonzero(image > background + threshold * noise)
+    labels, count = label_pixels(ys, xs, image.shape[1])
+
+    weight = image[ys, xs].astype(np.float64) - background
+    area = np.bincount(labels, minlength=count)
+    flux = np.bincount(labels, weight, minlength=count)
+    peak = np.zeros(count)
+    np.maximum.at(peak, labels, weight)
+    keep = (area >= min_area) & (area <= max_area) & (flux > 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x = np.bincount(labels, weight * xs, minlength=count) / flux
+        y = np.bincount(labels, weight * ys, minlength=count) / flux
+    order = np.argsort(-flux[keep])[:max_stars]
+    return {
+        "x" : x[keep][order],
+        "y" : y[keep][order],
+        "peak" : peak[keep][order],
+        "area" : area[keep][order],
+        "background" : background,
+        "noise" : noise,
+    }
+
+def measure_stars(image : np.ndarray, x : np.ndarray, y : np.ndarray, background : float,
+                    noise : float = 0.0, outer_diameter : int = 30) -> dict:
+    """
+        Measure the stars with radial moments | 测量星点
+        Args :
+            image : np.ndarray # image to measure
+            x , y : np.ndarray # centroids of the stars
+            background : float # background level to subtract
+            noise : float # pixels less than 2 sigma above the background are ignored
+            outer_diameter : int # diameter of the measuring circle in pixels
+        Returns : dict
+            x , y , hfd , fwhm , eccentricity , flux : np.ndarray # one value per star
+        NOTE : Stars whose circle leaves the image are dropped
+    """
+    image = _luminance(image)
+    h, w = image.shape
+    radius = max(1, int(outer_diameter) // 2)
+    inside = (x >= radius) & (x < w - radius - 1) & (y >= radius) & (y < h - radius - 1)
+    x, y = x[inside], y[inside]
+
+    # Stack the cutouts of all the stars , (stars,size,size)
+    offset = np.arange(-radius, radius + 1)
+    cx = np.rint(x).astype(np.intp)
+    cy = np.rint(y).astype(np.intp)
+    rows = cy[:, None, None] + offset[None, :, None]
+    cols = cx[:, None, None] + offset[None, None, :]
+    values = image[rows, cols].astype(np.float32) - np.float32(background)
+    # The noise in the wings would widen the moments a lot , keep only the significant pixels
+    values[values < 2 * noise] = 0
+
+    # Distances to the sub-pixel centroid
+    dx = (cols - x[:, None, None]).astype(np.float32)
+    dy = (rows - y[:, None, None]).astype(np.float32)
+    r = np.hypot(dx, dy)
+    values[r > radius] = 0
+
+    flux = values.sum(axis=(1,2), dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hfd = 2 * (values * r).sum(axis=(1,2), dtype=np.float64) / flux
+        mxx = (values * dx * dx).sum(axis=(1,2), dtype=np.float64) / flux
+        myy = (values * dy * dy).sum(axis=(1,2), dtype=np.float64) / flux
+        mxy = (values * dx * dy).sum(axis=(1,2), dtype=np.float64) / flux
+        # Eigenvalues of the second moment matrix are the squared axes of the star
+        half = (mxx + myy) / 2
+        diff = np.sqrt(((mxx - myy) / 2) ** 2 + mxy ** 2)
+        major, minor = half + diff, np.maximum(half - diff, 0)
+        fwhm = SIGMA_TO_FWHM * np.sqrt(half)
+        eccentricity = np.sqrt(1 - minor / major)
+    good = flux > 0
+    return {
+        "x" : x[good],
+        "y" : y[good],
+        "hfd" : hfd[good],
+        "fwhm" : fwhm[good],
+        "eccentricity" : eccentricity[good],
+        "flux" : flux[good],
+    }
+
+def calc_star_metrics(image : np.ndarray, outer_diameter : int = 30, threshold : float = 5.0,
+                        min_area : int = 5, max_stars : int = 1000) -> dict:
+    """
+        Detect and measure all the stars in a frame | 计算整帧的星点指标
+        Args :
+            image : np.ndarray # image to calculate
+            outer_diameter : int # diameter of the measuring circle in pixels
+            threshold : float # detection level in sigma above the background
+            min_area : int # smallest star in pixels
+            max_stars : int # measure only the brightest stars
+        Returns : dict
+            count : int # number of measured stars
+            hfd , fwhm , eccentricity , flux : float # median over the stars , 0 if there are none
+            background , noise : float
+            stars : dict # per star arrays returned by measure_stars()
+        Examples:
+            calc_star_metrics(image)["hfd"]
+    """
+    found = detect_stars(image, threshold=threshold, min_area=min_area, max_stars=max_stars)
+    stars = measure_stars(image, found["x"], found["y"], found["background"],
+                            found["noise"], outer_diameter)
+    count = len(stars["hfd"])
+    res = {
+        "count" : count,
+        "background" : found["background"],
+        "noise" : found["noise"],
+        "stars" : stars,
+    }
+    for key in ("hfd","fwhm","eccentricity","flux"):
+        res[key] = float(np.median(stars[key])) if count else 0.0
+    return res
+
 def calc_hfd(image : np.ndarray,outer_diameter : int) -> float:
     """
         Calculate the HFD of an image | 计算图像HFD
         Args:
-            image : np.ndarray # image to calculate
+            image : np.ndarray # image to calculate , not modified
             outer_diameter : int # outer diameter of the circle
         Returns:
-            float: HFD of the image
+            float: median HFD of the stars in the image
     """
     if outer_diameter is None:
         outer_diameter = 60
-    output = image
-    # Calculate the mean of the image
-    # Meanfilter ?
-    mean = np.mean(image)
-    for x in range(image.shape[0]):
-        for y in range(image.shape[1]):
-            if image[x][y] < mean: 
-                output[x][y] = 0
-            else:
-                output[x][y] -= mean
-    
-    out_radius = outer_diameter / 2
-
-    center_x = int(output.shape[0] / 2)
-    center_y = int(output.shape[1] / 2)
-
-    _sum,sum_dist = 0,0
-
-    for x in range(image.shape[0]):
-        for y in range(image.shape[1]):
-            if pow(x - center_x,2) + pow(y - center_y,2) <= pow(out_radius,2):
-                _sum += output[x][y]
-                sum_dist = output[x][y] * sqrt(pow(x - center_x,2) + pow(y - center_y,2))
-    if _sum != 0:
-        return 2 * sum_dist / _sum
-    return sqrt(2) * out_radius
+    metrics = calc_star_metrics(image, outer_diameter)
+    if metrics["count"]:
+        return metrics["hfd"]
+    return sqrt(2) * outer_diameter / 2
@@ -0,0 +1,284 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Persistent INDI XML client
+#
+# Replaces the indi_getprop / indi_setprop processes : one socket to
+# the INDI server , opened on the first call and opened again after the
+# server is restarted. A reader thread keeps every property in memory ,
+# so reading a property is a dict lookup :
+#
+#   client = INDIXMLClient("localhost" , 7624)
+#   client.get_prop("CCD Simulator" , "CONNECTION" , "CONNECT")   # "On"
+#   client.set_prop("CCD Simulator" , "CONNECTION" , "CONNECT" , "On")
+#
+# The values are the texts sent by the drivers , like indi_getprop.
+# BLOBs are never requested , the INDI server does not send them to a
+# client which did not ask for them.
+#
+# #################################################################
+
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from utils.i18n import _
+from server.logging import logger
+
+INDI_PROTOCOL_VERSION = "1.7"
+# Seconds to wait for a property not received yet , like indi_getprop
+INDI_WAIT_TIMEOUT = 2.0
+INDI_CONNECT_TIMEOUT = 2.0
+
+# Tag of the def / set vectors -> type of the property
+VECTOR_TYPES = {
+    "NumberVector" : "Number",
+    "SwitchVector" : "Switch",
+    "TextVector" : "Text",
+    "LightVector" : "Light",
+    "BLOBVector" : "BLOB",
+}
+
+class INDIXMLClient(object):
+    """
+        Long-lived connection to the INDI server | INDI常驻连接
+    """
+
+    def __init__(self, host : str = "localhost", port : int = 7624) -> None:
+        """
+            Construct a new client , the connection is opened on the first call
+            Args :
+                host : str
+                port : int
+            Returns : None
+        """
+        self.host = host
+        self.port = port
+        self._sock = None
+        self._reader = None
+        self._send_lock = threading.Lock()
+        # Held to update or read the properties , notified on every update
+        self._changed = threading.Condition()
+        # (device , property) -> {"type" , "state" , "elements" : {element : text}}
+        self._properties = {}
+
+    def is_connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self) -> bool:
+        """
+            Open the connection if it is not opened and ask for all of the properties
+            Args : None
+            Returns : bool # False if the INDI server can not be reached
+        """
+        with self._send_lock:
+            if self._sock is not None:
+                return True
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout = INDI_CONNECT_TIMEOUT)
+                sock.settimeout(None)
+                sock.sendall('<getProperties version="{}"/>\n'.format(INDI_PROTOCOL_VERSION).encode())
+            except OSError as e:
+                logger.error(_("Failed to connect to INDI server {}:{} : {}").format(self.host, self.port, e))
+                return False
+            with self._changed:
+                self._properties.clear()
+            self._sock = sock
+            self._reader = threading.Thread(target = self._read, args = (sock,), name = "indi-xml", daemon = True)
+            self._reader.start()
+            logger.info(_("Connected to INDI server {}:{}").format(self.host, self.port))
+            return True
+
+    def close(self) -> None:
+        """
+            Close the connection , the next call opens it again
+            Args : None
+            Returns : None
+        """
+        with self._send_lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        with self._changed:
+            self._properties.clear()
+            self._changed.notify_all()
+
+    # #################################################################
+    # Reader thread
+    # #################################################################
+
+    def _read(self, sock : socket.socket) -> None:
+        """
+            Parse the stream of the server , it has no root element so one is given
+        """
+        parser = ET.XMLPullParser(events = ("start", "end"))
+        parser.feed("<indi>")
+        root = None
+        depth = 0
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                parser.feed(data)
+                for event, element in parser.read_events():
+                    if event == "start":
+                        if root is None:
+                            root = element
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if depth == 1:
+                        self._handle(element)
+                        # Forget the parsed messages
+                        root.clear()
+        except (OSError, ET.ParseError) as e:
+            if self._sock is sock:
+                logger.error(_("INDI server connection lost : {}").format(e))
+        if self._sock is sock:
+            logger.info(_("Disconnected from INDI server {}:{}").format(self.host, self.port))
+            self.close()
+
+    def _handle(self, element : ET.Element) -> None:
+        """
+            Keep a def*Vector , set*Vector or delProperty message
+        """
+        tag = element.tag
+        device = element.get("device")
+        name = element.get("name")
+        if tag == "delProperty":
+            with self._changed:
+                for key in [k for k in self._properties if k[0] == device and (name is None or k[1] == name)]:
+                    del self._properties[key]
+                self._changed.notify_all()
+            return
+        kind = VECTOR_TYPES.get(tag[3:])
+        if kind is None or device is None or name is None:
+            return
+        elements = {one.get("name") : (one.text or "").strip() for one in element if one.get("name") is not None}
+        with self._changed:
+            prop = self._properties.get((device, name))
+            if tag.startswith("def") or prop is None:
+                prop = self._properties[(device, name)] = {"type" : kind, "state" : None, "elements" : {}}
+            if kind != "BLOB":
+                prop["elements"].update(elements)
+            if element.get("state") is not None:
+                prop["state"] = element.get("state")
+            self._changed.notify_all()
+
+    # #################################################################
+    # Properties
+    # #################################################################
+
+    def _wait(self, dev : str, prop : str, timeout : float) -> dict:
+        """
+            Get a property , waiting for it if it was not received yet. The condition is held
+        """
+        deadline = time.monotonic() + timeout
+        while (dev, prop) not in self._properties:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.is_connected():
+                return None
+            self._changed.wait(remaining)
+        return self._properties[(dev, prop)]
+
+    def get_prop(self, dev : str, prop : str, element : str, timeout : float = INDI_WAIT_TIMEOUT) -> str:
+        """
+            Get a property of a device
+            Args :
+                dev : str # name of the device
+                prop : str # name of the property
+                element : str # name of the element , "_STATE" for the state of the property
+                timeout : float # seconds to wait for a property not received yet
+            Returns : str # None if unknown
+        """
+        if not self.connect():
+            return None
+        with self._changed:
+            vector = self._wait(dev, prop, timeout)
+            if vector is None:
+                return None
+            if element == "_STATE":
+                return vector["state"]
+            return vector["elements"].get(element)
+
+    def set_prop(self, dev : str, prop : str, element : str, value) -> bool:
+        """
+            Set one element of a property , like indi_setprop
+            Args :
+                dev : str # name of the device
+                prop : str # name of the property
+                element : str # name of the element
+                value : str # "On" / "Off" for a switch
+            Returns : bool # False if the property is unknown or could not be sent
+        """
+        if not self.connect():
+            return False
+        with self._changed:
+            vector = self._wait(dev, prop, INDI_WAIT_TIMEOUT)
+            kind = vector["type"] if vector is not None else None
+        if kind not in ("Number", "Switch", "Text"):
+            logger.error(_("Unknown INDI property {}.{}").format(dev, prop))
+            return False
+        message = ET.Element("new{}Vector".format(kind), device = dev, name = prop)
+        ET.SubElement(message, "one{}".format(kind), name = element).text = str(value)
+        return self.send(ET.tostring(message) + b"\n")
+
+    def send(self, data : bytes) -> bool:
+        """
+            Send a raw XML message to the server
+            Args :
+                data : bytes
+            Returns : bool
+        """
+        with self._send_lock:
+            sock = self._sock
+            if sock is None:
+                return False
+            try:
+                sock.sendall(data)
+                return True
+            except OSError as e:
+                logger.error(_("Failed to send to INDI server : {}").format(e))
+        self.close()
+        return False
+
+    def get_devices(self, timeout : float = INDI_WAIT_TIMEOUT) -> list:
+        """
+            Get the devices with their connection state , like indi_getprop *.CONNECTION.CONNECT
+            Args :
+                timeout : float # seconds to wait for the properties after opening the connection
+            Returns : list # [{"device" : str , "connected" : bool}]
+        """
+        if not self.is_connected():
+            if not self.connect():
+                return []
+            # The properties are sent right after getProperties , give the drivers some time
+            time.sleep(min(timeout, 0.5))
+        with self._changed:
+            return [{"device" : dev, "connected" : vector["elements"].get("CONNECT") == "On"}
+                    for (dev, prop), vector in self._properties.items() if prop == "CONNECTION"]
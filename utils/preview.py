@@ -0,0 +1,375 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# Downsampled previews of captured frames
+#
+# Level n of a frame is the stretched 8 bits image binned by 2 ** n,
+# level 0 is the full resolution. Whole levels and tiles of a level
+# are rendered on the first request and then kept in memory.
+#
+# The raw frame is kept only for the last "raw_frames" frames , the
+# older ones keep the stretched level 1 (1/8 of a 16 bits frame) and
+# their level 0 is no longer served. The store is limited in bytes ,
+# configured in the "preview" section :
+#
+#   "preview" : {
+#       "max_bytes" : 268435456 ,  # raw frames , levels and encoded images
+#       "raw_frames" : 1
+#   }
+#
+# #################################################################
+
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+from uuid import uuid4
+
+import numpy as np
+
+from utils.histogram import analyse_frame, apply_stretch, white_level
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Longest side of the smallest level
+PREVIEW_MIN_SIZE = 256
+# Side of a tile in pixels
+PREVIEW_TILE_SIZE = 256
+PREVIEW_DEFAULTS = {
+    "max_bytes" : 256 * 1024 * 1024,
+    "raw_frames" : 1,
+}
+# zlib level of the PNG encoder , higher is much slower for little gain on noisy images
+PNG_COMPRESSION = 1
+JPEG_QUALITY = 85
+
+PREVIEW_FORMATS = ("png","jpg")
+CONTENT_TYPES = {
+    "png" : "image/png",
+    "jpg" : "image/jpeg",
+}
+
+# #################################################################
+# Encoders
+# #################################################################
+
+def _png_chunk(tag : bytes, data : bytes) -> bytes:
+    """
+        Build a PNG chunk with its length and CRC
+    """
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+def encode_png(img : np.ndarray, level : int = PNG_COMPRESSION) -> bytes:
+    """
+        Encode an 8 bits image to PNG without any extra library | 编码PNG图像
+        Args :
+            img : np.ndarray # uint8 , gray (h,w) or RGB (h,w,3)
+            level : int # zlib compression level
+        Returns : bytes
+        NOTE : Every row uses the "Up" filter , computed for the whole image at once
+    """
+    h, w = img.shape[:2]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    rows = np.ascontiguousarray(img, dtype=np.uint8).reshape(h, w * channels)
+    raw = np.empty((h, w * channels + 1), dtype=np.uint8)
+    raw[:, 0] = 2
+    raw[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=raw[1:, 1:])
+    color_type = 0 if channels == 1 else 2
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, color_type, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+def encode_image(img : np.ndarray, fmt : str = "png") -> tuple:
+    """
+        Encode an 8 bits image | 编码图像
+        Args :
+            img : np.ndarray # uint8 , gray (h,w) or RGB (h,w,3)
+            fmt : str # "png" or "jpg"
+        Returns : tuple
+            data : bytes
+            fmt : str # the format really used , JPEG needs Pillow and falls back to PNG
+    """
+    if fmt == "jpg" and Image is not None:
+        buffer = BytesIO()
+        Image.fromarray(np.ascontiguousarray(img)).save(buffer, format="JPEG", quality=JPEG_QUALITY)
+        return buffer.getvalue(), "jpg"
+    return encode_png(img), "png"
+
+# #################################################################
+# Binning
+# #################################################################
+
+def to_display(nda : np.ndarray) -> np.ndarray:
+    """
+        Get a (h,w) or (h,w,3) view of a frame for display | 转换为显示布局
+        Args :
+            nda : np.ndarray # (h,w) , (planes,h,w) or (h,w,planes)
+        Returns : np.ndarray # view , no copy
+    """
+    if nda.ndim == 2:
+        return nda
+    if nda.ndim == 3:
+        if nda.shape[0] == 3:
+            return np.moveaxis(nda, 0, -1)
+        if nda.shape[2] == 3:
+            return nda
+        if nda.shape[0] < nda.shape[2]:
+            return nda[0]
+        return nda[..., 0]
+    raise ValueError("Unsupported frame shape : {}".format(nda.shape))
+
+def bin_image(nda : np.ndarray, factor : int) -> np.ndarray:
+    """
+        Bin an image by averaging factor x factor blocks | 图像合并
+        Args :
+            nda : np.ndarray # (h,w) or (h,w,c)
+            factor : int
+        Returns : np.ndarray # float32 , the last incomplete blocks are dropped
+    """
+    if factor <= 1:
+        return nda
+    h, w = nda.shape[0] // factor, nda.shape[1] // factor
+    blocks = nda[:h * factor, :w * factor].reshape((h, factor, w, factor) + nda.shape[2:])
+    return blocks.mean(axis=(1,3), dtype=np.float32)
+
+# #################################################################
+# Preview of one frame
+# #################################################################
+
+class FramePreview(object):
+    """
+        Preview pyramid of one frame
+    """
+
+    def __init__(self, frame_id : str, nda : np.ndarray, stretch : dict, white : float) -> None:
+        """
+            Args :
+                frame_id : str
+                nda : np.ndarray # raw frame , kept as is
+                stretch : dict # see utils.histogram.calc_stretch()
+                white : float # white level of the frame
+        """
+        self.id = frame_id
+        self.nda = to_display(nda)
+        # to_display() may be a view , the whole frame stays in memory
+        self.nbytes = nda.nbytes
+        # Level of self.nda , 1 once the raw frame is released
+        self.base_level = 0
+        self.stretch = stretch
+        self.white = white
+        self.height, self.width = self.nda.shape[:2]
+        self.levels = 1
+        while max(self.height, self.width) >> (self.levels - 1) > PREVIEW_MIN_SIZE:
+            self.levels += 1
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get_info(self) -> dict:
+        """
+            Get the description of the pyramid sent to the client
+            Args : None
+            Returns : dict
+        """
+        return {
+            "id" : self.id,
+            "width" : self.width,
+            "height" : self.height,
+            "tile_size" : PREVIEW_TILE_SIZE,
+            "stretch" : self.stretch,
+            "levels" : [
+                {
+                    "level" : level,
+                    "binning" : 1 << level,
+                    "width" : self.width >> level,
+                    "height" : self.height >> level,
+                    "url" : "/preview/{}/{}.png".format(self.id, level),
+                } for level in range(self.base_level, self.levels)
+            ],
+        }
+
+    def get_size(self) -> int:
+        """
+            Get the memory used by the frame , its levels and the encoded images
+            Args : None
+            Returns : int # bytes
+        """
+        with self._lock:
+            return self.nbytes + sum(len(data) for data, _fmt in self._cache.values())
+
+    def release_raw(self) -> None:
+        """
+            Replace the raw frame by the stretched level 1 , level 0 is no longer available
+            Args : None
+            Returns : None
+        """
+        if self.base_level or self.levels < 2:
+            return
+        base = apply_stretch(bin_image(self.nda, 2), self.stretch, self.white)
+        with self._lock:
+            self.nda = base
+            self.nbytes = base.nbytes
+            self.base_level = 1
+            for key in [k for k in self._cache if k[1] == 0]:
+                del self._cache[key]
+
+    def _render(self, level : int, top : int, left : int, height : int, width : int) -> np.ndarray:
+        """
+            Stretch a region given in pixels of the level
+        """
+        with self._lock:
+            nda, base_level = self.nda, self.base_level
+        if level < base_level:
+            raise KeyError(level)
+        factor = 1 << (level - base_level)
+        region = nda[top * factor:(top + height) * factor, left * factor:(left + width) * factor]
+        if base_level:
+            # Already stretched
+            return np.rint(bin_image(region, factor)).astype(np.uint8)
+        return apply_stretch(bin_image(region, factor), self.stretch, self.white)
+
+    def _get(self, key : tuple, fmt : str, render) -> tuple:
+        """
+            Render and encode once , then return the cached bytes
+        """
+        with self._lock:
+            if key + (fmt,) in self._cache:
+                return self._cache[key + (fmt,)]
+        data = encode_image(render(), fmt)
+        with self._lock:
+            self._cache[key + (fmt,)] = data
+        return data
+
+    def get_level(self, level : int, fmt : str = "png") -> tuple:
+        """
+            Get a whole level | 获取整层预览
+            Args :
+                level : int # 0 is the full resolution
+                fmt : str # "png" or "jpg"
+            Returns : tuple # (data : bytes , fmt : str)
+        """
+        if not self.base_level <= level < self.levels:
+            raise KeyError(level)
+        return self._get(("level", level), fmt,
+            lambda : self._render(level, 0, 0, self.height >> level, self.width >> level))
+
+    def get_tile(self, level : int, x : int, y : int, fmt : str = "png") -> tuple:
+        """
+            Get a tile of a level | 获取预览图块
+            Args :
+                level : int
+                x , y : int # column and row of the tile
+                fmt : str # "png" or "jpg"
+            Returns : tuple # (data : bytes , fmt : str)
+        """
+        if not self.base_level <= level < self.levels:
+            raise KeyError(level)
+        height, width = self.height >> level, self.width >> level
+        top, left = y * PREVIEW_TILE_SIZE, x * PREVIEW_TILE_SIZE
+        if x < 0 or y < 0 or top >= height or left >= width:
+            raise KeyError((x, y))
+        size_y = min(PREVIEW_TILE_SIZE, height - top)
+        size_x = min(PREVIEW_TILE_SIZE, width - left)
+        return self._get(("tile", level, x, y), fmt,
+            lambda : self._render(level, top, left, size_y, size_x))
+
+# #################################################################
+# Store of the last frames
+# #################################################################
+
+class PreviewStore(object):
+    """
+        In memory store of the previews of the last frames
+    """
+
+    def __init__(self, options : dict = None) -> None:
+        """
+            Args :
+                options : dict # see PREVIEW_DEFAULTS
+        """
+        self.options = dict(PREVIEW_DEFAULTS)
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(options)
+
+    def configure(self, options : dict = None) -> None:
+        """
+            Change the limits of the store , applied on the next frame | 设置预览缓存
+            Args :
+                options : dict # max_bytes , raw_frames
+            Returns : None
+        """
+        self.options.update(options or {})
+
+    def add(self, nda : np.ndarray, stretch : dict = None, white : float = None) -> dict:
+        """
+            Add a frame to the store | 添加图像预览
+            Args :
+                nda : np.ndarray # raw frame
+                stretch : dict # auto stretch parameters , calculated if not given
+                white : float # white level of the frame
+            Returns : dict # see FramePreview.get_info()
+            NOTE : Nothing is rendered here , so this is cheap to call on every exposure
+        """
+        white = white_level(nda, white)
+        if stretch is None:
+            stretch = analyse_frame(nda, white=white)["stretch"]
+        preview = FramePreview(uuid4().hex, nda, stretch, white)
+        with self._lock:
+            self._frames[preview.id] = preview
+            frames = list(self._frames.values())
+        raw_frames = max(int(self.options["raw_frames"]), 1)
+        for old in frames[:-raw_frames]:
+            old.release_raw()
+        with self._lock:
+            # The newest frame is always kept
+            total = sum(frame.get_size() for frame in self._frames.values())
+            while len(self._frames) > 1 and total > self.options["max_bytes"]:
+                total -= self._frames.popitem(last=False)[1].get_size()
+        return preview.get_info()
+
+    def get_size(self) -> int:
+        """
+            Get the memory used by the store in bytes
+        """
+        with self._lock:
+            return sum(frame.get_size() for frame in self._frames.values())
+
+    def get(self, frame_id : str) -> FramePreview:
+        """
+            Get the preview of a frame
+            Args :
+                frame_id : str
+            Returns : FramePreview
+            NOTE : Raise KeyError if the frame is unknown or was dropped
+        """
+        with self._lock:
+            return self._frames[frame_id]
+
+preview_store = PreviewStore()
@@ -0,0 +1,136 @@
+# coding=utf-8
+
+"""
+
+Copyright(c) 2022-2023 Max Qian  <lightapt.com>
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Library General Public
+License version 3 as published by the Free Software Foundation.
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Library General Public License for more details.
+You should have received a copy of the GNU Library General Public License
+along with this library; see the file COPYING.LIB.  If not, write to
+the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+Boston, MA 02110-1301, USA.
+
+"""
+
+# #################################################################
+#
+# SER video file writer (planetary imaging)
+#
+#   offset  size  content
+#   0       14    "LUCAM-RECORDER"
+#   14      4     LuID
+#   18      4     ColorID , 0 mono , 100 RGB
+#   22      4     LittleEndian , 0 as written by most capture programs , data is little endian
+#   26      4     width
+#   30      4     height
+#   34      4     bits per pixel per plane
+#   38      4     frame count , updated when the file is closed
+#   42      120   observer , instrument , telescope (40 bytes each)
+#   162     8     local start time , 100 ns ticks since 0001-01-01
+#   170     8     UTC start time
+#   178     ...   frames , then one UTC timestamp (int64) per frame
+#
+# #################################################################
+
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+
+SER_HEADER = struct.Struct("<14siiiiiii40s40s40sqq")
+SER_MONO = 0
+SER_RGB = 100
+
+# Ticks of 100 ns between 0001-01-01 and 1970-01-01
+_EPOCH_TICKS = 621355968000000000
+
+def ser_timestamp(t : float = None) -> int:
+    """
+        Convert a unix time to SER ticks
+        Args :
+            t : float # seconds since 1970 , now if None
+        Returns : int
+    """
+    if t is None:
+        t = datetime.now(timezone.utc).timestamp()
+    return _EPOCH_TICKS + int(t * 10000000)
+
+class SerWriter(object):
+    """
+        Append frames to a SER file
+    """
+
+    def __init__(self, path : str, observer : str = "", instrument : str = "", telescope : str = "") -> None:
+        """
+            Args :
+                path : str
+                observer , instrument , telescope : str # written in the header
+            NOTE : The size and type are taken from the first frame
+        """
+        self.path = path
+        self.observer = observer
+        self.instrument = instrument
+        self.telescope = telescope
+        self.count = 0
+        self._file = None
+        self._shape = None
+        self._dtype = None
+        self._timestamps = []
+
+    def _open(self, nda : np.ndarray) -> None:
+        """
+            Create the file and write the header from the first frame
+        """
+        if nda.ndim == 3 and nda.shape[2] == 3:
+            color = SER_RGB
+        elif nda.ndim == 2:
+            color = SER_MONO
+        else:
+            raise ValueError("SER frames must be (h,w) or (h,w,3)")
+        self._shape = nda.shape
+        self._dtype = np.dtype("<u1") if nda.dtype.itemsize == 1 else np.dtype("<u2")
+        now = datetime.now()
+        self._file = open(self.path, "xb")
+        self._file.write(SER_HEADER.pack(b"LUCAM-RECORDER", 0, color, 0,
+            nda.shape[1], nda.shape[0], self._dtype.itemsize * 8, 0,
+            self.observer.encode()[:40], self.instrument.encode()[:40], self.telescope.encode()[:40],
+            ser_timestamp(now.timestamp() + (now.astimezone().utcoffset().total_seconds())),
+            ser_timestamp(now.timestamp())))
+
+    def write(self, nda : np.ndarray, t : float = None) -> None:
+        """
+            Append a frame | 写入一帧
+            Args :
+                nda : np.ndarray # (h,w) or (h,w,3) , 8 or 16 bits , same size for every frame
+                t : float # unix time of the frame , now if None
+            Returns : None
+        """
+        if self._file is None:
+            self._open(nda)
+        if nda.shape != self._shape:
+            raise ValueError("Frame size changed during the recording")
+        if nda.dtype != self._dtype:
+            nda = np.clip(nda, 0, np.iinfo(self._dtype).max).astype(self._dtype)
+        self._file.write(memoryview(np.ascontiguousarray(nda)).cast("B"))
+        self._timestamps.append(ser_timestamp(t))
+        self.count += 1
+
+    def close(self) -> None:
+        """
+            Write the timestamps trailer and the frame count
+            Args : None
+            Returns : None
+        """
+        if self._file is None:
+            return
+        self._file.write(np.asarray(self._timestamps, dtype="<i8").tobytes())
+        self._file.seek(38)
+        self._file.write(struct.pack("<i", self.count))
+        self._file.close()
+        self._file = None